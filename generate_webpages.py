@@ -67,17 +67,17 @@ def tuple_to_html_page(data_tuple, inc_rinchi=True, inc_rauxinfo=True, inc_longk
     head = '<?php $title = "{}"; include "/var/www/template/header.php"; ?>'.format("RInChI Example")
     foot = '<?php include "/var/www/template/footer.php"; ?>'
     main_text = head
-    web = RInChI().rinchikey_from_rinchi(data_tuple[0], "W").join(wrappings)
+    longkey, shortkey, webkey = RInChI().rinchikeys_from_rinchi(data_tuple[0], "LSW")
     if inc_rinchi:
         main_text += data_tuple[0].join(wrappings)
     if inc_rauxinfo:
         main_text += data_tuple[1].join(wrappings)
     if inc_longkey:
-        main_text += RInChI().rinchikey_from_rinchi(data_tuple[0], "L").join(wrappings)
+        main_text += longkey.join(wrappings)
     if inc_shortkey:
-        main_text += RInChI().rinchikey_from_rinchi(data_tuple[0], "S").join(wrappings)
+        main_text += shortkey.join(wrappings)
     if inc_webkey:
-        main_text += web
+        main_text += webkey.join(wrappings)
     main_text += foot
     return main_text
 
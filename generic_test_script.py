@@ -12,9 +12,14 @@ Modifications:
 """
 
 import cProfile
+import os
+import re
+import tempfile
 import time
 
-from rinchi_tools import Matcher, Molecule
+import numpy
+
+from rinchi_tools import Matcher, Molecule, RInChI, _external, _rxn_rdf_patch, fingerprints, tools, v02_tools
 
 
 def get_aldols():
@@ -59,5 +64,187 @@ def get_aldols():
     #    file.write(i + '\n')
     #print("Finished in {}".format(time.strftime("%H:%M:%S", time.gmtime(time.time() - tstart))))
 
+
+def check_split_conformance():
+    """
+    Checks that the native RInChI splitter agrees with the RInChI C library on the RInChIs in the test resources,
+    including reversed, equilibrium and unknown structure variants of each.  Prints any disagreements.
+
+    Returns:
+        The number of disagreements found
+    """
+    pairs = [(entry['rinchi'], entry.get('rauxinfo', ''))
+             for entry in tools.rinchi_to_dict_list(open(os.path.join(_external.TEST_PATH, 'tests.rinchi')).read())]
+    v02 = tools.rinchi_to_dict_list(open(os.path.join(_external.TEST_PATH, 'v02tests.rinchi')).read())
+    pairs.extend((v02_tools.convert_rinchi(entry['rinchi']), v02_tools.convert_rauxinfo(entry['rauxinfo']))
+                 for entry in v02 if 'rauxinfo' in entry)
+
+    cases = []
+    for rinchi, rauxinfo in pairs:
+        body = rinchi.rsplit('/d', 1)[0]
+        for tail in ('', '/d+', '/d-', '/d=', '/d+/u1-0-0', '/d-/u0-2-1', '/u1-1-0'):
+            cases.append((body + tail, ''))
+            cases.append((body + tail, rauxinfo))
+
+    failures = 0
+    for rinchi, rauxinfo in cases:
+        expected = RInChI().inchis_from_rinchi(rinchi, rauxinfo)
+        expected = (expected['Reactants'], expected['Products'], expected['Agents'], expected['Direction'],
+                    expected['No-Structures'])
+        result = tools.split_rinchi_inc_auxinfo(rinchi, rauxinfo, validate=False)
+        if result != expected:
+            failures += 1
+            print("Mismatch for {}\n  native: {}\n  C:      {}".format(rinchi, result, expected))
+    print("{} of {} RInChIs split identically".format(len(cases) - failures, len(cases)))
+    return failures
+
+
+def _reference_rxn_to_molfs(rxn):
+    """
+    The string slicing RXN splitter that ``_rxn_rdf_patch._tokenize_rxn`` replaced, kept for comparison.
+    """
+    while not rxn.startswith('$RXN'):
+        rxn = rxn[1:]
+    rxnts_prods_line = rxn.splitlines()[4]
+    num_reactants = int(rxnts_prods_line[0:3])
+    num_products = int(rxnts_prods_line[3:6])
+    if len(rxnts_prods_line) > 6:
+        num_agents = int(rxnts_prods_line[6:9])
+    else:
+        num_agents = 0
+    mol_entries = [item.strip() for item in rxn.split('M  END')]
+    mol_entries[0] = '$MOL' + mol_entries[0].split('$MOL')[1]
+    reactants = [mol_entries.pop(0)[5:] + '\nM  END' for _ in range(num_reactants)]
+    products = [mol_entries.pop(0)[5:] + '\nM  END' for _ in range(num_products)]
+    agents = [mol_entries.pop(0)[5:] + '\nM  END' for _ in range(num_agents)]
+
+    agent_variations = {}
+    for datum in (item.split('$DTYPE')[-1] for item in mol_entries):
+        value = re.findall(r'VARIATION\((\d+)\)', datum)
+        if value:
+            agent_variations.setdefault(int(value[0]), []).append(datum.split('\n', 2)[2].rstrip())
+    return reactants, products, agents, mol_entries, agent_variations
+
+
+def benchmark_rxn_tokenizer(repeats=200):
+    """
+    Checks that the single pass RXN tokenizer gives the same output as the string slicing splitter it replaced on the
+    RD files in the test resources, and times both.
+
+    Args:
+        repeats: The number of times each RD file is tokenized by each implementation
+
+    Returns:
+        The number of entries for which the outputs differ
+    """
+    failures = 0
+    for name in ('test.rdf', 'test2.rdf'):
+        entries = [entry.strip() for entry in open(os.path.join(_external.TEST_PATH, name)).read().split('$RFMT')[1:]]
+        for entry in entries:
+            if _rxn_rdf_patch._tokenize_rxn(entry) != _reference_rxn_to_molfs(entry):
+                failures += 1
+                print("Tokenizer output differs for an entry of {}".format(name))
+
+        timings = []
+        for function in (_reference_rxn_to_molfs, _rxn_rdf_patch._tokenize_rxn):
+            tstart = time.perf_counter()
+            for _ in range(repeats):
+                for entry in entries:
+                    function(entry)
+            timings.append((time.perf_counter() - tstart) / (repeats * len(entries)))
+        print("{}: {} entries, {:.1f} us per entry before, {:.1f} us per entry after ({:.1f}x)".format(
+            name, len(entries), timings[0] * 1e6, timings[1] * 1e6, timings[0] / timings[1]))
+    return failures
+
+
+def benchmark_fingerprint_store(rows=1000000, width=1024, k=10):
+    """
+    Checks the nearest fingerprints found in a fingerprint store of random fingerprints against a brute force ranking,
+    and times top-k queries by each metric over packed bits and int8 differences.
+
+    Args:
+        rows: The number of fingerprints in each store
+        width: The number of features in each fingerprint
+        k: The number of nearest fingerprints found
+
+    Returns:
+        The number of queries whose results differ from the brute force ranking
+    """
+    rng = numpy.random.default_rng(0)
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for dtype in ('bits', 'int8'):
+            store = fingerprints.FingerprintStore(os.path.join(directory, dtype), width, dtype)
+            for start in range(0, rows, 100000):
+                count = min(100000, rows - start)
+                if dtype == 'bits':
+                    vectors = rng.random((count, width)) < 0.1
+                else:
+                    vectors = rng.integers(-20, 20, (count, width)) * (rng.random((count, width)) < 0.1)
+                store.append((str(i) for i in range(start, start + count)), vectors)
+            query = numpy.asarray(store.matrix()[0] if dtype == 'int8' else numpy.unpackbits(store.matrix()[0]))
+
+            for metric in fingerprints.METRICS:
+                tstart = time.perf_counter()
+                nearest = store.top_k(query, k, metric)
+                elapsed = time.perf_counter() - tstart
+                scores = numpy.concatenate([store.scores(query, store.matrix()[start:start + 65536], metric)
+                                            for start in range(0, rows, 65536)])
+                order = numpy.argsort(scores if metric == 'euclidean' else -scores, kind='stable')[:k]
+                if not numpy.allclose([score for _, score in nearest], scores[order], rtol=1e-5):
+                    failures += 1
+                    print("{} {} nearest fingerprints differ from the brute force ranking".format(dtype, metric))
+                print("{} {}: {} rows in {:.3f} s ({:.0f} rows/s)".format(dtype, metric, rows, elapsed,
+                                                                        rows / elapsed))
+    return failures
+
+
+def benchmark_fingerprint_index(rows=1000000, width=1024, k=10, queries=20):
+    """
+    Measures the recall and latency of approximate top-k queries of a fingerprint store's LSH index at each probe
+    radius, against exact queries.  The fingerprints are random perturbations of a set of random centres, so that each
+    has near neighbours to find.
+
+    Args:
+        rows: The number of fingerprints in each store
+        width: The number of features in each fingerprint
+        k: The number of nearest fingerprints found
+        queries: The number of queries at each radius
+
+    Returns:
+        A dict of the mean recall of each dtype and radius
+    """
+    rng = numpy.random.default_rng(0)
+    recalls = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for dtype in ('bits', 'int8'):
+            store = fingerprints.FingerprintStore(os.path.join(directory, dtype), width, dtype)
+            centres = rng.integers(-20, 20, (rows // 20, width)) * (rng.random((rows // 20, width)) < 0.1)
+            for start in range(0, rows, 100000):
+                vectors = centres[rng.integers(0, len(centres), min(100000, rows - start))]
+                vectors = vectors + rng.integers(-3, 4, vectors.shape) * (rng.random(vectors.shape) < 0.05)
+                store.append((str(i) for i in range(start, start + len(vectors))), vectors)
+            tstart = time.perf_counter()
+            store.build_index()
+            print("{}: indexed {} rows in {:.1f} s".format(dtype, rows, time.perf_counter() - tstart))
+
+            metric = 'tanimoto' if dtype == 'bits' else 'euclidean'
+            samples = rng.integers(0, rows, queries)
+            matrix = store.matrix()
+            targets = [numpy.unpackbits(matrix[i]) if dtype == 'bits' else numpy.asarray(matrix[i]) for i in samples]
+            tstart = time.perf_counter()
+            exact = [set(key for key, _ in store.top_k(query, k, metric)) for query in targets]
+            print("{} exact: {:.1f} ms per query".format(dtype, (time.perf_counter() - tstart) / queries * 1e3))
+            for radius in range(3):
+                tstart = time.perf_counter()
+                found = [set(key for key, _ in store.top_k(query, k, metric, approximate=True, radius=radius))
+                         for query in targets]
+                elapsed = (time.perf_counter() - tstart) / queries
+                recalls[dtype, radius] = sum(len(a & b) for a, b in zip(exact, found)) / (k * queries)
+                print("{} radius {}: recall {:.3f}, {:.1f} ms per query".format(dtype, radius,
+                                                                               recalls[dtype, radius], elapsed * 1e3))
+    return recalls
+
+
 if __name__ == "__main__":
     cProfile.run('get_aldols()')
@@ -18,7 +18,7 @@ Modifications:
 import argparse
 import os
 
-from rinchi_tools import Reaction, _external, conversion, utils
+from rinchi_tools import Reaction, _external, conversion, ingestion, rdf_reader, utils
 
 
 def convert_ops(args, parser):
@@ -30,8 +30,15 @@ def convert_ops(args, parser):
         parser: An ``ArgumentParser`` object
     """
 
+    # Deduplicate huge RD file conversions in bounded memory if requested
+    seen = utils.BloomFilter(args.bloom) if args.bloom else None
+
     if args.filein:
-        args.input, input_name, extension = utils.read_input_file(args.input)
+        if args.rdf2rinchi or args.rdf2csv:
+            # Stream RD files record by record rather than reading them whole
+            args.input = rdf_reader.RDFReader(args.input)
+        else:
+            args.input, input_name, extension = utils.read_input_file(args.input)
     if args.rxn2rinchi:
         data = conversion.rxn_to_rinchi(args.input, force_equilibrium=args.equilibrium, ret_rauxinfo=args.rauxinfo,
                                         longkey=args.longkey, shortkey=args.shortkey, webkey=args.webkey)
@@ -40,7 +47,7 @@ def convert_ops(args, parser):
     elif args.rdf2rinchi:
         data = conversion.rdf_to_rinchis(args.input, force_equilibrium=args.equilibrium, return_rauxinfos=args.rauxinfo,
                                          return_longkeys=args.longkey, return_shortkeys=args.shortkey,
-                                         return_webkeys=args.webkey)
+                                         return_webkeys=args.webkey, jobs=args.jobs, seen=seen)
         text = utils.construct_output_text(data)
         utils.output(text, args.fileout, ".rinchi")
     elif args.rinchi2file:
@@ -56,16 +63,18 @@ def convert_ops(args, parser):
         if not args.fileout:
             parser.error('IOError - Fileout path required')
         if os.path.isfile(args.fileout):  # Append the file out if it exists
-            conversion.rdf_to_csv_append(args.input, args.fileout)
+            conversion.rdf_to_csv_append(args.input, args.fileout, jobs=args.jobs)
         else:  # Otherwise create a file
             conversion.rdf_to_csv(args.input, args.fileout, return_rauxinfo=args.rauxinfo, return_longkey=args.longkey,
-                                  return_shortkey=args.shortkey, return_webkey=args.webkey)
+                                  return_shortkey=args.shortkey, return_webkey=args.webkey, jobs=args.jobs,
+                                  seen=seen)
     elif args.dir2csv:
         if not args.fileout:
             parser.error('IOError - Fileout path required')
-        conversion.create_csv_from_directory(args.input, args.fileout, return_rauxinfo=args.rauxinfo,
-                                             return_longkey=args.longkey, return_shortkey=args.shortkey,
-                                             return_webkey=args.webkey)
+        # Convert whole files, in parallel if requested, checkpointing to a manifest
+        ingestion.ingest_directory(args.input, args.fileout, return_rauxinfo=args.rauxinfo, return_longkey=args.longkey,
+                                   return_shortkey=args.shortkey, return_webkey=args.webkey,
+                                   force_equilibrium=args.equilibrium, jobs=args.jobs, resume=args.resume)
     elif args.svg:
         for rinchi in args.input.splitlines():
             if rinchi.startswith("RInChI="):
@@ -117,6 +126,15 @@ def add_convert(subparser):
                                help="Generate and return the Short-RInChIKey")
     opt_to_rinchi.add_argument("-w", "--webkey", action="store_true",
                                help="Generate and return the Web-RInChIKey")
+    opt_to_rinchi.add_argument("-j", "--jobs", type=int, default=1,
+                               help="Number of worker processes for RD file conversions (--rdf2rinchi, --rdf2csv and "
+                                    "--dir2csv)")
+    opt_to_rinchi.add_argument("--resume", action="store_true",
+                               help="With --dir2csv, resume an interrupted conversion from the manifest written "
+                                    "alongside the CSV file, rather than starting afresh")
+    opt_to_rinchi.add_argument("-b", "--bloom", type=int, metavar="CAPACITY",
+                               help="Remove duplicate reactions with a Bloom filter sized for this many reactions, "
+                                    "rather than holding every key in memory (--rdf2rinchi and new --rdf2csv files)")
 
     # Add options for converting to Keys
     opt_to_key = subparser.add_argument_group("Converting RInChIs to Keys")
@@ -16,7 +16,7 @@ Modifications:
 
 import argparse
 
-from rinchi_tools import _external, database
+from rinchi_tools import _external, database, fingerprints, ingestion
 
 
 def add_db(subparser):
@@ -38,14 +38,62 @@ def add_db(subparser):
     adding.add_argument('--rdf2db', action='store_true', help='Convert and add an rdfile to an SQL database')
     adding.add_argument('--csv2db', action='store_true',
                         help='Add the contents of a rinchi .csv file to an SQL database')
+    adding.add_argument('--dir2db', action='store_true',
+                        help='Convert and add a directory of rdfiles to an SQL database')
+    adding.add_argument('--resume', action='store_true',
+                        help='With --dir2db, skip the rdfiles already ingested by an interrupted run')
+    adding.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes converting rdfiles or v0.02 RInChIs, or fingerprinting '
+                             'reactions')
+
+    # Add index operations
+    indexes = subparser.add_argument_group("Index management")
+    indexes.add_argument('--build-indexes', action='store_true',
+                         help='Index the key and rinchi columns of the input table, so lookups do not scan it')
+    indexes.add_argument('--drop-indexes', action='store_true',
+                         help='Drop the indexes created by --build-indexes, e.g. before a large load')
+    indexes.add_argument('--list-indexes', action='store_true', help='List the indexed columns of the input table')
+    indexes.add_argument('--build-text-index', action='store_true',
+                         help='Build a trigram full text index of the rinchi column of the input table, which '
+                              'substring and layer searches use instead of scanning the table')
+    indexes.add_argument('--drop-text-index', action='store_true', help='Drop the full text index of the input table')
+    indexes.add_argument('--build-component-index', action='store_true',
+                         help='Index the component InChIs of the reactions in the input table by role, which InChI '
+                              'searches use instead of parsing RInChIs')
+    indexes.add_argument('--drop-component-index', action='store_true',
+                         help='Drop the component index of the input table')
+    indexes.add_argument('--build-change-index', action='store_true',
+                         help='Calculate and store the changes across the reactions in the input table, which '
+                              'filtered searches use instead of recalculating them')
+    indexes.add_argument('--drop-change-index', action='store_true', help='Drop the change index of the input table')
+    indexes.add_argument('--build-fingerprint-index', action='store_true',
+                         help='Build an approximate nearest neighbour index of the fingerprints in the input table, '
+                              'which --cfingerprints --approximate searches instead of scoring every fingerprint')
+    indexes.add_argument('--drop-fingerprint-index', action='store_true',
+                         help='Drop the fingerprint index of the input table')
 
     # Add fingerprint related operations
     fpts = subparser.add_argument_group("Fingerprints")
     fpts.add_argument('--ufingerprints', action='store_true',
-                      help='Adds new entries to the fpts table containing fingerprint data')
+                      help='Fingerprints the reactions of the input table added since the last run, in --jobs worker '
+                           'processes, adding them to the output table (default fpts). Interrupted runs are resumed')
     fpts.add_argument('--rfingerprints', action='store_true', help='Returns the fingerprint of a given key')
     fpts.add_argument('--cfingerprints', action='store_true',
-                      help='Returns all RInChIs containing the given InChI to STDOUT')
+                      help='Returns the Long-RInChIKeys of the reactions whose fingerprints are nearest to that of the '
+                           'given RInChI or Long-RInChIKey to STDOUT')
+    fpts.add_argument('--top_k', type=int, default=_external.FINGERPRINT_TOP_K,
+                      help='The number of nearest fingerprints returned by --cfingerprints')
+    fpts.add_argument('--metric', choices=fingerprints.METRICS, default='euclidean',
+                      help='The distance or similarity by which --cfingerprints ranks fingerprints')
+    fpts.add_argument('--approximate', action='store_true',
+                      help='Search only the candidates found by the fingerprint index with --cfingerprints')
+    fpts.add_argument('--radius', type=int,
+                      help='The number of bits by which the fingerprint index codes probed by an approximate search '
+                           'may differ from the query. Larger values find more of the nearest fingerprints, slower')
+    fpts.add_argument('--fingerprint-backend', choices=('obabel', 'native'),
+                      help='The program generating molecule fingerprints for --ufingerprints and --cfingerprints '
+                           '(default: that which built the fingerprint table, or {})'.format(
+                               _external.FINGERPRINT_BACKEND))
 
     # Add converting data operations
     convert = subparser.add_argument_group("Converting operations")
@@ -66,26 +114,62 @@ def db_ops(args):
         args: The output of the ``parser.parse_args()``. The command line arguments.
     """
     args.output = args.output
-    if args.rdf2db:
-        database.rdf_to_sql(args.input, args.database, args.output)
-    if args.csv2db:
-        database.csv_to_sql(args.input, args.database, args.output)
-    if args.ufingerprints:
-        database.update_fingerprints(args.input, args.database, args.output)
-    if args.rfingerprints:
-        print(list(database.recall_fingerprints(args.input, args.database, args.output)))
-    if args.cfingerprints:
-        database.compare_fingerprints(args.input, args.database, args.output)
-    if args.key:
-        print(database.sql_key_to_rinchi(args.input, args.database, args.output, args.key))
-    if args.convert2_to_3:
-        # Names hardcoded because significant modification of the arparse system would be needed and would be complex
-        v02_column_names = ["rinchi", "rauxinfo"]
-        v10_column_names = ["rinchi", "rauxinfo", "longkey", "shortkey", "webkey"]
-        column_names = v02_column_names + v10_column_names
-        database.convert_v02_v10(args.database, args.input, *column_names)
-    if args.generate_rauxinfo:
-        database.gen_rauxinfo(args.database, args.input)
+    if args.dir2db:
+        ingestion.ingest_directory(args.input, args.database, args.output, return_rauxinfo=True, return_longkey=True,
+                                   return_shortkey=True, return_webkey=True, jobs=args.jobs,
+                                   resume=args.resume)
+
+    # The remaining operations share one session, so its connections and cached table schemas are reused
+    with database.RInChIDatabase(args.database) as db:
+        if args.rdf2db:
+            database.rdf_to_sql(args.input, db, args.output, jobs=args.jobs)
+        if args.csv2db:
+            database.csv_to_sql(args.input, db, args.output)
+        if args.ufingerprints:
+            database.update_fingerprints(db, args.input, args.output or "fpts", jobs=args.jobs,
+                                         backend=args.fingerprint_backend)
+        if args.rfingerprints:
+            print(list(database.recall_fingerprints(args.input, db, args.output)))
+        if args.cfingerprints:
+            database.compare_fingerprints(args.input, db, args.output, args.top_k, args.metric, args.approximate,
+                                          args.radius, args.fingerprint_backend)
+        if args.key:
+            print(database.sql_key_to_rinchi(args.input, db, args.output, args.key))
+        if args.convert2_to_3:
+            # Names hardcoded because significant modification of the arparse system would be needed and would be
+            # complex
+            v02_column_names = ["rinchi", "rauxinfo"]
+            v10_column_names = ["rinchi", "rauxinfo", "longkey", "shortkey", "webkey"]
+            column_names = v02_column_names + v10_column_names
+            database.convert_v02_v10(db, args.input, *column_names, jobs=args.jobs)
+        if args.generate_rauxinfo:
+            database.gen_rauxinfo(db, args.input)
+        if args.drop_indexes:
+            print("Dropped: {}".format(", ".join(database.drop_indexes(db, args.input)) or "none"))
+        if args.build_indexes:
+            print("Created: {}".format(", ".join(database.create_indexes(db, args.input)) or "none"))
+        if args.drop_text_index:
+            print("Dropped text index" if database.drop_text_index(db, args.input) else "No text index to drop")
+        if args.build_text_index:
+            print("Built text index" if database.create_text_index(db, args.input) else "Text index not supported")
+        if args.drop_component_index:
+            print("Dropped component index" if database.drop_component_index(db, args.input) else
+                  "No component index to drop")
+        if args.build_component_index:
+            print("Indexed the components of {} reactions".format(database.create_component_index(db, args.input)))
+        if args.drop_change_index:
+            print("Dropped change index" if database.drop_change_index(db, args.input) else "No change index to drop")
+        if args.build_change_index:
+            print("Indexed the changes across {} reactions".format(
+                database.create_change_index(db, args.input, jobs=args.jobs)))
+        if args.drop_fingerprint_index:
+            print("Dropped fingerprint index" if database.drop_fingerprint_index(db, args.input) else
+                  "No fingerprint index to drop")
+        if args.build_fingerprint_index:
+            print("Indexed {} fingerprints".format(database.create_fingerprint_index(db, args.input)))
+        if args.list_indexes:
+            for column, names in sorted(database.list_indexes(db, args.input).items()):
+                print('{} : {}'.format(column, ", ".join(names)))
 
 
 if __name__ == "__main__":
@@ -53,6 +53,10 @@ def add_search(subparser):
                                  "the default value of 'rinchis1-00' is used")
     io_options.add_argument("-o", "--output_format", choices=['list', 'file', 'stats'], default="list",
                             help="The format of the output - must be one of 'list', 'file', 'stats'")
+    io_options.add_argument("-p", "--page_size", type=int,
+                            help="Search one page of this many RInChIs at a time, printing a cursor token with which "
+                                 "to fetch the next page")
+    io_options.add_argument("-c", "--cursor", help="The cursor token printed with the previous page of a search")
 
     # Filters for a the search
     filters = subparser.add_argument_group("Filters - the changes should be of the form 'sp2=1,sp3=-1,...'")
@@ -81,10 +85,23 @@ def search_ops(args):
     """
     if args.table_name:
         args.is_database = True
-    results = database.search_master(args.search_term, args.file, args.table_name, args.is_database,
-                                     sd(args.hybridisation), sd(args.valence), sd(args.rings), sd(args.formula),
-                                     args.reactant, args.product, args.agent, args.number, args.key, sd(args.ringelement),
-                                     args.isotopic)
+    db = database.RInChIDatabase(args.file) if args.is_database else args.file
+    next_cursor = None
+    try:
+        if (args.page_size or args.cursor) and not args.key:
+            results, next_cursor = database.search_rinchis_page(
+                args.search_term, db, args.table_name or None, args.is_database, args.cursor, args.page_size,
+                hyb=sd(args.hybridisation), val=sd(args.valence), rings=sd(args.rings), formula=sd(args.formula),
+                ringelements=sd(args.ringelement), isotopic=args.isotopic, reactant=args.reactant,
+                product=args.product, agent=args.agent)
+        else:
+            results = database.search_master(args.search_term, db, args.table_name, args.is_database,
+                                             sd(args.hybridisation), sd(args.valence), sd(args.rings),
+                                             sd(args.formula), args.reactant, args.product, args.agent, args.number,
+                                             args.key, sd(args.ringelement), args.isotopic)
+    finally:
+        if args.is_database:
+            db.close()
 
     if args.output_format == "list":
         outstring = utils.construct_output_text(results)
@@ -97,6 +114,8 @@ def search_ops(args):
             total += len(the_value)
             print('{} : {}'.format(the_key, len(the_value)))
         print('Total: {}'.format(total))
+    if next_cursor is not None:
+        print('Next page: --cursor {}'.format(next_cursor))
 
 
 if __name__ == "__main__":
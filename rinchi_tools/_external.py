@@ -32,16 +32,90 @@ else:
 EXEC_PATH = ROOT + '{0}rinchi_tools{0}libs'.format(SEPARATOR)
 INCHI_PATH = EXEC_PATH + '{0}inchi-1'.format(SEPARATOR)
 
+# Number of structures passed to each inchi-1 process, and the number of inchi-1 processes run at once
+INCHI_BATCH_SIZE = 500
+INCHI_WORKERS = 1
+
+# Size of the in-memory cache of InChI software results, and the path and size of its optional on-disk tier
+INCHI_CACHE_SIZE = 100000
+INCHI_CACHE_PATH = None
+INCHI_CACHE_DB_SIZE = 5000000
+
+# Number of RD file records sent to a worker process at a time by parallel conversions, and the number of chunks
+# per worker allowed to be queued or awaiting output at once
+RDF_CHUNK_SIZE = 25
+RDF_CHUNKS_IN_FLIGHT = 2
+
+# Number of v0.02 rows sent to a worker process at a time by database.convert_v02_v10, and the number of converted rows
+# inserted in each transaction
+V02_CONVERSION_CHUNK_SIZE = 100
+V02_CONVERSION_COMMIT_SIZE = 10000
+
+# Minimum number of keys the Bloom filter of a conversion.CSVKeyIndex is sized for
+CSV_KEY_FILTER_MIN_CAPACITY = 100000
+
 # Path to the v1.00 RInChI C library
 LIB_RINCHI_PATH = EXEC_PATH + SEPARATOR + lib_file
 
 # Set RInChI Version
 RINCHI_VERSION = '1.00'
 
+# Number of parsed RInChIs to memoize in tools.parse_rinchi_cached
+SPLIT_CACHE_SIZE = 65536
+
 # Set RInChI database variables
 RINCHI_DATABASE = ROOT + '{0}database{0}rinchi.db'.format(SEPARATOR)
 RINCHI_DATABASE_PATH = os.path.dirname(RINCHI_DATABASE)
-RINCHI_TEMP_DATABASE = RINCHI_DATABASE_PATH + SEPARATOR + "rinchi_temp.db"
+
+# Maximum number of pooled connections held by a database session, and the number of prepared statements cached by
+# each connection
+DB_POOL_SIZE = 4
+DB_STATEMENT_CACHE_SIZE = 256
+
+# Columns of RInChI tables indexed by database.create_indexes
+DB_INDEXED_COLUMNS = ("longkey", "shortkey", "webkey", "rinchi")
+
+# Number of reactions sent to a worker process at a time when building a change index
+CHANGE_INDEX_CHUNK_SIZE = 100
+
+# Directory of the cached search databases built from flat files.  If None, each is kept alongside its flat file, or in
+# the system temporary directory if that is not writable
+SEARCH_CACHE_DIR = None
+
+# Number of rows fetched at a time by searches, and returned in each page of paginated searches
+SEARCH_PAGE_SIZE = 1000
+
+# Number of rowids in each shard of a table searched by a worker process in database.search_for_roles
+ROLE_SEARCH_SHARD_SIZE = 1000
+
+# Number of fingerprints scored in each vectorised pass over a fingerprint store, small enough for a pass to stay in the
+# CPU cache, and the default number of nearest fingerprints found
+FINGERPRINT_CHUNK_SIZE = 1024
+FINGERPRINT_TOP_K = 10
+
+# Number of molecule fingerprints to memoize by InChI, number of reactions sent to a worker process at a time when
+# building fingerprints, and number of fingerprints written to the database in each transaction
+FINGERPRINT_CACHE_SIZE = 65536
+FINGERPRINT_BUILD_CHUNK_SIZE = 100
+FINGERPRINT_COMMIT_SIZE = 10000
+
+# Program generating molecule fingerprints for reaction fingerprints: "obabel" for Open Babel's FP2 fingerprints, or
+# "native" for fingerprints.circular_fingerprint, which needs no external program.  Fingerprints compared with each
+# other must be generated by the same backend.  The radius of native fingerprints is also set here.
+FINGERPRINT_BACKEND = "obabel"
+CIRCULAR_FINGERPRINT_RADIUS = 2
+
+# Weights omega_na of the reactants and products and omega_a of the agents in reaction fingerprints, empirically derived
+# values suggested by Daniel M. Lowe (2015), and the numpy dtype of reaction fingerprints
+REACTION_FINGERPRINT_WEIGHTS = (10, 1)
+REACTION_FINGERPRINT_DTYPE = "int32"
+
+# Number of hash tables and bits per code of new fingerprint LSH indexes, and the number of bits by which the codes
+# probed by a query may differ from its own.  More tables or a larger radius find more of the nearest fingerprints,
+# but score more of the store.
+LSH_TABLES = 8
+LSH_BITS = 16
+LSH_RADIUS = 1
 
 # Set test folder
 TEST_PATH = ROOT + "{0}test-resources".format(SEPARATOR)
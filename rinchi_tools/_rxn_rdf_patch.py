@@ -11,11 +11,16 @@ Modifications:
  - D.F. Hampshire 2017
 """
 
-import os
+import functools
 import re
-import tempfile
 
-from . import _external, tools, utils
+from . import _external, inchi_cache, inchi_engine, rdf_reader, tools, utils
+
+# The tag ending each molfile
+_MOLFILE_END = 'M  END'
+
+# Matches the variation number of an RD file data field
+_VARIATION = re.compile(r'VARIATION\((\d+)\)')
 
 
 def rxn_to_molfs(rxn):
@@ -33,42 +38,85 @@ def rxn_to_molfs(rxn):
         the third a list of the agents'. These molfiles are also in the form of strings.
     """
 
-    # Count the stated number of reactants and products in the RXN file.
+    reactants, products, agents, leftovers, _ = _tokenize_rxn(rxn)
+    return reactants, products, agents, leftovers
 
-    while not rxn.startswith('$RXN'):
-        rxn = rxn[1:]
-    rxnts_prods_line = rxn.splitlines()[4]
-    num_reactants = int(rxnts_prods_line[0:3])
-    num_products = int(rxnts_prods_line[3:6])
 
-    # Count the number of agents if present; else count zero
-    if len(rxnts_prods_line) > 6:
-        num_agents = int(rxnts_prods_line[6:9])
-    else:
-        num_agents = 0
+def _tokenize_rxn(rxn):
+    """
+    Splits an RXN file into its molfiles and data in a single pass.
 
-    # Split all entries
-    mol_entries = [item.strip() for item in rxn.split('M  END')]
+    The text is walked once from the "$RXN" tag with three states: the RXN header, whose fifth line is the counts line;
+    the molfile blocks, each ending at an "M  END" tag; and the data following the final molfile, which is split at
+    each further "M  END" tag.  As each data block is closed, its final "$DTYPE"/"$DATUM" pair is checked for an agent
+    molfile belonging to a "VARIATION(n)".
 
-    # Delete data before the first "$MOL".
-    mol_entries[0] = '$MOL' + mol_entries[0].split('$MOL')[1]
+    Args:
+        rxn: The contents of an RXN file, or an RXN entry of an RD file, as a string.
 
-    # Remove data after the final "M  END" and store it.
+    Returns:
+        A tuple of the reactant, product and agent molfiles, the leftover data blocks following the molfiles, and a
+        dict of lists of agent molfiles found in the data blocks, keyed by variation number.
 
-    # Loop through these sections collecting up the reactants, products and agents.
-    reactants = []
-    for rr in range(0, num_reactants):
-        rxnt = mol_entries.pop(0)[5:] + '\nM  END'
-        reactants.append(rxnt)
-    products = []
-    for pp in range(0, num_products):
-        prod = mol_entries.pop(0)[5:] + '\nM  END'
-        products.append(prod)
-    agents = []
-    for aa in range(0, num_agents):
-        agnt = mol_entries.pop(0)[5:] + '\nM  END'
-        agents.append(agnt)
-    return reactants, products, agents, mol_entries
+    Raises:
+        IndexError: The text is not a recognisable RXN file
+    """
+
+    # Header state: skip to the "$RXN" tag and read the counts line
+    position = rxn.find('$RXN')
+    if position == -1:
+        raise IndexError("No $RXN tag found")
+    line_start = position
+    for _ in range(4):
+        line_start = rxn.find('\n', line_start) + 1
+        if not line_start:
+            raise IndexError("RXN block has no counts line")
+    line_end = rxn.find('\n', line_start)
+    counts = rxn[line_start:line_end if line_end != -1 else len(rxn)].rstrip('\r')
+    num_reactants = int(counts[0:3])
+    num_products = int(counts[3:6])
+
+    # Count the number of agents if present; else count zero
+    num_agents = int(counts[6:9]) if len(counts) > 6 else 0
+    num_molfiles = num_reactants + num_products + num_agents
+
+    molfiles = []
+    leftovers = []
+    agents_by_variation = {}
+    block_start = position
+    while block_start is not None:
+        block_end = rxn.find(_MOLFILE_END, block_start)
+        if block_end == -1:
+            block = rxn[block_start:].strip()
+            block_start = None
+        else:
+            block = rxn[block_start:block_end].strip()
+            block_start = block_end + len(_MOLFILE_END)
+
+        # Discard the RXN header before the first "$MOL" tag
+        if not molfiles and not leftovers:
+            mol_start = block.find('$MOL')
+            if mol_start == -1:
+                raise IndexError("No $MOL tag found")
+            mol_end = block.find('$MOL', mol_start + 4)
+            block = block[mol_start:mol_end if mol_end != -1 else len(block)]
+
+        if len(molfiles) < num_molfiles:
+            # Molfile state: remove the "$MOL" tag and restore the "M  END" tag
+            molfiles.append(block[5:] + '\n' + _MOLFILE_END)
+            continue
+
+        # Data state: only the final "$DTYPE" of a block can precede an embedded molfile
+        leftovers.append(block)
+        datum = block[block.rfind('$DTYPE') + len('$DTYPE'):] if '$DTYPE' in block else block
+        variation = _VARIATION.search(datum)
+        if variation:
+            agents_by_variation.setdefault(int(variation.group(1)), []).append(datum.split('\n', 2)[2].rstrip())
+
+    if len(molfiles) < num_molfiles:
+        raise IndexError("Fewer molfiles found than stated in the counts line")
+    return (molfiles[:num_reactants], molfiles[num_reactants:num_reactants + num_products],
+            molfiles[num_reactants + num_products:], leftovers, agents_by_variation)
 
 
 def rdf_to_molfs(rdfile, start=0, stop=0):
@@ -82,29 +130,20 @@ def rdf_to_molfs(rdfile, start=0, stop=0):
     Therefore, in order to export a comprehensive list of RXN files described by the RDFile, each RXN entry is
     scanned for variations, and each variation is scanned for additional substances.
 
+    The RXN entries are read one at a time, so an ``RDFReader`` over a large file is never held in memory whole.
+
     Args:
-        rdfile: The RD file text block
+        rdfile: The RD file text block, or an ``rdf_reader.RDFReader``
         start: The index of the first RXN entry to process
         stop: The index of the last RXN entry to process
 
     Returns:
-        A list of rxnfiles for conversion to a RInChI
+        A generator yielding rxnfiles for conversion to a RInChI
     """
 
-    # First, split the RDfile into its component RXN entries.
-    rxn_entries = rdfile.split('$RFMT')
-    rxn_entries = rxn_entries[1:]
-    if stop != 0:
-        rxn_entries = rxn_entries[:stop]
-    rxn_entries = rxn_entries[start:]
-
-    # Loop through the RDFile, scanning for variations and extra substances and creating a list of reactions.
-    reactions = []
-
-    for rxn_entry in rxn_entries:
-        rxns = _rdf_rxn_2_molfs(rxn_entry)
-        reactions.extend(rxns)
-    return reactions
+    # Loop through the RDFile, scanning for variations and extra substances and yielding each reaction.
+    for rxn_entry in rdf_reader.iter_records(rdfile, start, stop):
+        yield from _rdf_rxn_2_molfs(rxn_entry)
 
 
 def _rdf_rxn_2_molfs(rxn_entry):
@@ -119,16 +158,9 @@ def _rdf_rxn_2_molfs(rxn_entry):
         molfiles and a list of product molfiles.  Catalysts, solvents, etc.  are returned as both a reactant and
         a product (i.e. present on both sides of the reaction).
     """
-    reactants, products, agents, ldata = rxn_to_molfs(rxn_entry.strip())
-
-    # Discard anything before a $DTYPE tag in the leftover data, leaving
-    # behind only data sandwiched between a '$DTYPE' and an 'M  END' tag.
-    ldata = [item.split('$DTYPE')[-1] for item in ldata]
-
-    # Extract any "reaction agents" saved as embedded molfiles within the data section of the reaction record,
-    # and sort them according to variation.
-
-    agents_by_variation = _agent_harvester(ldata)
+    # Any "reaction agents" saved as embedded molfiles within the data section of the reaction record are extracted
+    # by the tokenizer, sorted according to variation.
+    reactants, products, agents, _, agents_by_variation = _tokenize_rxn(rxn_entry.strip())
 
     # Create the final list of reactions
     reactions = []
@@ -139,47 +171,18 @@ def _rdf_rxn_2_molfs(rxn_entry):
     output_rxnts = list(set(rstriplist(reactants)))
     output_prods = list(set(rstriplist(products)))
     reactions.append((output_rxnts, output_prods, list(set(rstriplist(agents)))))
-    for agents_set in agents_by_variation:
+    for agents_set in agents_by_variation.values():
         output_agents = list(set(agents_set + agents))
         reactions.append((output_rxnts, output_prods, output_agents))
     # Return this list
     return reactions
 
 
-def _agent_harvester(data):
-    """
-    Parses agent variations from the leftover data at the end of a RD files
-
-    Args:
-        data: The leftover data at the end of the RD file
-
-    Returns:
-        A complete list of agent variation stored as a list of lists
-    """
-
-    def cleanup_agent(datum):
-        return datum.split('\n', 2)[2].rstrip()
-
-    agent_variations = {}
-
-    for datum in data:
-        value = re.findall('VARIATION\((\d+)\)', datum)
-        if value is not None and value:
-            variation = int(value[0])
-            item = cleanup_agent(datum).rstrip()
-            agent_variations.setdefault(variation, []).append(item)
-    return agent_variations.values()
-
-
 def molf_2_inchi(molf):
     """Run the InChI creation software on a molfile.
 
-    The function works by saving the molfile string to a tempfile, and running
-    the inchi-1 program on this tempfile as a subprocess.
-
-    In the future, this funciton might be better implimented without the need
-    to write the molfile to a temp directory.  A python implimentation of the
-    inchi conversion software would allow this.
+    The molfile is passed to the default ``inchi_engine`` engine.  Where many molfiles are to be converted,
+    ``molfs_2_inchis`` converts them in as few runs of inchi-1 as possible.
 
     Args:
         molf: The contents of a molfile as a string.
@@ -194,29 +197,33 @@ def molf_2_inchi(molf):
         N.B. If the inchi program fails to generate data, an empty string will
         be returned instead.
     """
-    # Saves the molfile to a temporary file.
-    molf_tempfile = tempfile.NamedTemporaryFile(delete=False)
-    molf_tempfile.write(bytes(molf, 'utf-8'))
-    molf_tempfile.close()
-    # Runs inchi-1 program on this molfile, and stores the output.
-    inchi_args = [_external.INCHI_PATH, molf_tempfile.name, '-STDIO', '-NoLabels']
-    inchi_out, inchi_log = utils.call_command(inchi_args)
-    # Closes the molfile tempfile.
-    os.unlink(molf_tempfile.name)
-    # Finds and returns the inchi, auxinfo, and inchikey from the output.
-    inchi_out_lines = inchi_out.splitlines()
-    inchi = ''
-    auxinfo = ''
-    for line in inchi_out_lines:
-        if line.startswith('InChI='):
-            inchi = line
-        if line.startswith('AuxInfo='):
-            auxinfo = line
-    # Returns everything requested.
-    return inchi, auxinfo
-
-
-def molfiles_2_rinchi(reactants, products, agents, direction='+', nstructs=''):
+    return molfs_2_inchis([molf])[0]
+
+
+def molfs_2_inchis(molfs):
+    """
+    Run the InChI creation software on many molfiles at once.  Results are looked up in, and added to, the default
+    ``inchi_cache`` cache, so only molfiles not seen before are converted.
+
+    Args:
+        molfs: An iterable of molfiles as strings
+
+    Returns:
+        A list of (InChI, AuxInfo) tuples in the order of the input.  Empty strings are returned for any molfile the
+        inchi program fails to convert.
+    """
+    results = inchi_cache.get_cache().cached('molf', list(molfs), inchi_cache.normalise_molfile, _molfs_2_inchi_text)
+    return [tuple(result.split('\n', 1)) if result else ('', '') for result in results]
+
+
+def _molfs_2_inchi_text(molfs):
+    """
+    Runs the InChI software on molfiles, joining each InChI and AuxInfo into one string for caching.
+    """
+    return ['\n'.join(pair) if pair[0] else '' for pair in inchi_engine.get_engine().molfs_to_inchis(molfs)]
+
+
+def molfiles_2_rinchi(reactants, products, agents, direction='+', nstructs='', inchi_data=None):
     """
     Convert an RXN file to a RInChI.
 
@@ -226,19 +233,24 @@ def molfiles_2_rinchi(reactants, products, agents, direction='+', nstructs=''):
         agents: list of agent molfiles
         direction: The direction of the reaction
         nstructs: The no structure flag
+        inchi_data: Optional dict of molfiles and their (InChI, AuxInfo) tuples, as already calculated.  Molfiles not
+            found are converted in a single batch.
 
     Returns:
         A tuple containing the rinchi and rauxinfo
     """
+    if inchi_data is None:
+        inchi_data = {}
 
     # Run the InChI program on the Molfiles, generating AuxInfo if required.
-    def collect_inchidata(molfile_group):
-        for molfile in molfile_group:
-            yield molf_2_inchi(molfile)
-
-    reactants_i = list(collect_inchidata(reactants))
-    products_i = list(collect_inchidata(products))
-    agents_i = list(collect_inchidata(agents))
+    missing = list(set(molf for molf in reactants + products + agents if molf not in inchi_data))
+    if missing:
+        inchi_data = dict(inchi_data)
+        inchi_data.update(zip(missing, molfs_2_inchis(missing)))
+
+    reactants_i = [inchi_data[molf] for molf in reactants]
+    products_i = [inchi_data[molf] for molf in products]
+    agents_i = [inchi_data[molf] for molf in agents]
     # Build the RInChI for output.
     rinchi, rauxinfo = tools.build_rinchi_rauxinfo(reactants_i, products_i, agents_i, direction=direction,
                                                    u_struct=nstructs)
@@ -267,25 +279,89 @@ def rxn_to_rinchi(rxn_entry, force_equilibrium=False):
     return rinchi, rauxinfo
 
 
-def rdf_to_rinchi(rdf_entry, start=0, stop=0, force_equilibrium=False):
+def rdf_to_rinchi(rdf_entry, start=0, stop=0, force_equilibrium=False, jobs=1):
     """
     Converts an RD file into a list of RInChIs
 
     Args:
-        rdf_entry: The RD file as a string
+        rdf_entry: The RD file as a string, or an ``rdf_reader.RDFReader``
         start: The index of the entry to start at.
         stop: The index of the entry to end at.
         force_equilibrium: Whether to force the output RInChI to be an equilibrium reaction
+        jobs: The number of worker processes to convert chunks of RD file records in.  Results are still yielded in
+            the order of the RD file.
+
+    Returns:
+        A generator object yielding tuples of RInChI and RAuxInfo data
+    """
+    if jobs > 1:
+        chunks = utils.chunked(rdf_reader.iter_records(rdf_entry, start, stop), _external.RDF_CHUNK_SIZE)
+        convert = functools.partial(rdf_records_to_rinchis, force_equilibrium=force_equilibrium)
+        for results in utils.ordered_parallel_map(convert, chunks, jobs, _external.RDF_CHUNKS_IN_FLIGHT * jobs):
+            yield from results
+    else:
+        yield from _reactions_to_rinchis(rdf_to_molfs(rdf_entry, start, stop), force_equilibrium)
+
+
+def rdf_records_to_rinchis(records, force_equilibrium=False):
+    """
+    Converts a chunk of RD file records.  Used as the task run by worker processes of a parallel conversion.
+
+    Args:
+        records: A list of RD file records, each the text following a "$RFMT" tag
+        force_equilibrium: Whether to force the output RInChI to be an equilibrium reaction
+
+    Returns:
+        A list of tuples of RInChI and RAuxInfo data
+    """
+    reactions = (reaction for record in records for reaction in _rdf_rxn_2_molfs(record))
+    return list(_reactions_to_rinchis(reactions, force_equilibrium))
+
+
+def _reactions_to_rinchis(reactions, force_equilibrium=False):
+    """
+    Converts reactions to RInChIs, converting the molfiles of several reactions in each run of the InChI program.
+
+    Args:
+        reactions: An iterable of (reactants, products, agents) tuples of molfile lists
+        force_equilibrium: Whether to force the output RInChI to be an equilibrium reaction
 
     Returns:
         A generator object yielding tuples of RInChI and RAuxInfo data
     """
-    reactions = rdf_to_molfs(rdf_entry, start, stop)
     if force_equilibrium:
         direction = '='
     else:
         direction = '+'
+
+    for batch in _batch_reactions(reactions, inchi_engine.get_engine().batch_size):
+        molfs = list(set(molf for reaction in batch for group in reaction for molf in group))
+        inchi_data = dict(zip(molfs, molfs_2_inchis(molfs)))
+        for reaction in batch:
+            reactants, products, agents = reaction
+            out = molfiles_2_rinchi(reactants, products, agents, direction, inchi_data=inchi_data)
+            yield out
+
+
+def _batch_reactions(reactions, batch_size):
+    """
+    Groups reactions so that each group contains about ``batch_size`` molfiles.
+
+    Args:
+        reactions: An iterable of (reactants, products, agents) tuples of molfile lists
+        batch_size: The number of molfiles desired in each group
+
+    Returns:
+        A generator yielding lists of reactions
+    """
+    batch = []
+    molf_count = 0
     for reaction in reactions:
-        reactants, products, agents = reaction
-        out = molfiles_2_rinchi(reactants, products, agents, direction)
-        yield out
+        batch.append(reaction)
+        molf_count += sum(len(group) for group in reaction)
+        if molf_count >= batch_size:
+            yield batch
+            batch = []
+            molf_count = 0
+    if batch:
+        yield batch
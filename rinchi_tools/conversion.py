@@ -29,19 +29,21 @@ Modifications:
 
 """
 import csv
+import functools
 import os
+import sqlite3
 
-from . import _rxn_rdf_patch, tools, utils
+from . import _external, _rxn_rdf_patch, rdf_reader, tools, utils
 from .rinchi_lib import RInChI
 
 
 def rdf_to_rinchis(rdf, start=0, stop=0, force_equilibrium=False, return_rauxinfos=False, return_longkeys=False,
-                   return_shortkeys=False, return_webkeys=False, return_rinchis=True, columns=None):
+                   return_shortkeys=False, return_webkeys=False, return_rinchis=True, columns=None, jobs=1, seen=None):
     """
-    Convert an RDFile to a list of RInChIs.
+    Convert an RDFile to a list of RInChIs.  See ``iter_rdf_rinchis`` to process the RInChIs as they are converted.
 
     Args:
-        rdf: The contents of an RDFile as a string.
+        rdf: The contents of an RDFile as a string, or an ``rdf_reader.RDFReader`` streaming the file.
         start: The index of the RXN entry within the RDFile at which to start converting.  If set at default value (0),
             conversion begins from the first RXN entry.
         stop: The index of the RXN entry within the RDFile at which to stop converting.  If set at default value (0),
@@ -53,12 +55,49 @@ def rdf_to_rinchis(rdf, start=0, stop=0, force_equilibrium=False, return_rauxinf
         return_webkeys: If True, generates and returns Web-RInChIKeys for each generated RInChI.
         return_rinchis: Return the rinchi. Defaults to True
         columns: the data to return may be given as list of headers instead.
+        jobs: The number of worker processes converting chunks of RD file records, including key generation.  The
+            output is in the same order as a conversion in a single process.
+        seen: The Long-RInChIKeys of reactions to exclude, as a set or ``utils.BloomFilter``.  Updated in place.
 
     Returns:
         List of dicts of reaction data as defined above. The data types are the keys for each dict
     """
-    # Split the RDFile into a list of RD files.
+    return list(iter_rdf_rinchis(rdf, start, stop, force_equilibrium, return_rauxinfos, return_longkeys,
+                                 return_shortkeys, return_webkeys, return_rinchis, columns, jobs, seen))
 
+
+def iter_rdf_rinchis(rdf, start=0, stop=0, force_equilibrium=False, return_rauxinfos=False, return_longkeys=False,
+                     return_shortkeys=False, return_webkeys=False, return_rinchis=True, columns=None, jobs=1,
+                     seen=None):
+    """
+    Convert an RDFile to RInChIs, yielding the data of each unique reaction as soon as it has been converted.
+
+    Duplicate reactions are identified by their Long-RInChIKey, which is always generated for this purpose.  The keys
+    seen are held in a set unless a ``utils.BloomFilter`` is given, which bounds the memory used by very large
+    conversions at the cost of occasionally discarding a unique reaction as a false positive.
+
+    Args:
+        rdf: The contents of an RDFile as a string, or an ``rdf_reader.RDFReader`` streaming the file.
+        start: The index of the RXN entry within the RDFile at which to start converting.  If set at default value (0),
+            conversion begins from the first RXN entry.
+        stop: The index of the RXN entry within the RDFile at which to stop converting.  If set at default value (0),
+            conversion does not stop until the end of the file is reached.
+        force_equilibrium: Whether to set the direction flags explicitly to equilibrium
+        return_rauxinfos: If True, generates and returns RAuxInfo each generated RInChI.
+        return_longkeys: If True, generates and returns Long-RInChIKeys for each generated RInChI.
+        return_shortkeys: If True, generates and returns Short-RInChIKeys for each generated RInChI.
+        return_webkeys: If True, generates and returns Web-RInChIKeys for each generated RInChI.
+        return_rinchis: Return the rinchi. Defaults to True
+        columns: the data to return may be given as list of headers instead.
+        jobs: The number of worker processes converting chunks of RD file records, including key generation.  The
+            output is in the same order as a conversion in a single process.
+        seen: The Long-RInChIKeys of reactions to exclude, as a set or ``utils.BloomFilter``.  The keys of the
+            reactions yielded are added to it.  Defaults to a new set.
+
+    Returns:
+        A generator yielding a dict of reaction data as defined above for each unique reaction. The data types are
+        the keys for each dict
+    """
     if columns:
         if "rinchi" not in columns:
             return_rinchis = False
@@ -71,32 +110,61 @@ def rdf_to_rinchis(rdf, start=0, stop=0, force_equilibrium=False, return_rauxinf
         if "webkey" in columns:
             return_webkeys = True
 
+    # The key types requested, generated together for each RInChI.  The Long key always comes first.
+    key_columns = [column for column, wanted in (('longkey', return_longkeys), ('shortkey', return_shortkeys),
+                                                 ('webkey', return_webkeys)) if wanted]
+    key_types = "L" + "".join(column[0].upper() for column in key_columns if column != 'longkey')
+    rinchi_lib = RInChI()
+    if seen is None:
+        seen = set()
+
     # Looping over the RD files, convert each to a RInChI.
-    data_list = []
-    rinchis = []
-    rauxinfos = []
-
-    for pair in _rxn_rdf_patch.rdf_to_rinchi(rdf, start, stop, force_equilibrium):
-        rinchi, rauxinfo = pair
-        if rinchi not in rinchis:  # Force unique entries
-            data = {}
-            if return_rinchis:
-                data['rinchi'] = rinchi
-                rinchis.append(rinchi)
-            if return_rauxinfos:
-                data['rauxinfo'] = rauxinfo
-                rauxinfos.append(rauxinfo)
-            if return_longkeys:
-                longkey = RInChI().rinchikey_from_rinchi(rinchi, "L")
-                data['longkey'] = longkey
-            if return_shortkeys:
-                shortkey = RInChI().rinchikey_from_rinchi(rinchi, "S")
-                data['shortkey'] = shortkey
-            if return_webkeys:
-                webkey = RInChI().rinchikey_from_rinchi(rinchi, "W")
-                data['webkey'] = webkey
-            data_list.append(data)
-    return data_list
+    if jobs > 1:
+        chunks = utils.chunked(rdf_reader.iter_records(rdf, start, stop), _external.RDF_CHUNK_SIZE)
+        convert = functools.partial(_rdf_records_to_data, force_equilibrium=force_equilibrium, key_types=key_types)
+        results = (result for chunk in utils.ordered_parallel_map(convert, chunks, jobs,
+                                                                  _external.RDF_CHUNKS_IN_FLIGHT * jobs)
+                   for result in chunk)
+    else:
+        results = ((rinchi, rauxinfo, None)
+                   for rinchi, rauxinfo in _rxn_rdf_patch.rdf_to_rinchi(rdf, start, stop, force_equilibrium))
+
+    for rinchi, rauxinfo, keys in results:
+        if keys is None:
+            keys = rinchi_lib.rinchikeys_from_rinchi(rinchi, key_types)
+        keys = dict(zip(key_types, keys))
+
+        # Force unique entries
+        if keys['L'] in seen:
+            continue
+        seen.add(keys['L'])
+
+        data = {}
+        if return_rinchis:
+            data['rinchi'] = rinchi
+        if return_rauxinfos:
+            data['rauxinfo'] = rauxinfo
+        for column in key_columns:
+            data[column] = keys[column[0].upper()]
+        yield data
+
+
+def _rdf_records_to_data(records, force_equilibrium=False, key_types="L"):
+    """
+    Converts a chunk of RD file records to RInChIs and keys.  Used as the task run by worker processes of a parallel
+    conversion.
+
+    Args:
+        records: A list of RD file records, each the text following a "$RFMT" tag
+        force_equilibrium: Whether to set the direction flags explicitly to equilibrium
+        key_types: The types of key to generate, as a string of "L", "S" and "W" characters
+
+    Returns:
+        A list of tuples of the RInChI, the RAuxInfo and a tuple of the requested keys
+    """
+    rinchi_lib = RInChI()
+    return [(rinchi, rauxinfo, rinchi_lib.rinchikeys_from_rinchi(rinchi, key_types))
+            for rinchi, rauxinfo in _rxn_rdf_patch.rdf_records_to_rinchis(records, force_equilibrium)]
 
 
 def rxn_to_rinchi(rxn_text, ret_rauxinfo=False, longkey=False, shortkey=False, webkey=False, force_equilibrium=False):
@@ -124,12 +192,11 @@ def rxn_to_rinchi(rxn_text, ret_rauxinfo=False, longkey=False, shortkey=False, w
     data = {'rinchi': rinchi}
     if ret_rauxinfo:
         data['rauxinfo'] = rauxinfo
-    if longkey:
-        data['longkey'] = RInChI().rinchikey_from_rinchi(rinchi, "L")
-    if shortkey:
-        data['shortkey'] = RInChI().rinchikey_from_rinchi(rinchi, "S")
-    if webkey:
-        data['webkey'] = RInChI().rinchikey_from_rinchi(rinchi, "W")
+    key_columns = [column for column, wanted in (('longkey', longkey), ('shortkey', shortkey), ('webkey', webkey))
+                   if wanted]
+    if key_columns:
+        key_types = "".join(column[0].upper() for column in key_columns)
+        data.update(zip(key_columns, RInChI().rinchikeys_from_rinchi(rinchi, key_types)))
     return data
 
 
@@ -179,6 +246,10 @@ def rinchis_to_keys(data, longkey=False, shortkey=False, webkey=False, inc_rinch
             {'rinchi': '[DATA], 'rauxinfo': [DATA, ... }
     """
     data_list = tools.rinchi_to_dict_list(data)
+    key_columns = [column for column, wanted in (('longkey', longkey), ('shortkey', shortkey), ('webkey', webkey))
+                   if wanted]
+    key_types = "".join(column[0].upper() for column in key_columns)
+    rinchi_lib = RInChI()
     for entry in data_list:
         assert isinstance(entry, dict)
         if 'rauxinfo' not in entry and inc_rauxinfo:
@@ -190,12 +261,8 @@ def rinchis_to_keys(data, longkey=False, shortkey=False, webkey=False, inc_rinch
             except KeyError:
                 pass
         # Calculate keys
-        if longkey:
-            entry['longkey'] = RInChI().rinchikey_from_rinchi(entry['rinchi'], "L")
-        if shortkey:
-            entry['shortkey'] = RInChI().rinchikey_from_rinchi(entry['rinchi'], "S")
-        if webkey:
-            entry['webkey'] = RInChI().rinchikey_from_rinchi(entry['rinchi'], "W")
+        if key_types:
+            entry.update(zip(key_columns, rinchi_lib.rinchikeys_from_rinchi(entry['rinchi'], key_types)))
         if not inc_rinchi:
             # Remove RInChI if not needed
             del entry['rinchi']
@@ -206,19 +273,134 @@ def rinchis_to_keys(data, longkey=False, shortkey=False, webkey=False, inc_rinch
 # CSV Tools
 ###########
 
+# Extension of the sidecar Long-RInChIKey index of a CSV file
+KEY_INDEX_EXTENSION = '.keys'
+
+
+class CSVKeyIndex:
+    """
+    A persistent index of the Long-RInChIKeys in a CSV file, kept in a SQLite file alongside it.  Supports ``in`` and
+    ``add()`` like a set, so it can be passed as the ``seen`` keys of a conversion.
+
+    The size and modification time of the CSV file are recorded whenever the index is synced.  If the CSV file has
+    been changed by anything else since, the index is rebuilt from it.
+
+    The keys are also held in a ``utils.BloomFilter``, so that most keys not in the index are ruled out without
+    querying it.
+    """
+
+    def __init__(self, csv_file):
+        """
+        Args:
+            csv_file: The path of the CSV file
+        """
+        self.csv_file = csv_file
+        self.path = csv_file + KEY_INDEX_EXTENSION
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS csv_keys (longkey TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS csv_state (size INTEGER, mtime INTEGER)')
+        self.db.commit()
+        if not self.is_current():
+            self.rebuild()
+        else:
+            self._load_filter()
+
+    def __repr__(self):
+        return "<CSVKeyIndex {} keys of {}>".format(len(self), self.csv_file)
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM csv_keys').fetchone()[0]
+
+    def __contains__(self, longkey):
+        if longkey not in self.filter:
+            return False
+        return self.db.execute('SELECT 1 FROM csv_keys WHERE longkey = ?', (longkey,)).fetchone() is not None
+
+    def add(self, longkey):
+        """
+        Adds a key to the index.  Not saved until ``sync()`` is called.
+
+        Args:
+            longkey: The Long-RInChIKey to add
+        """
+        self.db.execute('INSERT OR IGNORE INTO csv_keys VALUES (?)', (longkey,))
+        self.filter.add(longkey)
+
+    def is_current(self):
+        """
+        Returns:
+            True if the CSV file is unchanged since the index was last synced, otherwise False
+        """
+        state = self.db.execute('SELECT size, mtime FROM csv_state').fetchone()
+        stat = os.stat(self.csv_file)
+        return state == (stat.st_size, stat.st_mtime_ns)
+
+    def rebuild(self):
+        """
+        Rebuilds the index by reading the CSV file once.  If the file has no longkey column, the keys are generated
+        from its RInChIs.
+        """
+        self.db.execute('DELETE FROM csv_keys')
+        with open(self.csv_file) as f:
+            reader = csv.DictReader(f, delimiter="$")
+            if reader.fieldnames is None:
+                keys = ()
+            elif "longkey" in reader.fieldnames:
+                keys = (row['longkey'] for row in reader)
+            else:
+                rinchi_lib = RInChI()
+                keys = (rinchi_lib.rinchikeys_from_rinchi(row['rinchi'], "L")[0] for row in reader)
+            self.db.executemany('INSERT OR IGNORE INTO csv_keys VALUES (?)', ((key,) for key in keys))
+        self.sync()
+        self._load_filter()
+
+    def _load_filter(self):
+        """
+        Loads the keys of the index into a new Bloom filter, with room for as many keys again to be added
+        """
+        self.filter = utils.BloomFilter(max(2 * len(self), _external.CSV_KEY_FILTER_MIN_CAPACITY))
+        for (longkey,) in self.db.execute('SELECT longkey FROM csv_keys'):
+            self.filter.add(longkey)
+
+    def sync(self):
+        """
+        Saves the keys added and records the current state of the CSV file.  Call after writing to the CSV file.
+        """
+        stat = os.stat(self.csv_file)
+        self.db.execute('DELETE FROM csv_state')
+        self.db.execute('INSERT INTO csv_state VALUES (?, ?)', (stat.st_size, stat.st_mtime_ns))
+        self.db.commit()
+
+    def discard(self):
+        """
+        Discards the keys added since the last ``sync()``, e.g. after failing to write their rows to the CSV file.  They
+        remain in the Bloom filter, but are no longer found in the index.
+        """
+        self.db.rollback()
+
+    def close(self):
+        """
+        Closes the index database
+        """
+        self.db.close()
+
 
 def rdf_to_csv(rdf, outfile="rinchi", return_rauxinfo=False, return_longkey=False, return_shortkey=False,
-               return_webkey=False):
+               return_webkey=False, jobs=1, seen=None):
     """
-    Convert an RD file to a CSV file containing RInChIs and other optional parameters
+    Convert an RD file to a CSV file containing RInChIs and other optional parameters.  Rows are written as each
+    reaction is converted.
 
     Args:
-        rdf: The RD file as a text block
+        rdf: The RD file as a text block, or an ``rdf_reader.RDFReader``
         outfile: Optional output file name parameter
         return_rauxinfo: Include RAuxInfo in the result
         return_longkey: Include Long key in the result
         return_shortkey: Include the Short key in the result
         return_webkey: Include the Web key in the result
+        jobs: The number of worker processes to convert the RD file in
+        seen: The Long-RInChIKeys of reactions to exclude, as a set or ``utils.BloomFilter``.  The keys of the
+            reactions written are added to it.  If None, the keys are saved to a ``CSVKeyIndex`` of the new file.
 
     Returns:
         The name of the CSV file created with the requested fields
@@ -235,65 +417,78 @@ def rdf_to_csv(rdf, outfile="rinchi", return_rauxinfo=False, return_longkey=Fals
     if return_webkey:
         header.append("webkey")
 
-    data = rdf_to_rinchis(rdf, force_equilibrium=False, return_rauxinfos=return_rauxinfo,
-                          return_longkeys=return_longkey, return_shortkeys=return_shortkey,
-                          return_webkeys=return_webkey)
-
-    # Write new database file as .csv
+    # Write new database file as .csv, indexing its keys for later appends
     f, path = utils.create_output_file(outfile, '.csv')
-    writer = csv.DictWriter(f, header, delimiter='$')
-    writer.writeheader()
-    writer.writerows(data)
+    index = CSVKeyIndex(path) if seen is None else None
+    data = iter_rdf_rinchis(rdf, force_equilibrium=False, return_rauxinfos=return_rauxinfo,
+                            return_longkeys=return_longkey, return_shortkeys=return_shortkey,
+                            return_webkeys=return_webkey, jobs=jobs, seen=seen if index is None else index)
+    with f:
+        writer = csv.DictWriter(f, header, delimiter='$')
+        writer.writeheader()
+        writer.writerows(data)
+    if index is not None:
+        index.sync()
+        index.close()
     return os.path.abspath(path)
 
 
-def rdf_to_csv_append(rdf, csv_file, existing_keys=None):
+def rdf_to_csv_append(rdf, csv_file, existing_keys=None, jobs=1):
     """
-    Append an existing CSV file with values from an RD file
+    Append an existing CSV file with values from an RD file.  Rows are written as each new reaction is converted.
 
     Args:
-        rdf: The RD file as a text block
+        rdf: The RD file as a text block, or an ``rdf_reader.RDFReader``
         csv_file: the CSV file path
-        existing_keys: The keys already existing in the CSV file
+        existing_keys: The Long-RInChIKeys already existing in the CSV file, as a set, ``utils.BloomFilter`` or
+            ``CSVKeyIndex``.  If None, the ``CSVKeyIndex`` of the file is used, which is only built by reading the
+            file if missing or out of date.
+        jobs: The number of worker processes to convert the RD file in
+
+    Returns:
+        The Long-RInChIKeys existing in the CSV file, including those added.  A ``CSVKeyIndex`` opened by this
+        function is closed first.
     """
 
     # Open the existing csv_file and read the header defining which fields are present
     with open(csv_file) as f:
-        reader = csv.DictReader(f, delimiter="$")
-        header = reader.fieldnames
-        if existing_keys is None:
-            existing_keys = set(row['longkey'] for row in reader)
+        header = csv.DictReader(f, delimiter="$").fieldnames
+    own_index = existing_keys is None
+    if own_index:
+        existing_keys = CSVKeyIndex(csv_file)
 
     return_rauxinfo = "rauxinfo" in header
     return_longkey = "longkey" in header
     return_shortkey = "shortkey" in header
     return_webkey = "webkey" in header
 
-    # Construct a dict of RInChIs and RInChI data from the supplied rd file
-    data = rdf_to_rinchis(rdf, force_equilibrium=False, return_rauxinfos=return_rauxinfo,
-                          return_longkeys=return_longkey, return_shortkeys=return_shortkey,
-                          return_webkeys=return_webkey)
+    # Convert the supplied rd file, skipping reactions whose keys already exist in the csv_file
+    data = iter_rdf_rinchis(rdf, force_equilibrium=False, return_rauxinfos=return_rauxinfo,
+                            return_longkeys=return_longkey, return_shortkeys=return_shortkey,
+                            return_webkeys=return_webkey, jobs=jobs, seen=existing_keys)
 
     # Add all new, unique rinchis to the csv_file
     with open(csv_file, "a") as db:
         writer = csv.DictWriter(db, header, delimiter='$')
-        # Add rows determined
         try:
-            to_add = []
-            for entry in data:
-                assert isinstance(entry, dict)
-                lkey = entry['longkey']
-                if lkey not in existing_keys:
-                    to_add.append(entry)
-                    existing_keys.add(lkey)
-            writer.writerows(to_add)
+            writer.writerows(data)
+            written = True
         except csv.Error:
-            pass
+            written = False
+
+    # Only save the keys if their rows were written.  Otherwise, the index is rebuilt from the CSV file when next used.
+    if isinstance(existing_keys, CSVKeyIndex):
+        if written:
+            existing_keys.sync()
+        else:
+            existing_keys.discard()
+    if own_index:
+        existing_keys.close()
     return existing_keys
 
 
 def create_csv_from_directory(root_dir, outname, return_rauxinfo=False, return_longkey=False, return_shortkey=False,
-                              return_webkey=False):
+                              return_webkey=False, jobs=1):
     """
     Iterate recursively over all rdf files in the given folder and combine them into a single .csv database.
 
@@ -304,6 +499,7 @@ def create_csv_from_directory(root_dir, outname, return_rauxinfo=False, return_l
         return_longkey: Include Long key in the result
         return_shortkey: Include the Short key in the result
         return_webkey: Include the Web key in the result
+        jobs: The number of worker processes to convert each RD file in
 
     Raises:
         IndexError: File failed to be recognised for importing
@@ -312,23 +508,24 @@ def create_csv_from_directory(root_dir, outname, return_rauxinfo=False, return_l
     # Flag for whether the database should be created or appended
     database_has_started = False
     db_path = ''
-    existing_keys = None
+    # The Long-RInChIKeys written so far, shared between files so the CSV file is never re-read
+    existing_keys = set()
     # Iterate over all files in the root directory
     for root, folders, filenames in os.walk(root_dir):
         file_number = len(filenames)
         for number, filename in enumerate(filenames):
             print('processing {} of {}'.format((number + 1), file_number))
             filepath = os.path.join(root, filename)
-            data = open(filepath).read()
             try:
                 # Only try to process files with an .rdf extension
                 if os.path.splitext(filename)[1] == ".rdf":
-                    if database_has_started:
-                        existing_keys = rdf_to_csv_append(data, db_path, existing_keys)
-                    else:
-                        db_path = rdf_to_csv(data, outname, return_rauxinfo, return_longkey, return_shortkey,
-                                             return_webkey)
-                        database_has_started = True
+                    with rdf_reader.RDFReader(filepath) as data:
+                        if database_has_started:
+                            existing_keys = rdf_to_csv_append(data, db_path, existing_keys, jobs)
+                        else:
+                            db_path = rdf_to_csv(data, outname, return_rauxinfo, return_longkey, return_shortkey,
+                                                 return_webkey, jobs, existing_keys)
+                            database_has_started = True
             except IndexError as e:
                 # Send the names of any files that failed to be recognised to STDOUT
                 print(e, ("Failed to recognise {}".format(filename)))
@@ -12,31 +12,241 @@ Modifications:
 
     Python 3 restructuring and new function addition. Significantly modularised the exisiting code
 """
+import base64
 import csv
+import functools
+import hashlib
+import json
 import logging
 import os
 import pickle
 import queue
+import shutil
 import sqlite3
+import struct
 import sys
+import tempfile
 import threading
 import time
-from heapq import nsmallest
+from collections import Counter
+from contextlib import contextmanager
 
-from scipy.spatial import distance
+from numpy import asarray, clip, flatnonzero, frombuffer, zeros
 
-from . import _external, conversion, v02_tools
-from .reaction import Reaction
+from . import _external, conversion, fingerprints, matcher, rdf_reader, tools, utils, v02_tools
+from .molecule import Molecule
+from .reaction import Reaction, calculate_reaction_fingerprints
 from .rinchi_lib import RInChI
 
+logger = logging.getLogger(__name__)
+
 
 ###########
 # SQL tools
 ###########
 
+
+class RInChIDatabase:
+    """
+    A session on an SQLite RInChI database, which may be passed to the functions of this module in place of a
+    database file name.
+
+    The session holds a pool of open connections, so repeated lookups do not pay for connecting each time.  Each
+    connection keeps SQLite's cache of prepared statements, and the columns of each table are looked up once with
+    ``PRAGMA table_info`` and then cached.
+    """
+
+    def __init__(self, db_filename, pool_size=_external.DB_POOL_SIZE,
+                 cached_statements=_external.DB_STATEMENT_CACHE_SIZE):
+        """
+        Args:
+            db_filename: The file name of the SQLite database
+            pool_size: The maximum number of connections to hold open at once
+            cached_statements: The number of prepared statements cached by each connection
+        """
+        self.db_filename = db_filename
+        self.pool_size = max(1, int(pool_size))
+        self.cached_statements = cached_statements
+        self._pool = queue.LifoQueue()
+        self._open = 0
+        self._lock = threading.Lock()
+        self._columns = {}
+        self._pid = os.getpid()
+
+    def __repr__(self):
+        return "<RInChIDatabase {} connections:{}>".format(self.db_filename, self._open)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self):
+        """
+        Opens a new connection to the database
+        """
+        db = sqlite3.connect(self.db_filename, check_same_thread=False, cached_statements=self.cached_statements)
+
+        # Rows replaced on a unique constraint must fire delete triggers, to keep the text index in step
+        db.execute('PRAGMA recursive_triggers = ON')
+        return db
+
+    def _acquire(self):
+        """
+        Takes a connection from the pool, opening one if fewer than ``pool_size`` are open, or else waiting for one to
+        be released.
+        """
+        with self._lock:
+            # Connections cannot be shared with a forked process, which starts its own pool
+            if self._pid != os.getpid():
+                self._pool = queue.LifoQueue()
+                self._open = 0
+                self._pid = os.getpid()
+            try:
+                return self._pool.get_nowait()
+            except queue.Empty:
+                if self._open < self.pool_size:
+                    self._open += 1
+                    return self._connect()
+        return self._pool.get()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool.  Any open transaction is committed when the connection is returned, or
+        rolled back if an exception was raised.
+
+        Returns:
+            A context manager yielding an ``sqlite3.Connection``
+        """
+        db = self._acquire()
+        try:
+            yield db
+            if db.in_transaction:
+                db.commit()
+        except BaseException:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        finally:
+            self._pool.put(db)
+
+    def columns(self, table_name):
+        """
+        Gets the column names of a table, caching them for the life of the session.
+
+        Args:
+            table_name: The name of the table
+
+        Returns:
+            A list of column names in order, which is empty if the table does not exist
+        """
+        try:
+            return self._columns[table_name]
+        except KeyError:
+            with self.connection() as db:
+                columns = _get_sql_columns(db.cursor(), table_name)
+            if columns:
+                self._columns[table_name] = columns
+            return columns
+
+    def table_exists(self, table_name):
+        """
+        Args:
+            table_name: The table name to check for
+
+        Returns:
+            True if present, False if Not.
+        """
+        return bool(self.columns(table_name))
+
+    def invalidate(self, table_name=None):
+        """
+        Discards cached column names, e.g. after a table has been altered or dropped.
+
+        Args:
+            table_name: The table whose columns to discard.  If None, the whole cache is discarded.
+        """
+        if table_name is None:
+            self._columns.clear()
+        else:
+            self._columns.pop(table_name, None)
+
+    def close(self):
+        """
+        Closes the pooled connections not currently borrowed
+        """
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+            self._open -= 1
+
+
+@contextmanager
+def _connect(db):
+    """
+    Gets a connection to a database given as a session or a file name.
+
+    Args:
+        db: A ``RInChIDatabase`` session, whose pool a connection is borrowed from, or the file name of a database,
+            to which a new connection is opened and then closed.
+
+    Returns:
+        A context manager yielding an ``sqlite3.Connection``
+    """
+    if isinstance(db, RInChIDatabase):
+        with db.connection() as connection:
+            yield connection
+    else:
+        session = RInChIDatabase(db, pool_size=1)
+        try:
+            with session.connection() as connection:
+                yield connection
+        finally:
+            session.close()
+
+
+def _database_path(db):
+    """
+    Args:
+        db: A ``RInChIDatabase`` session or the file name of a database
+
+    Returns:
+        The file name of the database
+    """
+    return db.db_filename if isinstance(db, RInChIDatabase) else db
+
+
+def _table_columns(db, cursor, table_name):
+    """
+    Gets the column names of a table from the session's cache if there is one.
+
+    Args:
+        db: A ``RInChIDatabase`` session or the file name of a database
+        cursor: A cursor on the database
+        table_name: The name of the table
+
+    Returns:
+        A list of column names in order
+    """
+    if isinstance(db, RInChIDatabase):
+        return db.columns(table_name)
+    return _get_sql_columns(cursor, table_name)
+
+
 # Regularly used command wrappers. Not for external use
 #################################
 
+def _quote(name):
+    """
+    Quotes an SQL identifier, so that table names such as "rinchis1-00" may be used in statements
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
 def _pragma_sql_env(cursor):
     """
     Sets various environmental variables and state flags within the SQLite environment.
@@ -65,23 +275,23 @@ def _create_sql_table(cursor, table_name, columns, unique=None):
     if unique is not None:
         ut = ", UNIQUE({}) ON CONFLICT REPLACE".format(unique)
 
-    column_string = " TEXT, ".join(columns)
-    cursor.execute('CREATE TABLE IF NOT EXISTS {} ({}){}'.format(table_name, column_string, ut))
+    column_string = " TEXT, ".join(columns) + " TEXT"
+    cursor.execute('CREATE TABLE IF NOT EXISTS {} ({}{})'.format(_quote(table_name), column_string, ut))
 
 
 def _get_sql_columns(cursor, table_name):
     """
-    Get list of column names quickly
+    Get list of column names quickly from the table's schema, without querying its rows
 
     Args:
         cursor: The SQLite database cursor object
         table_name: The name of the table
 
     Returns:
-        A list of column names in order
+        A list of column names in order, which is empty if the table does not exist
     """
-    cursor.execute('select * from {}'.format(table_name))
-    names = [description[0] for description in cursor.description]
+    cursor.execute('PRAGMA table_info({})'.format(_quote(table_name)))
+    names = [row[1] for row in cursor.fetchall()]
     return names
 
 
@@ -100,7 +310,8 @@ def _sql_insert(cursor, table_name, data, columns=None, exec_many=False):
         columns = _get_sql_columns(cursor, table_name)
 
     command = (
-        "INSERT INTO {}({}) VALUES (".format(table_name, ", ".join(columns)) + ", ".join(["?"] * len(columns)) + ")")
+        "INSERT INTO {}({}) VALUES (".format(_quote(table_name), ", ".join(columns)) + ", ".join(["?"] * len(columns)) +
+        ")")
 
     if exec_many:
         cursor.executemany(command, data)
@@ -136,7 +347,7 @@ def _drop_table_if_needed(table_name, cursor):
     if _check_table_exists(table_name, cursor):
         approved = input("Table {} will be deleted and recreated. Continue? (type 'yes') :".format(table_name))
         if approved == "yes":
-            cursor.execute('drop table if exists {}'.format(table_name))
+            cursor.execute('drop table if exists {}'.format(_quote(table_name)))
             logging.info("dropping table")
         else:
             logging.info("exiting operation")
@@ -176,103 +387,858 @@ def _sql_search(cursor, table_name, columns=None, lookup_value=None, field=None,
     else:
         limiter = ""
 
-    # formulate the query
-    part1 = 'SELECT {} FROM {}'.format(' ,'.join(columns), table_name)
-    part2 = ' WHERE {} {} ?'.format(field, comparator)
-    if lookup_value is None:
-        command = part1 + limiter
-    else:
-        command = part1 + part2 + limiter
+    # formulate the query
+    part1 = 'SELECT {} FROM {}'.format(' ,'.join(columns), _quote(table_name))
+    part2 = ' WHERE {} {} ?'.format(field, comparator)
+    if lookup_value is None:
+        command = part1 + limiter
+    else:
+        command = part1 + part2 + limiter
+
+    if lookup_value is not None:
+        cursor.execute(command, (lookup_value,))
+    else:
+        cursor.execute(command)
+    return cursor
+
+
+# The table of the search databases built from flat files, and the extension of their file names
+FLAT_FILE_TABLE = "rinchis"
+SEARCH_DB_EXTENSION = ".searchdb"
+
+
+def _search_db_paths(path):
+    """
+    Args:
+        path: The path of a flat file
+
+    Returns:
+        The paths at which the search database of the flat file may be cached, in order of preference
+    """
+    path = os.path.abspath(path)
+    name = "{}-{}{}".format(os.path.basename(path), hashlib.sha1(path.encode()).hexdigest()[:16], SEARCH_DB_EXTENSION)
+    if _external.SEARCH_CACHE_DIR is not None:
+        return [os.path.join(_external.SEARCH_CACHE_DIR, name)]
+    return [path + SEARCH_DB_EXTENSION, os.path.join(tempfile.gettempdir(), name)]
+
+
+def _search_db_is_current(search_db, source):
+    """
+    Checks whether a cached search database was built from the current version of a flat file.
+
+    Args:
+        search_db: The path of the search database
+        source: A tuple of the absolute path, size and modification time in nanoseconds of the flat file
+
+    Returns:
+        True if the search database can be used, otherwise False
+    """
+    if not os.path.exists(search_db):
+        return False
+    try:
+        db = sqlite3.connect(search_db)
+        try:
+            return db.execute('SELECT path, size, mtime FROM source').fetchone() == source
+        finally:
+            db.close()
+    except sqlite3.DatabaseError:
+        return False
+
+
+def _flat_file_to_search_db(path, delim="$"):
+    """
+    Gets an SQLite database for searching or analysis of a flat file.  The database is built once, with the text and
+    component indexes used by searches, and cached in a file alongside the flat file.  It is reused until the flat
+    file's size or modification time changes.
+
+    Args:
+        path: The path of the file with which to populate the table
+        delim: The delimiter of the flat file.  Only the first field of each line is used.
+
+    Returns:
+        The path of the database, in which the flat file is held in the table ``FLAT_FILE_TABLE``
+    """
+    stat = os.stat(path)
+    source = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    candidates = _search_db_paths(path)
+    for search_db in candidates:
+        if _search_db_is_current(search_db, source):
+            return search_db
+
+    def read_flat_file_lines(path, delim):
+        with open(path, 'r') as f:
+            for line in f:
+                yield (line.split(delim, 1)[0].rstrip('\n'),)
+
+    # Build under a temporary name and then move into place, so that no search sees a partly built database
+    for search_db in candidates:
+        building = "{}.{}.tmp".format(search_db, os.getpid())
+        try:
+            db = sqlite3.connect(building)
+        except sqlite3.OperationalError:
+            continue
+        try:
+            logging.info("Building search database {}".format(search_db))
+            cursor = db.cursor()
+            _create_sql_table(cursor, FLAT_FILE_TABLE, ['rinchi'])
+            _sql_insert(cursor, FLAT_FILE_TABLE, read_flat_file_lines(path, delim), ['rinchi'], True)
+            db.commit()
+            db.close()
+            create_text_index(building, FLAT_FILE_TABLE)
+            create_component_index(building, FLAT_FILE_TABLE)
+            db = sqlite3.connect(building)
+            db.execute('CREATE TABLE source (path TEXT, size INTEGER, mtime INTEGER)')
+            db.execute('INSERT INTO source VALUES (?, ?, ?)', source)
+            db.commit()
+            db.close()
+            os.replace(building, search_db)
+            return search_db
+        except BaseException:
+            db.close()
+            if os.path.exists(building):
+                os.remove(building)
+            raise
+    raise IOError("Cannot create a search database for {} in any of {}".format(path, ", ".join(candidates)))
+
+
+def _keyset_pages(cursor, command, args=(), key='t.rowid', tail='', limit=None, after=0, page_size=None):
+    """
+    Runs a query page by page, each page starting after the last rowid of the one before, so that rows are streamed
+    without being held in memory at once, and a search can be resumed from any row.
+
+    Args:
+        cursor: The SQLite database cursor object
+        command: The query, ending in its WHERE clause, whose first column is the rowid the pages are keyed on
+        args: The arguments of the query
+        key: The expression of the rowid in the query
+        tail: Any clauses to follow the WHERE clause, such as GROUP BY
+        limit: The maximum number of rows to return.  0 or None means no limit.
+        after: The rowid after which to start
+        page_size: The number of rows fetched in each page.  Defaults to ``_external.SEARCH_PAGE_SIZE``
+
+    Returns:
+        A generator yielding the rows of the query, in rowid order
+    """
+    page_size = page_size or _external.SEARCH_PAGE_SIZE
+    command = '{} AND {} > ?{} ORDER BY {} LIMIT ?'.format(command, key, tail, key)
+    remaining = limit or None
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        cursor.execute(command, tuple(args) + (after, size))
+        rows = cursor.fetchmany(size)
+        yield from rows
+        if len(rows) < size:
+            return
+        after = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def _string_finder(string, cursor, table_name, limit, field='rinchi', condition=None, after=0, page_size=None):
+    """
+    Search for a string in a database field.  The trigram text index of the table is used if there is one, and the
+    string is long enough to be looked up in it.  Otherwise, the whole table is scanned.  Rows are streamed in pages,
+    see ``_keyset_pages``.
+
+    Args:
+        string:
+        cursor:
+        table_name:
+        limit:
+        field:
+        condition: An optional tuple of further SQL condition on the rows of the table, aliased as "t", and its
+            arguments, such as from ``_change_condition``
+        after: The rowid after which to start
+        page_size: The number of rows fetched at a time
+
+    Returns:
+        A generator object of tuples of the rowid and rinchi of each row found
+    """
+    extra, extra_args = condition or ('', ())
+    if extra:
+        extra = ' AND ' + extra
+
+    # Remove header part of inchi
+    if string.startswith("InChI="):
+        string = string.split("/", 1)[1]
+    query = "%" + string + "%"
+    if _can_use_text_index(cursor, table_name, field, string):
+        # Candidates from the index are checked against the table, so that stale index entries cannot match
+        command = 'SELECT f.rowid, t.rinchi FROM {} AS f JOIN {} AS t ON t.rowid = f.rowid WHERE f.{} MATCH ? AND ' \
+                  't.{} LIKE ?{}'.format(_quote(_text_index_name(table_name)), _quote(table_name), field, field, extra)
+        args = ('"{}"'.format(string.replace('"', '""')), query) + tuple(extra_args)
+        return _keyset_pages(cursor, command, args, 'f.rowid', limit=limit, after=after, page_size=page_size)
+    command = 'SELECT t.rowid, t.rinchi FROM {} AS t WHERE t.{} LIKE ?{}'.format(_quote(table_name), field, extra)
+    return _keyset_pages(cursor, command, (query,) + tuple(extra_args), limit=limit, after=after, page_size=page_size)
+
+
+def _encode_token(signature, rowid):
+    """
+    Encodes the position reached by a search as a cursor token, from which the search can be resumed.
+
+    Args:
+        signature: A string identifying the search, from ``_search_signature``
+        rowid: The rowid of the last row returned
+
+    Returns:
+        The token as a URL safe string
+    """
+    return base64.urlsafe_b64encode(json.dumps([signature, rowid]).encode()).decode()
+
+
+def _decode_token(signature, token):
+    """
+    Decodes a cursor token from ``_encode_token``.
+
+    Args:
+        signature: A string identifying the search being resumed, from ``_search_signature``
+        token: The token, or None to start at the beginning
+
+    Returns:
+        The rowid after which to resume
+
+    Raises:
+        ValueError: The token is malformed or belongs to a different search
+    """
+    if token is None:
+        return 0
+    try:
+        token_signature, rowid = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (ValueError, TypeError):
+        raise ValueError("Malformed cursor token {}".format(token))
+    if token_signature != signature:
+        raise ValueError("The cursor token belongs to a different search")
+    return int(rowid)
+
+
+def _search_signature(db, *query):
+    """
+    Args:
+        db: The file name of the database or flat file searched, or a ``RInChIDatabase`` session
+        *query: The arguments of the search
+
+    Returns:
+        A short string identifying the search, for checking that a cursor token is resumed by the same search
+    """
+    key = repr((os.path.abspath(_database_path(db)),) + query)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+# Index management
+##################
+
+def _index_name(table_name, column):
+    """
+    Returns:
+        The name of the index on a column created by ``create_indexes``
+    """
+    return "idx_{}_{}".format(table_name, column)
+
+
+def _get_sql_indexes(cursor, table_name):
+    """
+    Gets the indexes of a table by the column each one leads with, including those SQLite creates automatically for
+    unique constraints.
+
+    Args:
+        cursor: The SQLite database cursor object
+        table_name: The name of the table
+
+    Returns:
+        A dict of column names and the list of names of the indexes that can be used to look up each column
+    """
+    indexes = {}
+    for index in cursor.execute('PRAGMA index_list({})'.format(_quote(table_name))).fetchall():
+        info = cursor.execute('PRAGMA index_info({})'.format(_quote(index[1]))).fetchall()
+        leading = [row[2] for row in info if row[0] == 0]
+        if leading:
+            indexes.setdefault(leading[0], []).append(index[1])
+    return indexes
+
+
+def list_indexes(db, table_name):
+    """
+    Lists the indexes of a table.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+
+    Returns:
+        A dict of column names and the list of names of the indexes that can be used to look up each column
+    """
+    with _connect(db) as connection:
+        return _get_sql_indexes(connection.cursor(), table_name)
+
+
+def create_indexes(db, table_name, columns=None):
+    """
+    Indexes the key columns of a table, so that they can be looked up without scanning the table.  Columns which are
+    already indexed, or which are not in the table, are skipped.
+
+    Indexes are best created after a table has been bulk loaded, since building an index once is faster than updating
+    it for every row inserted.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+        columns: The columns to index.  Defaults to ``_external.DB_INDEXED_COLUMNS``
+
+    Returns:
+        A list of the names of the indexes created
+    """
+    if columns is None:
+        columns = _external.DB_INDEXED_COLUMNS
+    created = []
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        table_columns = _get_sql_columns(cursor, table_name)
+        indexed = _get_sql_indexes(cursor, table_name)
+        for column in columns:
+            if column in table_columns and column not in indexed:
+                name = _index_name(table_name, column)
+                logging.info("Creating index {}".format(name))
+                cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {}({})'.format(
+                    _quote(name), _quote(table_name), _quote(column)))
+                created.append(name)
+        if created:
+            cursor.execute('ANALYZE {}'.format(_quote(table_name)))
+    return created
+
+
+def drop_indexes(db, table_name, columns=None):
+    """
+    Drops the indexes created by ``create_indexes``, e.g. before a large load into an existing table.  Indexes
+    belonging to unique constraints are kept.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+        columns: The columns whose indexes to drop.  Defaults to ``_external.DB_INDEXED_COLUMNS``
+
+    Returns:
+        A list of the names of the indexes dropped
+    """
+    if columns is None:
+        columns = _external.DB_INDEXED_COLUMNS
+    dropped = []
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        indexed = _get_sql_indexes(cursor, table_name)
+        for column in columns:
+            name = _index_name(table_name, column)
+            if name in indexed.get(column, ()):
+                cursor.execute('DROP INDEX {}'.format(_quote(name)))
+                dropped.append(name)
+    return dropped
+
+
+def _text_index_name(table_name):
+    """
+    Returns:
+        The name of the full text index of a table created by ``create_text_index``
+    """
+    return "{}_fts".format(table_name)
+
+
+def _get_text_index_column(cursor, table_name):
+    """
+    Args:
+        cursor: The SQLite database cursor object
+        table_name: The name of the table
+
+    Returns:
+        The column covered by the table's text index, or None if it has none
+    """
+    columns = _get_sql_columns(cursor, _text_index_name(table_name))
+    return columns[0] if columns else None
+
+
+def _can_use_text_index(cursor, table_name, field, string):
+    """
+    Checks whether a substring search can be answered by the text index of a table.  The trigram index needs at least
+    three characters, and cannot match the wildcards of LIKE patterns.
+
+    Args:
+        cursor: The SQLite database cursor object
+        table_name: The table to be searched
+        field: The column to be searched
+        string: The substring to search for
+
+    Returns:
+        True if the text index can be used, otherwise False
+    """
+    if len(string) < 3 or '%' in string or '_' in string:
+        return False
+    return _get_text_index_column(cursor, table_name) == field
+
+
+def create_text_index(db, table_name, column="rinchi"):
+    """
+    Creates a full text index of a column of a table, so that substrings of it, such as InChIs or InChI layers within
+    RInChIs, can be searched for without scanning the table.  The index is an SQLite FTS5 table, tokenized into
+    trigrams, which refers to the rows of the table rather than copying them.  Triggers keep it up to date as rows are
+    inserted, updated or deleted.  An existing index is rebuilt.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+        column: The column to index
+
+    Returns:
+        True if the index was built, or False if the SQLite library lacks the FTS5 trigram tokenizer, in which case
+        searches continue to scan the table.
+    """
+    fts = _text_index_name(table_name)
+    drop_text_index(db, table_name)
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE {} USING fts5({}, content={}, content_rowid='rowid', "
+                           "tokenize='trigram')".format(_quote(fts), _quote(column),
+                                                        "'{}'".format(table_name.replace("'", "''"))))
+        except sqlite3.OperationalError as e:
+            logging.warning("Cannot create a text index of {}: {}".format(table_name, e))
+            return False
+
+        values = dict(fts=_quote(fts), table=_quote(table_name), column=_quote(column))
+        triggers = (
+            ('ai', 'AFTER INSERT', "INSERT INTO {fts}(rowid, {column}) VALUES (new.rowid, new.{column});"),
+            ('ad', 'AFTER DELETE', "INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.rowid, "
+                                   "old.{column});"),
+            ('au', 'AFTER UPDATE OF {column}', "INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', "
+                                               "old.rowid, old.{column}); INSERT INTO {fts}(rowid, {column}) VALUES "
+                                               "(new.rowid, new.{column});"))
+        for suffix, event, body in triggers:
+            cursor.execute('CREATE TRIGGER {} {} ON {} BEGIN {} END'.format(
+                _quote("{}_{}".format(fts, suffix)), event.format(**values), _quote(table_name),
+                body.format(**values)))
+
+        logging.info("Building text index {}".format(fts))
+        cursor.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(_quote(fts)))
+    if isinstance(db, RInChIDatabase):
+        db.invalidate(fts)
+    return True
+
+
+def drop_text_index(db, table_name):
+    """
+    Drops the full text index of a table created by ``create_text_index``, and the triggers maintaining it.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+
+    Returns:
+        True if an index was dropped, otherwise False
+    """
+    fts = _text_index_name(table_name)
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        for suffix in ('ai', 'ad', 'au'):
+            cursor.execute('DROP TRIGGER IF EXISTS {}'.format(_quote("{}_{}".format(fts, suffix))))
+        exists = _check_table_exists(fts, cursor)
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(_quote(fts)))
+    if isinstance(db, RInChIDatabase):
+        db.invalidate(fts)
+    return exists
+
+
+# The roles of components in reactions, stored in the component index by their position
+_ROLES = ("reactant", "product", "agent")
+
+
+def _component_index_names(table_name):
+    """
+    Returns:
+        The names of the component dictionary, reaction to component link and state tables of a table's component
+        index, as created by ``create_component_index``
+    """
+    return ("{}_components".format(table_name), "{}_roles".format(table_name),
+            "{}_components_state".format(table_name))
+
+
+def _update_components(cursor, table_name):
+    """
+    Adds the components of the reactions inserted into a table since its component index was last updated.  Does
+    nothing if the table has no component index.
+
+    Args:
+        cursor: The SQLite database cursor object
+        table_name: The name of the table
+
+    Returns:
+        The number of reactions added to the index
+    """
+    components, roles, state = (_quote(name) for name in _component_index_names(table_name))
+    if not _check_table_exists(_component_index_names(table_name)[2], cursor):
+        return 0
+    last = cursor.execute('SELECT last_rowid FROM {}'.format(state)).fetchone()[0]
+
+    # Read the new rows on a separate cursor, as the index is written on this one
+    reader = cursor.connection.execute('SELECT rowid, rinchi FROM {} WHERE rowid > ? ORDER BY rowid'.format(
+        _quote(table_name)), (last,))
+    component_ids = {}
+    count = 0
+    while True:
+        batch = reader.fetchmany(10000)
+        if not batch:
+            break
+        links = []
+        for rowid, rinchi in batch:
+            last = rowid
+            try:
+                split = tools.split_rinchi(rinchi, validate=False)
+            except (ValueError, IndexError, AttributeError):
+                logging.info("Cannot index the components of {}".format(rinchi))
+                continue
+            count += 1
+            for role, inchis in enumerate(split[:3]):
+                for inchi in inchis:
+                    component_id = component_ids.get(inchi)
+                    if component_id is None:
+                        row = cursor.execute('SELECT id FROM {} WHERE inchi = ?'.format(components),
+                                             (inchi,)).fetchone()
+                        if row is None:
+                            cursor.execute('INSERT INTO {}(inchi) VALUES (?)'.format(components), (inchi,))
+                            component_id = cursor.lastrowid
+                        else:
+                            component_id = row[0]
+                        component_ids[inchi] = component_id
+                    links.append((rowid, component_id, role))
+        cursor.executemany('INSERT OR IGNORE INTO {} VALUES (?, ?, ?)'.format(roles), links)
+    cursor.execute('UPDATE {} SET last_rowid = ?'.format(state), (last,))
+    return count
+
+
+def create_component_index(db, table_name):
+    """
+    Decomposes the reactions of a table into their component InChIs, held once each in a dictionary table, and links
+    each reaction to its components by role.  Searches for reactions in which an InChI is a reactant, product or agent
+    then become indexed joins, without parsing any RInChIs.  An existing component index is rebuilt.
+
+    The index is kept up to date by ``rdf_to_sql``, ``csv_to_sql`` and directory ingestion, and links to deleted
+    reactions are removed by a trigger.  Rows inserted by other means are added by ``update_component_index``.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+
+    Returns:
+        The number of reactions indexed
+    """
+    drop_component_index(db, table_name)
+    components, roles, state = _component_index_names(table_name)
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        cursor.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY, inchi TEXT UNIQUE)'.format(_quote(components)))
+        cursor.execute('CREATE TABLE {} (reaction_id INTEGER, component_id INTEGER, role INTEGER, PRIMARY KEY '
+                       '(component_id, role, reaction_id)) WITHOUT ROWID'.format(_quote(roles)))
+        cursor.execute('CREATE INDEX {} ON {}(reaction_id)'.format(_quote(_index_name(roles, "reaction_id")),
+                                                                    _quote(roles)))
+        cursor.execute('CREATE TABLE {} (last_rowid INTEGER)'.format(_quote(state)))
+        cursor.execute('INSERT INTO {} VALUES (0)'.format(_quote(state)))
+        cursor.execute('CREATE TRIGGER {} AFTER DELETE ON {} BEGIN DELETE FROM {} WHERE reaction_id = old.rowid; '
+                       'END'.format(_quote("{}_ad".format(roles)), _quote(table_name), _quote(roles)))
+        logging.info("Building component index of {}".format(table_name))
+        count = _update_components(cursor, table_name)
+    if isinstance(db, RInChIDatabase):
+        for name in (components, roles, state):
+            db.invalidate(name)
+    return count
+
+
+def update_component_index(db, table_name):
+    """
+    Adds the reactions inserted into a table since its component index was last updated.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+
+    Returns:
+        The number of reactions added, which is 0 if the table has no component index
+    """
+    with _connect(db) as connection:
+        return _update_components(connection.cursor(), table_name)
+
+
+def drop_component_index(db, table_name):
+    """
+    Drops the component index of a table created by ``create_component_index``.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+
+    Returns:
+        True if an index was dropped, otherwise False
+    """
+    names = _component_index_names(table_name)
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        exists = _check_table_exists(names[2], cursor)
+        cursor.execute('DROP TRIGGER IF EXISTS {}'.format(_quote("{}_ad".format(names[1]))))
+        for name in names:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(_quote(name)))
+    if isinstance(db, RInChIDatabase):
+        for name in names:
+            db.invalidate(name)
+    return exists
+
+
+def _component_finder(search_term, cursor, table_name, limit, condition=None, after=0, page_size=None):
+    """
+    Finds the reactions of a table with a component InChI containing the search term, using its component index.
+    Reactions are streamed in pages, see ``_keyset_pages``.
 
-    if lookup_value is not None:
-        cursor.execute(command, (lookup_value,))
+    Args:
+        search_term: The InChI, or part of an InChI, to search for
+        cursor: The SQLite database cursor object
+        table_name: The name of the table, which must have a component index
+        limit: The maximum number of reactions to return.  0 or None means no limit.
+        condition: An optional tuple of further SQL condition on the rows of the table, aliased as "t", and its
+            arguments, such as from ``_change_condition``
+        after: The rowid after which to start
+        page_size: The number of reactions fetched at a time
+
+    Returns:
+        A generator of tuples of the rowid of each reaction found, its RInChI and the set of roles, of "reactant",
+        "product" and "agent", in which it has a matching component
+    """
+    components, roles, _ = (_quote(name) for name in _component_index_names(table_name))
+    if search_term.startswith("InChI="):
+        # Only InChIs starting with a complete InChI can contain it, so the dictionary's index is searched by prefix
+        match = 'c.inchi >= ? AND c.inchi < ?'
+        args = (search_term, search_term + '\uffff')
     else:
-        cursor.execute(command)
-    return cursor
+        match = 'instr(c.inchi, ?) > 0'
+        args = (search_term,)
+    command = 'SELECT l.reaction_id, t.rinchi, group_concat(DISTINCT l.role) FROM {} AS c JOIN {} AS l ON ' \
+              'l.component_id = c.id JOIN {} AS t ON t.rowid = l.reaction_id WHERE {}'.format(
+                  components, roles, _quote(table_name), match)
+    if condition:
+        command += ' AND {}'.format(condition[0])
+        args += tuple(condition[1])
+    rows = _keyset_pages(cursor, command, args, 'l.reaction_id', ' GROUP BY l.reaction_id', limit, after, page_size)
+    return ((rowid, rinchi, {_ROLES[int(role)] for role in found.split(',')}) for rowid, rinchi, found in rows)
+
+
+def _change_index_names(table_name):
+    """
+    Returns:
+        The names of the change table and state table of a table's change index, as created by
+        ``create_change_index``
+    """
+    return "{}_changes".format(table_name), "{}_changes_state".format(table_name)
 
 
-def _transfer_table(db_source, db_destination, table_name, drop_source=True):
+def _batch_changes(rows):
     """
-    Transfers a table from one database to another.  Optionally drops the source database
+    Calculates the change descriptors of a batch of reactions.  Used as the task run by worker processes.
 
     Args:
-        db_source: The name of the database to source the table
-        db_destination: The name of the destination database
-        table_name: The name of the table to transfer
-        drop_source: Whether to drop the source database.  Defaults to True
+        rows: A list of (rowid, RInChI) tuples
+
+    Returns:
+        A tuple of the last rowid of the batch, the number of reactions whose changes were calculated, and a list of
+        (rowid, kind, key, delta) tuples of the non-zero changes across each reaction
     """
-    logging.info("transferring {} from {} to {}...".format(table_name, db_source, db_destination))
+    changes = []
+    count = 0
+    for rowid, rinchi in rows:
+        try:
+            descriptors = Reaction(rinchi, validate=False).change_descriptors()
+        except (ValueError, IndexError, KeyError):
+            logging.info("Cannot calculate the changes across {}".format(rinchi))
+            continue
+        count += 1
+        for kind, counter in descriptors.items():
+            changes.extend((rowid, kind, str(key), delta) for key, delta in counter.items())
+    return rows[-1][0], count, changes
+
 
-    # Create connection and attach database
-    db = sqlite3.connect(db_destination)
-    cursor = db.cursor()
-    cursor.execute("ATTACH DATABASE ? AS db2", (db_source,))
+def _update_changes(cursor, table_name, jobs=1):
+    """
+    Adds the changes across the reactions inserted into a table since its change index was last updated.  Does nothing
+    if the table has no change index.
 
-    # Execute SQL create command for the source table on the new table
-    cursor.execute("SELECT sql FROM db2.sqlite_master WHERE type='table' AND name=?", (table_name,))
-    cursor.execute(cursor.fetchone()[0])
+    Args:
+        cursor: The SQLite database cursor object
+        table_name: The name of the table
+        jobs: The number of worker processes to calculate the changes in
 
-    # Insert values from source to destination
-    cursor.execute("INSERT INTO {0} SELECT * FROM db2.{0}".format(table_name))
-    db.commit()
-    db.close()
+    Returns:
+        The number of reactions added to the index
+    """
+    changes, state = _change_index_names(table_name)
+    if not _check_table_exists(state, cursor):
+        return 0
+    last = cursor.execute('SELECT last_rowid FROM {}'.format(_quote(state))).fetchone()[0]
+
+    # Read the new rows on a separate cursor, as the index is written on this one
+    reader = cursor.connection.execute('SELECT rowid, rinchi FROM {} WHERE rowid > ? ORDER BY rowid'.format(
+        _quote(table_name)), (last,))
+    batches = utils.chunked(reader, _external.CHANGE_INDEX_CHUNK_SIZE)
+    count = 0
+    for last, reactions, found in utils.ordered_parallel_map(_batch_changes, batches, jobs):
+        cursor.executemany('INSERT OR IGNORE INTO {} VALUES (?, ?, ?, ?)'.format(_quote(changes)), found)
+        count += reactions
+    cursor.execute('UPDATE {} SET last_rowid = ?'.format(_quote(state)), (last,))
+    return count
+
+
+def create_change_index(db, table_name, jobs=1):
+    """
+    Calculates the changes across the reactions of a table which ``search_rinchis`` can filter on, i.e. in
+    hybridisation, valence, rings, formula and ring elements, and whether they are isotopic, and stores them in a
+    "<table>_changes" table of (reaction_id, kind, key, delta) rows.  Filtered searches then become SQL conditions on
+    these rows, rather than rebuilding the molecules of every candidate reaction.  An existing change index is rebuilt.
 
-    # Drop the source table
-    if drop_source:
-        os.remove(db_source)
+    The index is kept up to date by ``rdf_to_sql``, ``csv_to_sql`` and directory ingestion, and the changes of deleted
+    reactions are removed by a trigger.  Rows inserted by other means are added by ``update_change_index``, and until
+    then are checked by parsing them, as without an index.
 
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+        jobs: The number of worker processes to calculate the changes in
 
-def _flat_file_to_search_db(path, delim="$"):
+    Returns:
+        The number of reactions indexed
+    """
+    drop_change_index(db, table_name)
+    changes, state = _change_index_names(table_name)
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        cursor.execute('CREATE TABLE {} (reaction_id INTEGER, kind TEXT, key TEXT, delta INTEGER, PRIMARY KEY '
+                       '(kind, key, delta, reaction_id)) WITHOUT ROWID'.format(_quote(changes)))
+        cursor.execute('CREATE INDEX {} ON {}(reaction_id)'.format(_quote(_index_name(changes, "reaction_id")),
+                                                                    _quote(changes)))
+        cursor.execute('CREATE TABLE {} (last_rowid INTEGER)'.format(_quote(state)))
+        cursor.execute('INSERT INTO {} VALUES (0)'.format(_quote(state)))
+        cursor.execute('CREATE TRIGGER {} AFTER DELETE ON {} BEGIN DELETE FROM {} WHERE reaction_id = old.rowid; '
+                       'END'.format(_quote("{}_ad".format(changes)), _quote(table_name), _quote(changes)))
+        logging.info("Building change index of {}".format(table_name))
+        count = _update_changes(cursor, table_name, jobs)
+    if isinstance(db, RInChIDatabase):
+        for name in (changes, state):
+            db.invalidate(name)
+    return count
+
+
+def update_change_index(db, table_name, jobs=1):
     """
-    Creates and populates a temporary SQLite database for searching or analysis
+    Adds the reactions inserted into a table since its change index was last updated.
 
     Args:
-        path: The path of the file with which to populate the table
-        delim: The delimiter of the flat file
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+        jobs: The number of worker processes to calculate the changes in
 
     Returns:
-        A cursor object pointing to the opened database.
-
+        The number of reactions added, which is 0 if the table has no change index
     """
-    search_db = sqlite3.connect("")  # Create temporary database
-    cursor = search_db.cursor()
-    _create_sql_table(cursor, "temp", ['rinchi'])
+    with _connect(db) as connection:
+        return _update_changes(connection.cursor(), table_name, jobs)
 
-    def read_flat_file_lines(path, delim):
-        with open(path, 'r') as f:
-            for line in f:
-                yield tuple(line.split(delim))
 
-    cursor.executemany("INSERT INTO temp VALUES (?)", read_flat_file_lines(path, delim))
-    return cursor
+def drop_change_index(db, table_name):
+    """
+    Drops the change index of a table created by ``create_change_index``.
 
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
 
-def _string_finder(string, cursor, table_name, limit, field='rinchi'):
+    Returns:
+        True if an index was dropped, otherwise False
+    """
+    names = _change_index_names(table_name)
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        exists = _check_table_exists(names[1], cursor)
+        cursor.execute('DROP TRIGGER IF EXISTS {}'.format(_quote("{}_ad".format(names[0]))))
+        for name in names:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(_quote(name)))
+    if isinstance(db, RInChIDatabase):
+        for name in names:
+            db.invalidate(name)
+    return exists
+
+
+def _change_condition(table_name, filters):
     """
-    Search for a string in a database field
+    Builds an SQL condition selecting the reactions of a table whose change index records all the given changes.
 
     Args:
-        string:
-        cursor:
-        table_name:
-        limit:
+        table_name: The name of the table, which must have a change index
+        filters: A dict of the kinds of change, as keys of ``Reaction.change_descriptors``, and dicts of the changes
+            sought of that kind, of the format {property:count,property2:count2,...}
 
     Returns:
-        A generator object of rinchis
+        A tuple of the SQL condition on the rows of the table, aliased as "t", and its arguments, or None if no
+        changes are sought
     """
+    changes = _quote(_change_index_names(table_name)[0])
+    selects = []
+    args = []
+    for kind, wanted in filters.items():
+        for key, delta in wanted.items():
+            selects.append('SELECT reaction_id FROM {} WHERE kind = ? AND key = ? AND delta = ?'.format(changes))
+            args.extend((kind, str(key), delta))
+    if not selects:
+        return None
+    return 't.rowid IN ({})'.format(' INTERSECT '.join(selects)), args
+
+
+def _update_reaction_indexes(cursor, table_name, jobs=1):
+    """
+    Brings the component and change indexes of a table, where present, up to date with the rows inserted into it.
+
+    Args:
+        cursor: The SQLite database cursor object
+        table_name: The name of the table
+        jobs: The number of worker processes to calculate changes in
+    """
+    _update_components(cursor, table_name)
+    _update_changes(cursor, table_name, jobs)
 
-    # Remove header part of inchi
-    if string.startswith("InChI="):
-        string = string.split("/", 1)[1]
-    query = "%" + string + "%"
-    cursor = _sql_search(cursor, table_name, ["rinchi"], query, field, True, limit)
 
-    return (i[0] for i in cursor.fetchall())
+def _report_scan(db, table_name, field, substring=False):
+    """
+    Logs a warning if a lookup will scan the whole of a table.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The table to be searched
+        field: The column to be searched
+        substring: Whether the lookup matches substrings, which only a text index can answer
+
+    Returns:
+        True if the lookup will scan the table, otherwise False
+    """
+    if substring:
+        with _connect(db) as connection:
+            if _get_text_index_column(connection.cursor(), table_name) == field:
+                return False
+        logging.warning("Column {0} of table {1} has no text index, so substring searches scan the whole table. "
+                        "Create one with create_text_index or 'rinchi_database.py --build-text-index {1}'".format(
+                            field, table_name))
+        return True
+    if field not in list_indexes(db, table_name):
+        logging.warning("Column {0} of table {1} is not indexed, so the lookup scans the whole table. Index it with "
+                        "create_indexes or 'rinchi_database.py --build-indexes {1}'".format(field, table_name))
+        return True
+    return False
 
 
 # Searching SQL databases
 #########################
 
+# The columns holding each type of RInChIKey
+_KEY_FIELDS = {"L": "longkey", "S": "shortkey", "W": "webkey"}
+
 
 def sql_key_to_rinchi(key, db_filename, table_name, keytype="L", column=None):
     """
@@ -280,7 +1246,7 @@ def sql_key_to_rinchi(key, db_filename, table_name, keytype="L", column=None):
 
     Args:
         key: The key to search for
-        db_filename: The database in which to search
+        db_filename: The database in which to search, as a file name or a ``RInChIDatabase`` session
         table_name: The table in which to search for the key
         keytype: The key type to seach for.  Defaults to the long key
         column: Optional column to look for the key in.
@@ -292,36 +1258,31 @@ def sql_key_to_rinchi(key, db_filename, table_name, keytype="L", column=None):
         the corresponding RInChI
     """
 
-    db = sqlite3.connect(db_filename)
-    cursor = db.cursor()
-
     if key.startswith(('Short-RInChIKey', 'Long-RInChIKey', 'Web-RInChIKey')):
         keytype = key[0]
 
-    if keytype == "L":
-        field = "longkey"
-    elif keytype == "S":
-        field = "shortkey"
-    elif keytype == "W":
-        field = "webkey"
+    if keytype in _KEY_FIELDS:
+        field = _KEY_FIELDS[keytype]
     elif column is not None:
         field = column
     else:
         raise ValueError('The keytype argument must be one of "L" , "S" or "W" or the column parameter must be given')
-    cursor = _sql_search(cursor, table_name, ["rinchi"], key, field)
-    rinchi = cursor.fetchone()[0]
-    db.close()
+    with _connect(db_filename) as db:
+        cursor = _sql_search(db.cursor(), table_name, ["rinchi"], key, field)
+        rinchi = cursor.fetchone()[0]
     return rinchi
 
 
 def search_rinchis(search_term, db=None, table_name=None, is_sql_db=False, hyb=None, val=None, rings=None, formula=None,
                    ringelements=None, isotopic=None, reactant=False, product=False, agent=False, number=1000):
     """
-    Search for an Inchi within a RInChi database. Includes all options
+    Search for an Inchi within a RInChi database. Includes all options.  If the table has a component index, the
+    roles of the InChI are looked up in it rather than by parsing each RInChI found, and if it has a change index, the
+    filters are applied by looking up the changes stored in it.
 
     Args:
-        db:
-        is_sql_db:
+        db: The file name of the database or flat file to search, or a ``RInChIDatabase`` session
+        is_sql_db: Whether db is an SQLite database rather than a flat file.  Implied if db is a session.
         number:
         search_term: The term to search for
         table_name: the table to search in
@@ -340,6 +1301,55 @@ def search_rinchis(search_term, db=None, table_name=None, is_sql_db=False, hyb=N
     Returns:
         A dictionary of lists where an inchi was found
     """
+    return _search_rinchis(search_term, db, table_name, is_sql_db, hyb, val, rings, formula, ringelements, isotopic,
+                           reactant, product, agent, number)[0]
+
+
+def search_rinchis_page(search_term, db=None, table_name=None, is_sql_db=False, token=None, page_size=None, **filters):
+    """
+    Search for an InChI within a RInChI database one page at a time, as ``search_rinchis``.  Each page examines the next
+    ``page_size`` RInChIs containing the search term, and returns those passing the filters, so a page may hold fewer
+    results.  The token returned resumes the search from the end of the page without repeating any of it.
+
+    Args:
+        search_term: The term to search for
+        db: The file name of the database or flat file to search, or a ``RInChIDatabase`` session
+        table_name: the table to search in
+        is_sql_db: Whether db is an SQLite database rather than a flat file.  Implied if db is a session.
+        token: The cursor token returned with the previous page, or None for the first page
+        page_size: The number of RInChIs examined in each page.  Defaults to ``_external.SEARCH_PAGE_SIZE``
+        **filters: The hyb, val, rings, formula, ringelements, isotopic, reactant, product and agent arguments of
+            ``search_rinchis``
+
+    Returns:
+        A tuple of the dictionary of lists where an inchi was found, and the cursor token of the next page, or None if
+        this is the last page
+
+    Raises:
+        ValueError: The token is malformed or belongs to a different search
+    """
+    page_size = page_size or _external.SEARCH_PAGE_SIZE
+    signature = _search_signature(db, table_name, search_term, sorted(filters.items()))
+    after = _decode_token(signature, token)
+    result_dict, last, count = _search_rinchis(search_term, db, table_name, is_sql_db, number=page_size, after=after,
+                                               page_size=page_size, **filters)
+    return result_dict, _encode_token(signature, last) if count == page_size else None
+
+
+def _search_rinchis(search_term, db=None, table_name=None, is_sql_db=False, hyb=None, val=None, rings=None,
+                    formula=None, ringelements=None, isotopic=None, reactant=False, product=False, agent=False,
+                    number=1000, after=0, page_size=None):
+    """
+    Implements ``search_rinchis`` and ``search_rinchis_page``.
+
+    Args:
+        after: The rowid after which to start
+        page_size: The number of candidate rows fetched at a time
+
+    Returns:
+        A tuple of the dictionary of lists where an inchi was found, the rowid of the last candidate examined, and the
+        number of candidates examined
+    """
     if hyb is None:
         hyb = {}
     if val is None:
@@ -355,58 +1365,90 @@ def search_rinchis(search_term, db=None, table_name=None, is_sql_db=False, hyb=N
     else:
         skip = False
 
-    if table_name is None:
+    if not table_name:
         table_name = "rinchis1-00"
     if not (reactant or product or agent):
         reactant = True
         product = True
         agent = True
 
-    if is_sql_db:
-        # Search existing db
-        db = sqlite3.connect(db)
-        cursor = db.cursor()
-        results = _string_finder(search_term, cursor, table_name, number)
-    else:
-        # Create a temporary db from a flat file
-        cursor = _flat_file_to_search_db(db)
-        results = _string_finder(search_term, cursor, table_name, number)
+    if not (is_sql_db or isinstance(db, RInChIDatabase)):
+        # Search the cached db built from the flat file
+        with RInChIDatabase(_flat_file_to_search_db(db), pool_size=1) as search_db:
+            return _search_rinchis(search_term, search_db, FLAT_FILE_TABLE, True, hyb, val, rings, formula,
+                                   ringelements, isotopic, reactant, product, agent, number, after, page_size)
 
     result_dict = {'as_reactant': [], 'as_product': [], 'as_agent': [], 'unknown': []}
-
-    # Linear
-    for rinchi in results:
-        r = Reaction(rinchi)
-        if r.detect_reaction(hyb_i=hyb, val_i=val, rings_i=rings, formula_i=formula, isotopic=isotopic, ring_elements=ringelements) or skip:
-            not_found = True
-            if reactant:
-                if any(search_term in s for s in r.reactant_inchis):
-                    result_dict['as_reactant'].append(rinchi)
-                    not_found = False
-            if product:
-                if any(search_term in s for s in r.product_inchis):
-                    result_dict['as_product'].append(rinchi)
-                    not_found = False
-            if agent:
-                if any(search_term in s for s in r.agent_inchis):
-                    result_dict['as_agent'].append(rinchi)
-                    not_found = False
-            if not_found:
-                result_dict['unknown'].append(rinchi)
-    db.close()
-    return result_dict
+    last = after
+    count = 0
+
+    # Search existing db, through its component index if it has one
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        condition = None
+        indexed = 0
+        state = _change_index_names(table_name)[1]
+        if not skip and _check_table_exists(state, cursor):
+            # The filters become conditions on the change index, so indexed candidates need not be parsed to check
+            # them.  Rows inserted since the index was last updated have no changes recorded, so are parsed instead.
+            indexed = cursor.execute('SELECT last_rowid FROM {}'.format(_quote(state))).fetchone()[0]
+            condition = _change_condition(table_name, {
+                'hyb': hyb, 'val': val, 'rings': rings, 'formula': formula, 'ringelements': ringelements or {},
+                'isotopic': {'': 1} if isotopic else {}})
+            if condition is not None:
+                condition = '({} OR t.rowid > ?)'.format(condition[0]), condition[1] + [indexed]
+        if _check_table_exists(_component_index_names(table_name)[2], cursor):
+            wanted = {"reactant": reactant, "product": product, "agent": agent}
+            for last, rinchi, roles in _component_finder(search_term, cursor, table_name, number, condition, after,
+                                                         page_size):
+                count += 1
+                if not skip and last > indexed and not Reaction(rinchi, validate=False).detect_reaction(
+                        hyb_i=hyb, val_i=val, rings_i=rings, formula_i=formula, isotopic=isotopic,
+                        ring_elements=ringelements):
+                    continue
+                found = [role for role in _ROLES if role in roles and wanted[role]]
+                for role in found:
+                    result_dict['as_' + role].append(rinchi)
+                if not found:
+                    result_dict['unknown'].append(rinchi)
+            return result_dict, last, count
+
+        # Linear
+        for last, rinchi in _string_finder(search_term, cursor, table_name, number, condition=condition, after=after,
+                                           page_size=page_size):
+            count += 1
+            r = Reaction(rinchi, validate=False)
+            if skip or last <= indexed or r.detect_reaction(hyb_i=hyb, val_i=val, rings_i=rings, formula_i=formula,
+                                                            isotopic=isotopic, ring_elements=ringelements):
+                not_found = True
+                if reactant:
+                    if any(search_term in s for s in r.reactant_inchis):
+                        result_dict['as_reactant'].append(rinchi)
+                        not_found = False
+                if product:
+                    if any(search_term in s for s in r.product_inchis):
+                        result_dict['as_product'].append(rinchi)
+                        not_found = False
+                if agent:
+                    if any(search_term in s for s in r.agent_inchis):
+                        result_dict['as_agent'].append(rinchi)
+                        not_found = False
+                if not_found:
+                    result_dict['unknown'].append(rinchi)
+    return result_dict, last, count
 
 
 def search_master(search_term, db=None, table_name=None, is_sql_db=False, hyb=None, val=None, rings=None, formula=None,
                   reactant=False, product=False, agent=False, number=1000, keytype=None, ring_type=None, isotopic=None):
     """
-    Search for an string within a RInChi database. Includes all options.
+    Search for an string within a RInChi database. Includes all options.  A warning is logged if an SQL database
+    lookup will scan the whole table, as for an unindexed key column.
 
     Args:
         ring_type:
         isotopic:
-        db:
-        is_sql_db:
+        db: The file name of the database or flat file to search, or a ``RInChIDatabase`` session
+        is_sql_db: Whether db is an SQLite database rather than a flat file.  Implied if db is a session.
         number: Maximum number of initial results
         search_term: The term to search for
         table_name: the table to search in
@@ -429,6 +1471,9 @@ def search_master(search_term, db=None, table_name=None, is_sql_db=False, hyb=No
     if keytype is None or keytype == 'N':
         if search_term.startswith(('Short-RInChIKey', 'Long-RInChIKey', 'Web-RInChIKey')):
             keytype = search_term[0]
+    is_sql_db = is_sql_db or isinstance(db, RInChIDatabase)
+    if is_sql_db:
+        _report_scan(db, table_name or "rinchis1-00", _KEY_FIELDS.get(keytype, "rinchi"), keytype is None)
     if keytype is not None:
         result_dict = {
             'rinchi': [sql_key_to_rinchi(key=search_term, db_filename=db, table_name=table_name, keytype=keytype)]}
@@ -439,126 +1484,306 @@ def search_master(search_term, db=None, table_name=None, is_sql_db=False, hyb=No
     return result_dict
 
 
-def search_for_roles(db, table_name, reactant_subs=None, product_subs=None, agent_subs=None, limit=200):
+# The database, table, Reaction method and compiled queries of the role search run by a worker process
+# The role search of a worker process, set by ``_init_role_search``
+_role_search = None
+
+
+def _compile_role_search(db_filename, table_name, method, queries):
     """
-    Searches for reactions in a particular roles
+    Compiles the query InChIs of a role search once, rather than once per reaction searched.
+
+    Args:
+        db_filename: The file name of the database
+        table_name: The name of the table searched
+        method: The name of the ``Reaction`` method matching each reaction, e.g. "has_substructures"
+        queries: The keyword arguments of the method, whose lists and dicts of InChIs are compiled into ``Molecule``
+            objects, the same object wherever an InChI appears
+
+    Returns:
+        A tuple of the database file name, table name, method and compiled keyword arguments, as taken by
+        ``_search_role_shard``
     """
-    logging.basicConfig(filename='roles.log', level=logging.DEBUG)
-    db = sqlite3.connect(db)
-    cursor = db.cursor()
-    _sql_search(cursor, table_name, columns=("rinchi",), limit=limit)
-    rinchis = (i[0] for i in cursor.fetchall())
-    count = 1
-    print('starting')
-    for rinchi in rinchis:
-        if count % 10000 == 0:
-            print("{} Processed".format(count), flush=True)
-        count += 1
+    molecules = {}
+
+    def compile_inchi(inchi):
+        if inchi not in molecules:
+            molecules[inchi] = Molecule(inchi)
+        return molecules[inchi]
+
+    compiled = {}
+    for name, value in queries.items():
+        if isinstance(value, dict):
+            value = {compile_inchi(inchi): count for inchi, count in value.items()}
+        elif isinstance(value, (list, tuple, set)):
+            value = [compile_inchi(inchi) for inchi in value]
+        compiled[name] = value
+    return db_filename, table_name, method, compiled
+
+
+def _init_role_search(*args):
+    """
+    Compiles the role search of a worker process.  See ``_compile_role_search`` for the arguments.
+    """
+    global _role_search
+    _role_search = _compile_role_search(*args)
+
+
+def _search_role_shard(shard, search=None):
+    """
+    Runs a role search over a range of rowids.  Used as the task run by worker processes.  The rows are read before any
+    are matched, so no read transaction is held open while matching.
+
+    Args:
+        shard: A tuple of the rowid after which the range starts, and the last rowid in the range
+        search: The role search compiled by ``_compile_role_search``.  If None, that of the worker process set up by
+            ``_init_role_search`` is run.
+
+    Returns:
+        A tuple of a list of the (rowid, RInChI) tuples of the matching reactions, the number of reactions searched, a
+        list of the RInChIs that could not be matched, a Counter of the candidates rejected by each stage of
+        ``matcher.screen``, and the time taken in seconds
+    """
+    db_filename, table_name, method, queries = search or _role_search
+    after, last = shard
+    tstart = time.time()
+    screened = Counter(matcher.SCREEN_STATS)
+    command = 'SELECT t.rowid, t.rinchi FROM {} AS t WHERE t.rowid <= ?'.format(_quote(table_name))
+    with _connect(db_filename) as db:
+        rows = list(_keyset_pages(db.cursor(), command, (last,), after=after))
+
+    matches = []
+    failed = []
+    for rowid, rinchi in rows:
         try:
-            r = Reaction(rinchi)
-            if r.has_substructures(reactant_subs, product_subs, agent_subs):
-                yield rinchi
+            if getattr(Reaction(rinchi, validate=False), method)(**queries):
+                matches.append((rowid, rinchi))
         except KeyError:
-            logging.info('Failed : ', rinchi)
+            failed.append(rinchi)
+    return matches, len(rows), failed, Counter(matcher.SCREEN_STATS) - screened, time.time() - tstart
+
+
+def _search_roles(db, table_name, method, queries, limit, token, with_tokens, jobs):
+    """
+    Shards a table into ranges of rowids, and matches the reactions of each shard in a pool of worker processes.  The
+    matches are yielded in rowid order as each shard completes, and the throughput is printed as the search progresses.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The name of the table
+        method: The name of the ``Reaction`` method matching each reaction
+        queries: The keyword arguments of the method.  See ``_init_role_search``.
+        limit: The maximum number of reactions to search.  0 or None means no limit.
+        token: A cursor token yielded by an earlier search of the table, after which to resume
+        with_tokens: Whether to yield the cursor token following each RInChI with it
+        jobs: The number of worker processes
+
+    Returns:
+        A generator yielding the matching RInChIs, or tuples of the RInChI and cursor token if ``with_tokens``
+
+    Raises:
+        ValueError: The token is malformed or belongs to a different table
+    """
+    signature = _search_signature(db, table_name, 'roles')
+    after = _decode_token(signature, token)
+
+    # Find the last rowid searched, so that the shards can be laid out before any is searched
+    table = _quote(table_name)
+    with _connect(db) as connection:
+        cursor = connection.cursor()
+        last = cursor.execute('SELECT MAX(rowid) FROM {}'.format(table)).fetchone()[0] or 0
+        if limit:
+            row = cursor.execute('SELECT rowid FROM {} WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?'.format(table),
+                                 (after, limit - 1)).fetchone()
+            if row is not None:
+                last = row[0]
+
+    size = _external.ROLE_SEARCH_SHARD_SIZE
+    shards = ((start, min(start + size, last)) for start in range(after, last, size))
+    search = (_database_path(db), table_name, method, queries)
+    if jobs <= 1:
+        # Searched in this process, so the compiled queries are bound to this search rather than held globally, where
+        # another search interleaved with this one would replace them
+        results = map(functools.partial(_search_role_shard, search=_compile_role_search(*search)), shards)
+    else:
+        results = utils.ordered_parallel_map(_search_role_shard, shards, jobs, initializer=_init_role_search,
+                                             initargs=search)
+
+    tstart = time.time()
+    searched = 0
+    found = 0
+    screened = Counter()
+    for matches, count, failed, shard_screened, _ in results:
+        screened.update(shard_screened)
+        for rinchi in failed:
+            logger.info('Failed : %s', rinchi)
+        for rowid, rinchi in matches:
+            yield (rinchi, _encode_token(signature, rowid)) if with_tokens else rinchi
+        found += len(matches)
+        if (searched + count) // 10000 > searched // 10000:
+            elapsed = time.time() - tstart
+            print("{} Processed, {} found ({:.1f} reactions/s)".format(
+                searched + count, found, (searched + count) / elapsed if elapsed else 0), flush=True)
+        searched += count
+
+    elapsed = time.time() - tstart
+    print("Searched {} reactions with {} workers in {:.1f} s ({:.1f} reactions/s), {} found".format(
+        searched, jobs, elapsed, searched / elapsed if elapsed else 0, found), flush=True)
+    print("Screened {} candidate substructures: {}, {} passed to matching".format(
+        sum(screened.values()), ", ".join("{} rejected by {}".format(screened[stage], stage)
+                                          for stage in matcher.SCREEN_STAGES), screened['passed']), flush=True)
+
+
+def search_for_roles(db, table_name, reactant_subs=None, product_subs=None, agent_subs=None, limit=200, token=None,
+                     with_tokens=False, jobs=1):
+    """
+    Searches for reactions in a particular roles
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        token: A cursor token yielded by an earlier search of the table, after which to resume
+        with_tokens: Whether to yield the cursor token following each RInChI with it
+        jobs: The number of worker processes to search in
+
+    Raises:
+        ValueError: The token is malformed or belongs to a different table
+    """
+    queries = {'reactant_subs': reactant_subs, 'product_subs': product_subs, 'agent_subs': agent_subs}
+    return _search_roles(db, table_name, 'has_substructures', queries, limit, token, with_tokens, jobs)
+
 
 def search_for_roles_advanced(db, table_name, reactant_subs=None, product_subs=None, agent_subs=None, changing_subs=None,
-                     exclusive=False, unique=True, limit=200):
+                              exclusive=False, unique=True, limit=200, token=None, with_tokens=False, jobs=1):
     """
     Searches for reactions in a particular functionality
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        token: A cursor token yielded by an earlier search of the table, after which to resume
+        with_tokens: Whether to yield the cursor token following each RInChI with it
+        jobs: The number of worker processes to search in
+
+    Raises:
+        ValueError: The token is malformed or belongs to a different table
     """
-    logging.basicConfig(filename='roles.log', level=logging.DEBUG)
-    db = sqlite3.connect(db)
-    cursor = db.cursor()
-    _sql_search(cursor, table_name, columns=("rinchi",), limit=limit)
-    rinchis = (i[0] for i in cursor.fetchall())
-    count = 1
-    print('starting')
-    for rinchi in rinchis:
-        if count % 10000 == 0:
-            print("{} Processed".format(count), flush=True)
-        count += 1
-        try:
-            r = Reaction(rinchi)
-            if r.has_substructures_by_populations(reactant_subs, product_subs, agent_subs, changing_subs, exclusive,
-                                                  unique):
-                yield rinchi
-        except KeyError:
-            logging.info('Failed : ', rinchi)
+    queries = {'reactant_subs': reactant_subs, 'product_subs': product_subs, 'agent_subs': agent_subs,
+               'changing_subs': changing_subs, 'exclusive': exclusive, 'unique': unique}
+    return _search_roles(db, table_name, 'has_substructures_by_populations', queries, limit, token, with_tokens, jobs)
 
 
 # Converting to SQL databases
 #############################
 
-def rdf_to_sql(rdfile, db_filename, table_name, columns=None):
+def rdf_to_sql(rdfile, db_filename, table_name, columns=None, jobs=1, build_indexes=True):
     """
-    Creates or adds to an SQLite db the contents of a given RDFile.
+    Creates or adds to an SQLite db the contents of a given RDFile.  Rows are inserted as each reaction is converted.
+    The key columns of a new table are indexed once all its rows have been inserted.
 
     Args:
-        rdfile: The RD file to add to the db
-        db_filename: The file name of the SQLite db
+        rdfile: The path of the RD file to add to the db, its contents as a string, or an ``rdf_reader.RDFReader``
+        db_filename: The file name of the SQLite db, or a ``RInChIDatabase`` session
         table_name: The name of the table to create or append
         columns: The columns to add.  If None, the default is [rinchi,rauxinfo,longkey,shortkey,webkey]
+        jobs: The number of worker processes to convert the RD file in
+        build_indexes: Whether to index the key columns of a new table.  See ``create_indexes``.
     """
     if columns is None:
         columns = ["rinchi", "rauxinfo", "longkey", "shortkey", "webkey"]
 
-    db = sqlite3.connect(db_filename)
-    cursor = db.cursor()
-
-    if not _check_table_exists(table_name, cursor):
-        _create_sql_table(cursor, table_name, columns, 'longkey')
+    if isinstance(rdfile, str) and os.path.isfile(rdfile):
+        with rdf_reader.RDFReader(rdfile) as reader:
+            return rdf_to_sql(reader, db_filename, table_name, columns, jobs, build_indexes)
 
-    # Repopulate columns variable.  Useful for pre-existing table
-    columns = _get_sql_columns(cursor, table_name)
-
-    # Open the rdfile and convert its contents to a dict of rinchis and RInChI data
-    rdf_data = conversion.rdf_to_rinchis(rdfile, columns=columns)
+    with _connect(db_filename) as db:
+        cursor = db.cursor()
+        new_table = not _table_columns(db_filename, cursor, table_name)
+        if new_table:
+            _create_sql_table(cursor, table_name, columns, 'longkey')
 
-    # Transform in place the dicts storing rxn info to their string representations
-    for i in rdf_data.keys():
-        rdf_data[i][1] = repr(rdf_data[i][1])
+        # Repopulate columns variable.  Useful for pre-existing table
+        columns = _table_columns(db_filename, cursor, table_name)
 
-    rdf_data_tuple = [tuple([i] + rdf_data[i]) for i in rdf_data.keys()]
+        # Convert the rdfile, inserting each row of RInChI data in the order of the table's columns.  Duplicates
+        # within the file are skipped, and rows with existing long keys are replaced by the table's unique constraint.
+        rdf_data = conversion.iter_rdf_rinchis(rdfile, columns=columns, jobs=jobs)
+        rows = (tuple(entry.get(column) for column in columns) for entry in rdf_data)
+        _sql_insert(cursor, table_name, rows, columns, True)
+        _update_reaction_indexes(cursor, table_name, jobs)
 
-    # Add the rdf data to the dict
-    _sql_insert(cursor, table_name, rdf_data_tuple, columns, True)
-    db.commit()
-    db.close()
+    if new_table and build_indexes:
+        create_indexes(db_filename, table_name)
 
 
-def csv_to_sql(csv_name, db_filename, table_name):
+def csv_to_sql(csv_name, db_filename, table_name, build_indexes=True):
     """
-    Creates or appends an SQL db with values from a CSV file
+    Creates or appends an SQL db with values from a CSV file.  The key columns of a new table are indexed once all its
+    rows have been inserted.
 
     Args:
         csv_name: The CSV filename
-        db_filename: The SQLite3 db
+        db_filename: The SQLite3 db, as a file name or a ``RInChIDatabase`` session
         table_name: The name of the table to create or append
+        build_indexes: Whether to index the key columns of a new table.  See ``create_indexes``.
     """
-    db = sqlite3.connect(db_filename)
-    cursor = db.cursor()
-
-    with open(csv_name) as csvfile:
+    with _connect(db_filename) as db, open(csv_name) as csvfile:
+        cursor = db.cursor()
         reader = csv.reader(csvfile, delimiter="$")
         columns = tuple(next(reader))
-        if not _check_table_exists(table_name, cursor):
+        new_table = not _table_columns(db_filename, cursor, table_name)
+        if new_table:
             _create_sql_table(cursor, table_name, columns, 'longkey')
         rows = (row for row in reader)
-        _sql_insert(cursor, table_name, rows, exec_many=True)
+        _sql_insert(cursor, table_name, rows, _table_columns(db_filename, cursor, table_name), exec_many=True)
+        _update_reaction_indexes(cursor, table_name)
+
+    if new_table and build_indexes:
+        create_indexes(db_filename, table_name)
+
+
+def _convert_v02_rows(rows, wanted):
+    """
+    Converts a batch of v0.02 RInChIs and RAuxInfos to v1.00.  Used as the task run by worker processes.
+
+    Args:
+        rows: A list of (rowid, RInChI, RAuxInfo) tuples
+        wanted: A tuple of whether the v1.00 RInChI, RAuxInfo, Long-RInChIKey, Short-RInChIKey and Web-RInChIKey are
+            wanted
 
-    db.commit()
-    db.close()
+    Returns:
+        A tuple of the number of rows in the batch, and a list of tuples of the wanted values of each row converted
+    """
+    key_types = "".join(key_type for key_type, key_wanted in zip("LSW", wanted[2:]) if key_wanted)
+    converted = []
+    for rowid, v02_rinchi, v02_rauxinfo in rows:
+        try:
+            the_rinchi = v02_tools.convert_rinchi(v02_rinchi)
+            data_to_add = []
+            if wanted[0]:
+                data_to_add.append(the_rinchi)
+            if wanted[1]:
+                data_to_add.append(v02_tools.convert_rauxinfo(v02_rauxinfo))
+            if key_types:
+                data_to_add.extend(RInChI().rinchikeys_from_rinchi(the_rinchi, key_types))
+            converted.append(tuple(data_to_add))
+        except Exception as e:
+            # librinchi raises a bare Exception for invalid RInChIs
+            logging.info("Cannot convert row {}, {}: {}".format(rowid, v02_rinchi, e))
+    return len(rows), converted
 
 
 def convert_v02_v10(db_filename, table_name, v02_rinchi=False, v02_rauxinfo=False, v10_rinchi=False, v10_rauxinfo=False,
-                    v10_longkey=False, v10_shortkey=False, v10_webkey=False):
+                    v10_longkey=False, v10_shortkey=False, v10_webkey=False, source_table_name="rinchis02", jobs=1):
     """
     Converts a db of v02 rinchis into a db of v10 rinchis and associated information.  N.B keys for v02
-    are not required as new keys must be generated for the db.  Because of the nature of this problem,
-    this is achieved by creating a new db for the processed data and then transferring back to the original
+    are not required as new keys must be generated for the db.
+
+    The source rows are read in pages and converted in batches by worker processes, and the results are inserted into
+    the new table in transactions of ``_external.V02_CONVERSION_COMMIT_SIZE`` rows, printing the progress and the
+    estimated time remaining after each.
 
     Args:
-         db_filename: The db filename to which the changes should be made.  The new db is added as a table.
+         db_filename: The db filename to which the changes should be made, or a ``RInChIDatabase`` session.  The new
+            db is added as a table.
          table_name: the name for the new v10 rinchi table.
          v02_rinchi: The name of the v02 rinchi column.  Defaults to False (No RInChI in db).
          v02_rauxinfo: The name of the v02 rauxinfo column.  Defaults to False (No rauxinfos in db).
@@ -567,11 +1792,14 @@ def convert_v02_v10(db_filename, table_name, v02_rinchi=False, v02_rauxinfo=Fals
          v10_longkey: The name of the v10 new rinchi column.  Defaults to False (No longkey column will be created).
          v10_shortkey: The name of the v10 new rinchi column.  Defaults to False (No shortkey column will be created).
          v10_webkey: The name of the v10 new webkey column.  Defaults to False (No webkey column will be created).
+         source_table_name: The table of v02 rinchis to convert
+         jobs: The number of worker processes to convert the rows in
 
+    Returns:
+        The number of rows converted
     """
 
-    # Create db connections including for a temporary db and setup logging
-    os.remove("convert0210.log")
+    # Setup logging
     logging.basicConfig(filename='conv0210.log', level=logging.DEBUG)
     logging.info("\n========\nStarting Conversion Process\n========")
     start_time = time.time()
@@ -584,47 +1812,49 @@ def convert_v02_v10(db_filename, table_name, v02_rinchi=False, v02_rauxinfo=Fals
     if all(i is False for i in col_list):
         raise ValueError("Cannot create empty table")
 
-    # Define the processing function
-    def processing_function(row, args):
-        """
-        Processes a row of a RInChIs and RAuxInfo input into a tuple for adding to a queue
-
-        Args:
-            row: A tuple containing the RInChI and RAuxInfo
-            args: Arguments for the function
+    with _connect(db_filename) as db:
+        cursor = db.cursor()
 
-        Returns:
-            The data to add to the queue
-        """
-        the_rinchi = v02_tools.convert_rinchi(row[0])
-        data_to_add = []
-        if args[0]:
-            data_to_add.append(the_rinchi)
-        if args[1]:
-            data_to_add.append(v02_tools.convert_rauxinfo(row[1]))
-        if args[2]:
-            data_to_add.append(RInChI().rinchikey_from_rinchi(the_rinchi, "L"))
-        if args[3]:
-            data_to_add.append(RInChI().rinchikey_from_rinchi(the_rinchi, "S"))
-        if args[4]:
-            data_to_add.append(RInChI().rinchikey_from_rinchi(the_rinchi, "W"))
-        return tuple(data_to_add)
-
-    # Check for existence of new table
-    logging.info("Check for original table")  # Doing this now to prevent delays later
-    db = sqlite3.connect(db_filename)
-    cursor = db.cursor()
-    _drop_table_if_needed(table_name, cursor)
-    db.close()
-
-    # Create args and run the queue
-    pop_args = [_populate_queue, [db_filename, "rinchis02", [v02_rinchi, v02_rauxinfo], processing_function, col_list]]
-    depop_args = [_depopulate_queue, [columns, table_name]]
-    _run_queue(1000, pop_args, depop_args)
-
-    # Transfer table from temporary db to new db
-    _transfer_table(_external.RINCHI_TEMP_DATABASE, db_filename, table_name)
-    logging.info("Finished conversion in {} seconds".format(time.time() - start_time))
+        # Check for existence of new table
+        logging.info("Check for original table")
+        _drop_table_if_needed(table_name, cursor)
+        _create_sql_table(cursor, table_name, columns, v10_longkey or None)
+        db.commit()
+
+        # Read the source rows in pages on a separate cursor, as the converted rows are written on this one
+        source = _quote(source_table_name)
+        total = cursor.execute('SELECT COUNT(*) FROM {}'.format(source)).fetchone()[0]
+        reader = _keyset_pages(db.cursor(), 'SELECT t.rowid, {}, {} FROM {} AS t WHERE 1'.format(
+            v02_rinchi or 'NULL', v02_rauxinfo or 'NULL', source))
+        batches = utils.chunked(reader, _external.V02_CONVERSION_CHUNK_SIZE)
+        convert = functools.partial(_convert_v02_rows, wanted=tuple(bool(column) for column in col_list))
+
+        # The pipeline ends when the reader is exhausted and the workers have returned every batch
+        read = 0
+        count = 0
+        pending = []
+        for batch_size, converted in utils.ordered_parallel_map(convert, batches, jobs):
+            read += batch_size
+            pending.extend(converted)
+            if len(pending) >= _external.V02_CONVERSION_COMMIT_SIZE:
+                _sql_insert(cursor, table_name, pending, columns, exec_many=True)
+                db.commit()
+                count += len(pending)
+                pending = []
+                elapsed = time.time() - start_time
+                rate = read / elapsed if elapsed else 0
+                print("{}/{} rows converted ({:.1f} rows/s, {:.0f} s remaining)".format(
+                    read, total, rate, (total - read) / rate if rate else 0), flush=True)
+        _sql_insert(cursor, table_name, pending, columns, exec_many=True)
+        count += len(pending)
+
+    if isinstance(db_filename, RInChIDatabase):
+        db_filename.invalidate(table_name)
+    elapsed = time.time() - start_time
+    logging.info("Finished conversion in {} seconds".format(elapsed))
+    print("Converted {} of {} rows in {:.1f} s ({:.1f} rows/s)".format(count, total, elapsed,
+                                                                      total / elapsed if elapsed else 0))
+    return count
 
 
 def gen_rauxinfo(db_filename, table_name):
@@ -632,11 +1862,9 @@ def gen_rauxinfo(db_filename, table_name):
     Updates a table in a db to give rauxinfos where the column is null
 
     Args:
-        db_filename: Database filename
+        db_filename: Database filename, or a ``RInChIDatabase`` session
         table_name: name of table
     """
-    db = sqlite3.connect(db_filename)
-    cursor = db.cursor()
 
     def converter(rinchi):
         """
@@ -646,10 +1874,10 @@ def gen_rauxinfo(db_filename, table_name):
         return rauxinfo
 
     # Creating SQL function improves performance
-    db.create_function("convert", 1, converter)
-    cursor.execute(
-        "UPDATE {} SET rauxinfo = convert(rinchi) WHERE rauxinfo IS NULL or rauxinfo = '';".format(table_name))
-    db.commit()
+    with _connect(db_filename) as db:
+        db.create_function("convert", 1, converter)
+        db.execute("UPDATE {} SET rauxinfo = convert(rinchi) WHERE rauxinfo IS NULL or rauxinfo = '';".format(
+            _quote(table_name)))
     return
 
     ##########################################################
@@ -657,44 +1885,179 @@ def gen_rauxinfo(db_filename, table_name):
     ##########################################################
 
 
-def compare_fingerprints(search_term, db_filename, table_name):
+# The prefix of fingerprints stored by ``_encode_fingerprint``, distinguishing them from pickled sparse matrices
+FINGERPRINT_BLOB_PREFIX = b'RFP1'
+
+
+def _encode_fingerprint(fingerprint):
+    """
+    Packs a fingerprint into a compact BLOB: the prefix, the length and number of non-zero values of the fingerprint as
+    little endian uint32s, the indexes of the non-zero values as uint16s, and the values as int16s, saturating at its
+    limits.  If at least half the values are non-zero, every value is stored instead, without the indexes, and the
+    number stored is the length.
+
+    Args:
+        fingerprint: A 1D array of integers, of up to 65536 values
+
+    Returns:
+        The fingerprint as bytes
+    """
+    fingerprint = clip(asarray(fingerprint).ravel(), -32768, 32767)
+    indexes = flatnonzero(fingerprint)
+    if 2 * len(indexes) >= len(fingerprint):
+        return b''.join((FINGERPRINT_BLOB_PREFIX, struct.pack('<II', len(fingerprint), len(fingerprint)),
+                         fingerprint.astype('<i2').tobytes()))
+    return b''.join((FINGERPRINT_BLOB_PREFIX, struct.pack('<II', len(fingerprint), len(indexes)),
+                     indexes.astype('<u2').tobytes(), fingerprint[indexes].astype('<i2').tobytes()))
+
+
+def _decode_fingerprint(blob):
+    """
+    Args:
+        blob: A fingerprint as stored in an SQL BLOB field, by ``_encode_fingerprint`` or as a pickled sparse matrix
+
+    Returns:
+        The fingerprint as a 1D numpy array
+    """
+    blob = bytes(blob)
+    if blob.startswith(FINGERPRINT_BLOB_PREFIX):
+        offset = len(FINGERPRINT_BLOB_PREFIX)
+        length, count = struct.unpack_from('<II', blob, offset)
+        offset += 8
+        if count == length:
+            return frombuffer(blob, '<i2', count, offset).astype('int16')
+        fingerprint = zeros(length, dtype='int16')
+        indexes = frombuffer(blob, '<u2', count, offset)
+        fingerprint[indexes] = frombuffer(blob, '<i2', count, offset + 2 * count)
+        return fingerprint
+    fingerprint = pickle.loads(blob)
+    if hasattr(fingerprint, 'toarray'):
+        fingerprint = fingerprint.toarray()
+    return asarray(fingerprint).ravel()
+
+
+def fingerprint_store_path(db, table_name):
+    """
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The table containing the fingerprints
+
+    Returns:
+        The path of the directory holding the fingerprint store of the table, alongside the database
+    """
+    return "{}.{}.fpstore".format(_database_path(db), table_name)
+
+
+def update_fingerprint_store(db, table_name, dtype='int8'):
     """
-    Search db for top 10 closest matches to a RInChI by fingerprinting method.  Sent to stdout.
+    Adds the fingerprints of a table's rows to its fingerprint store, creating the store if needed.  Only the rows
+    added since the store was last updated are read, in rowid order.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The table containing the longkey and fingerprint columns
+        dtype: The dtype of a new store, see ``fingerprints.DTYPES``.  Reaction fingerprints are differences of
+            counts, which "int8" holds unless they exceed 127.
+
+    Returns:
+        The ``fingerprints.FingerprintStore``, or None if the store does not exist and the table holds no fingerprints
+    """
+    path = fingerprint_store_path(db, table_name)
+    store = fingerprints.FingerprintStore(path) if os.path.exists(path) else None
+    command = 'SELECT t.rowid, t.longkey, t.fingerprint FROM {} AS t WHERE t.fingerprint IS NOT NULL'.format(
+        _quote(table_name))
+    with _connect(db) as connection:
+        rows = _keyset_pages(connection.cursor(), command, after=store.last_rowid if store else 0)
+        for chunk in utils.chunked(rows, _external.SEARCH_PAGE_SIZE):
+            vectors = [_decode_fingerprint(blob) for _, _, blob in chunk]
+            if store is None:
+                store = fingerprints.FingerprintStore(path, len(vectors[0]), dtype)
+            store.append([longkey for _, longkey, _ in chunk], vectors, chunk[-1][0])
+    return store
+
+
+def create_fingerprint_index(db, table_name, n_tables=None, n_bits=None):
+    """
+    Builds an approximate nearest neighbour index of the fingerprints of a table, which ``compare_fingerprints`` can
+    search instead of scoring every fingerprint.  The index is kept in the table's fingerprint store, and is updated
+    with the store.  See ``fingerprints.LSHIndex``.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The table containing the longkey and fingerprint columns
+        n_tables: The number of hash tables.  Defaults to ``_external.LSH_TABLES``
+        n_bits: The number of bits in the code of each table.  Defaults to ``_external.LSH_BITS``
+
+    Returns:
+        The number of fingerprints indexed
+    """
+    store = update_fingerprint_store(db, table_name)
+    if store is None:
+        return 0
+    return len(store.build_index(n_tables, n_bits))
+
+
+def drop_fingerprint_index(db, table_name):
+    """
+    Removes the approximate nearest neighbour index of the fingerprints of a table.
+
+    Args:
+        db: The file name of the database, or a ``RInChIDatabase`` session
+        table_name: The table containing the fingerprints
+
+    Returns:
+        True if there was an index to drop, otherwise False
+    """
+    path = fingerprint_store_path(db, table_name)
+    return os.path.exists(path) and fingerprints.FingerprintStore(path).drop_index()
+
+
+def compare_fingerprints(search_term, db_filename, table_name, k=None, metric='euclidean', approximate=False,
+                         radius=None, backend=None):
+    """
+    Search db for the closest matches to a RInChI by fingerprinting method.  Sent to stdout.
+
+    The fingerprints are searched in the table's fingerprint store, which is first brought up to date with the table.
+    See ``update_fingerprint_store``.
 
     Args:
         search_term: A RInChi or Long-RInChIKey to search with
-        db_filename: the db containing the fingerprints
+        db_filename: the db containing the fingerprints, as a file name or a ``RInChIDatabase`` session
         table_name: The table containing the RInChI fingerprints
+        k: The number of matches to find.  Defaults to ``_external.FINGERPRINT_TOP_K``
+        metric: The distance or similarity to rank matches by, see ``fingerprints.METRICS``
+        approximate: Whether to search only the candidates found by the table's fingerprint index, if it has one.  See
+            ``create_fingerprint_index``
+        radius: The radius of the approximate search, see ``fingerprints.LSHIndex.candidates``
+        backend: The backend generating the fingerprint of a RInChI.  Defaults to that which built the table, see
+            ``update_fingerprints``
+
+    Returns:
+        A list of tuples of the Long-RInChIKey and the distance or similarity of each match, closest first
 
+    Raises:
+        ValueError: The table was built with a different backend
     """
-    db_size = 830000
-    counter = 1
+    with _connect(db_filename) as db:
+        built = _fingerprint_backend(db.cursor(), table_name)
+    if backend and built and backend != built:
+        raise ValueError("{} holds fingerprints generated by {}, which cannot be compared with those of {}".format(
+            table_name, built, backend))
 
     if search_term.startswith("Long-RInChIKey"):
         fp1 = recall_fingerprints(search_term, db_filename, table_name)
     elif search_term.startswith("RInChI"):
         r = Reaction(search_term)
-        r.calculate_reaction_fingerprint()
-        fp1 = r.reaction_fingerprint.toarray()
+        r.calculate_reaction_fingerprint(backend=backend or built)
+        fp1 = r.reaction_fingerprint.toarray()[0]
     else:
         print("Invalid input")
         return
 
-    db = sqlite3.connect(db_filename)
-
-    res = []
-    cursor = db.cursor()
-    cursor = _sql_search(cursor, table_name, ["longkey", "fingerprint"], limit=-1)
-    for r in cursor:
-        counter += 1
-        res.append((r[0], distance.euclidean(fp1, pickle.loads(str(r[1])).toarray()[0])))
-        if counter % 10000 == 0:
-            per = int(float(100 * counter) / db_size)
-            sys.stdout.write("\r {0}% complete".format(per))
-            sys.stdout.flush()
-
-    out = nsmallest(10, res, key=lambda s: s[1])
-    print("\n", out)
+    store = update_fingerprint_store(db_filename, table_name)
+    out = store.top_k(fp1, k, metric, approximate=approximate, radius=radius) if store is not None else []
+    print(out)
+    return out
 
 
 def recall_fingerprints(lkey, db_filename, table_name):
@@ -703,145 +2066,179 @@ def recall_fingerprints(lkey, db_filename, table_name):
 
     Args:
         lkey: The long key to search for
-        db_filename: The db filename
+        db_filename: The db filename, or a ``RInChIDatabase`` session
         table_name: The table name which stores the fingerprints
 
     Returns:
         A numpy array the reaction fingerprint as stored in the reaction db
     """
-    db = sqlite3.connect(db_filename)
-    cursor = db.cursor()
-    cursor = _sql_search(cursor, table_name, ["fingerprint"], lkey, "longkey", )
+    with _connect(db_filename) as db:
+        cursor = _sql_search(db.cursor(), table_name, ["fingerprint"], lkey, "longkey", )
 
-    # Unpickle the binary data, and return a Numpy array containing the reaction fingerprint
-    fpt = pickle.loads(str(cursor.fetchone()[0])).toarray()[0]
-    db.close()
+        # Unpickle the binary data, and return a Numpy array containing the reaction fingerprint
+        fpt = _decode_fingerprint(cursor.fetchone()[0])
 
     return fpt
 
 
-def update_fingerprints(db_filename, table_name, fingerprint_table_name):
+def _fingerprint_state_name(fingerprint_table_name):
     """
-    NOT CURRENTLY WORKING.  NEEDS UPDATING TO USE MULTITHREADING FOR USABLE PERFORMANCE
-
-    Calculates the reaction fingerprint as defined in the reaction Reaction class, and stores it in the given
-    db in a compressed form
-
-    Args:
-        db_filename: the db filename to update
-        table_name: The table containing the RInChIs
-        fingerprint_table_name: The table to contain the fingerprint
+    Returns:
+        The name of the table recording the last source rowid fingerprinted into a fingerprint table
     """
-    db = sqlite3.connect(db_filename)
-
-    # Poor method.  A db cannot have two cursors pointing at it.
-    cursor = db.cursor()
-    cursor2 = db.cursor()
-
-    cursor = _sql_search(cursor, table_name, fingerprint_table_name)
-
-    counter = 0
-    for lkey in cursor:
-
-        try:
-            # cursor.execute('''SELECT rinchi FROM rinchis WHERE longkey LIKE ?''', (lkey,))
-            # rinchi = cursor.fetchone()[0]
-            r = Reaction(lkey[0])
-            r.calculate_reaction_fingerprint()
-
-            # Pickle the reaction fingerprint - store it as binary data within an SQL BLOB field
-            fingerprint = pickle.dumps(r.reaction_fingerprint)
-            # cursor.execute('''UPDATE fingerprints SET fingerprint = ? WHERE longkey = ? ''', (fingerprint, lkey[1]))
-            cursor2.execute('''INSERT INTO fpts (longkey, fingerprint) VALUES (?, ?) ''', (lkey[1], fingerprint))
-            counter += 1
-            print(counter)
-            db.commit()
-
-        except sqlite3.IntegrityError:
-            counter += 1
-            print(counter, "ERR", "\n")
-    db.commit()
-    db.close()
+    return "{}_state".format(fingerprint_table_name)
 
 
-# Updating scripts using threading for performance
-#################################################
-
-
-def _populate_queue(q, db_filename, table_name, source_columns, processing_function=None, processing_args=None):
+def _fingerprint_backend(cursor, fingerprint_table_name):
     """
-    Populates a queue with items processed from a db using a processing function provided.  If no processing
-    function is provided then each row is simply placed into the queue.
-
     Args:
-        q: A queue object instance
-        db_filename: The filename of the db from which to populate the queue
-        table_name: The name of the table from which to populate the queue
-        source_columns: A list of columns to select from the table
-        processing_function: A function which takes a row and outputs a row for the new table
-        processing_args: List of arguments if needed to pass to the function
+        cursor: The SQLite database cursor object
+        fingerprint_table_name: The name of the fingerprint table
+
+    Returns:
+        The backend which generated the fingerprints of a fingerprint table, see
+        ``reaction.calculate_reaction_fingerprints``, or None if it was not built by ``update_fingerprints``
     """
-    if callable(processing_function) or processing_function is None:
-        db = sqlite3.connect(db_filename)
-        cursor = db.cursor()
-        logging.info("populating")
-        for row in _sql_search(cursor, table_name, source_columns):
-            if processing_function is not None:
-                row = processing_function(row, processing_args)
-            q.put(row)
-            while q.full():
-                time.sleep(0.01)
-        logging.info("finished_populating")
-        db.close()
-    else:
-        raise ValueError("Function not given as argument 'Processing function'")
+    state = _fingerprint_state_name(fingerprint_table_name)
+    if not _check_table_exists(state, cursor):
+        return None
+    # Fingerprint tables built before the backend was recorded were built by obabel
+    if 'backend' not in _get_sql_columns(cursor, state):
+        return 'obabel'
+    return cursor.execute('SELECT backend FROM {}'.format(_quote(state))).fetchone()[0]
 
 
-def _depopulate_queue(q, columns, table_name):
+def _batch_fingerprints(rows, backend=None):
     """
-    Removes items from the queue and processes them to an output table
+    Calculates the reaction fingerprints of a batch of reactions.  Used as the task run by worker processes, each of
+    which caches the fingerprints of the molecules it has seen.
 
     Args:
-        q: The queue to depopulate
-        columns: the columns to create in the output table
-        table_name: the name of the table to create
+        rows: A list of (rowid, Long-RInChIKey, RInChI) tuples.  Missing keys are generated.
+        backend: The backend generating the molecule fingerprints, see ``reaction.calculate_reaction_fingerprints``
+
+    Returns:
+        A tuple of the last rowid of the batch, a list of (Long-RInChIKey, fingerprint BLOB) tuples of the reactions
+        fingerprinted, and the number of reactions skipped
+
+    Raises:
+        OSError: The fingerprint backend could not be run, e.g. obabel is not installed.  Only reactions which
+            cannot be fingerprinted are skipped, not those which the environment prevents from being fingerprinted.
     """
-    db = sqlite3.connect(_external.RINCHI_TEMP_DATABASE)
-    cursor = db.cursor()
-    _create_sql_table(cursor, table_name, columns, 'longkey')
-    logging.info("depopulating")
-    while True:
+    reactions = []
+    longkeys = []
+    for rowid, longkey, rinchi in rows:
         try:
-            _sql_insert(cursor, table_name, q.get(True, 2))
-            # Waits for 2 seconds, otherwise throws `Queue.Empty`
-        except queue.Empty:
-            logging.info("Finished depopulating")
-            break
-    db.commit()
-    db.close()
+            r = Reaction(rinchi, validate=False)
+            longkeys.append(longkey or r.longkey())
+            reactions.append(r)
+        except (ValueError, IndexError, KeyError) as e:
+            logger.info("Cannot fingerprint row {}, {}: {}".format(rowid, rinchi, e))
+
+    # Fingerprint the whole batch at once, falling back to one reaction at a time to skip any that fail
+    try:
+        matrix = calculate_reaction_fingerprints(reactions, backend=backend)
+    except (ValueError, IndexError, KeyError):
+        matrix = []
+        for r in reactions:
+            try:
+                matrix.append(calculate_reaction_fingerprints([r], backend=backend)[0])
+            except (ValueError, IndexError, KeyError) as e:
+                logger.info("Cannot fingerprint {}: {}".format(r.rinchi, e))
+                matrix.append(None)
+    fingerprinted = [(longkey, _encode_fingerprint(fingerprint)) for longkey, fingerprint in zip(longkeys, matrix)
+                     if fingerprint is not None]
+    return rows[-1][0], fingerprinted, len(rows) - len(fingerprinted)
+
+
+def update_fingerprints(db_filename, table_name, fingerprint_table_name="fpts", jobs=1, resume=True, backend=None):
+    """
+    Calculates the reaction fingerprint as defined in the reaction Reaction class of each reaction in a table, and
+    stores it in a "(longkey, fingerprint)" table in a compressed form.  See ``_encode_fingerprint``.
 
+    The RInChIs are streamed in rowid order, fingerprinted in batches by worker processes, and written in transactions
+    of ``_external.FINGERPRINT_COMMIT_SIZE`` rows, each recording the last rowid written.  An interrupted build is
+    resumed from there, and later calls add only the reactions inserted since.  An existing fingerprint store of the
+    fingerprint table is then brought up to date.  See ``update_fingerprint_store``.
 
-def _run_queue(q_length, *threads):
-    """
-    Runs a set of functions as threads which perform functions on a queue and ends them together
+    The backend generating the fingerprints is recorded with the state, as fingerprints of different backends cannot
+    be compared.  A fingerprint table can only be resumed with the backend that built it.
 
     Args:
-        q_length: The length of the queue to populate for converting the data
-        *threads: The threads store as a tuple of the function name, and the arguments for that function, excluding
-            the first argument which is the queue object created in this function
-    """
-    q = queue.Queue(q_length)
-    thread_list = []
-
-    # Create a list of thread objects
-    for thread in threads:
-        args = [q] + thread[1]
-        thread_list.append(threading.Thread(target=thread[0], args=args))
+        db_filename: the db filename to update, or a ``RInChIDatabase`` session
+        table_name: The table containing the RInChIs, and optionally their Long-RInChIKeys
+        fingerprint_table_name: The table to contain the fingerprint
+        jobs: The number of worker processes to calculate fingerprints in
+        resume: Whether to continue from the last reaction fingerprinted.  Otherwise, the fingerprint table is rebuilt.
+        backend: "obabel" or "native", see ``reaction.calculate_reaction_fingerprints``.  Defaults to the backend which
+            built the fingerprint table, or ``_external.FINGERPRINT_BACKEND`` for a new table
 
-    # Start the threads
-    for thread in thread_list:
-        thread.start()
+    Returns:
+        The number of reactions fingerprinted
 
-    # End the threads together
-    for thread in thread_list:
-        thread.join()
+    Raises:
+        OSError: The fingerprint backend could not be run.  The reactions fingerprinted before the last commit are
+            kept, and the build can be resumed once the backend is available.
+        ValueError: The fingerprint table was built with a different backend
+    """
+    state = _fingerprint_state_name(fingerprint_table_name)
+    with _connect(db_filename) as db:
+        cursor = db.cursor()
+        if not resume:
+            for name in (fingerprint_table_name, state):
+                cursor.execute('DROP TABLE IF EXISTS {}'.format(_quote(name)))
+            if os.path.exists(fingerprint_store_path(db_filename, fingerprint_table_name)):
+                shutil.rmtree(fingerprint_store_path(db_filename, fingerprint_table_name))
+        cursor.execute('CREATE TABLE IF NOT EXISTS {} (longkey TEXT PRIMARY KEY, fingerprint BLOB)'.format(
+            _quote(fingerprint_table_name)))
+        built = _fingerprint_backend(cursor, fingerprint_table_name)
+        if backend and built and backend != built:
+            raise ValueError("{} holds fingerprints generated by {}, not {}.  Rebuild it to change backend.".format(
+                fingerprint_table_name, built, backend))
+        backend = backend or built or _external.FINGERPRINT_BACKEND
+        if not _check_table_exists(state, cursor):
+            cursor.execute('CREATE TABLE {} (last_rowid INTEGER, backend TEXT)'.format(_quote(state)))
+            cursor.execute('INSERT INTO {} VALUES (0, ?)'.format(_quote(state)), (backend,))
+        db.commit()
+        last = cursor.execute('SELECT last_rowid FROM {}'.format(_quote(state))).fetchone()[0]
+
+        # Read the new rows on a separate cursor, as the fingerprints are written on this one
+        key = 'longkey' if 'longkey' in _table_columns(db_filename, cursor, table_name) else 'NULL'
+        reader = db.execute('SELECT rowid, {}, rinchi FROM {} WHERE rowid > ? ORDER BY rowid'.format(
+            key, _quote(table_name)), (last,))
+        batches = utils.chunked(reader, _external.FINGERPRINT_BUILD_CHUNK_SIZE)
+
+        def write(rows, last_rowid):
+            cursor.executemany('INSERT OR IGNORE INTO {} VALUES (?, ?)'.format(_quote(fingerprint_table_name)), rows)
+            cursor.execute('UPDATE {} SET last_rowid = ?'.format(_quote(state)), (last_rowid,))
+            db.commit()
+            return len(rows)
+
+        # A batch failing other than by skipping reactions aborts the build before the state records it
+        tstart = time.time()
+        count = 0
+        skipped = 0
+        pending = []
+        fingerprint_batch = functools.partial(_batch_fingerprints, backend=backend)
+        for last, fingerprinted, batch_skipped in utils.ordered_parallel_map(fingerprint_batch, batches, jobs):
+            skipped += batch_skipped
+            pending.extend(fingerprinted)
+            if len(pending) >= _external.FINGERPRINT_COMMIT_SIZE:
+                count += write(pending, last)
+                pending = []
+                elapsed = time.time() - tstart
+                print("{} reactions fingerprinted ({:.1f} reactions/s)".format(
+                    count, count / elapsed if elapsed else 0), flush=True)
+        count += write(pending, last)
+
+    if skipped:
+        logger.warning("Skipped {} reactions of {} that could not be fingerprinted".format(skipped, table_name))
+    if isinstance(db_filename, RInChIDatabase):
+        for name in (fingerprint_table_name, state):
+            db_filename.invalidate(name)
+    if os.path.exists(fingerprint_store_path(db_filename, fingerprint_table_name)):
+        update_fingerprint_store(db_filename, fingerprint_table_name)
+    elapsed = time.time() - tstart
+    print("Fingerprinted {} reactions in {:.1f} s ({:.1f} reactions/s)".format(
+        count, elapsed, count / elapsed if elapsed else 0))
+    return count
@@ -0,0 +1,604 @@
+"""
+RInChI Fingerprint Store Module
+-------------------------------
+
+This module stores reaction and molecule fingerprints as one contiguous matrix, memory-mapped from disk, and finds the
+fingerprints nearest to a query in chunked, vectorised passes over the matrix rather than row by row.
+
+Bit fingerprints are stored packed, eight bits to a byte, and compared by counting set bits with a lookup table.
+Count and difference fingerprints, such as the reaction fingerprint of ``Reaction.calculate_reaction_fingerprint``,
+are stored as small integers, saturating at the limits of the dtype chosen.
+
+A store may also hold an approximate nearest neighbour index, ``LSHIndex``, which answers queries by scoring only the
+rows likely to be nearest, rather than every row.
+
+Molecule fingerprints can be generated here too, from the molecular graph of a ``Molecule``, without an external
+program.  See ``circular_fingerprint``.
+"""
+
+import glob
+import itertools
+import json
+import os
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+from . import _external
+from .molecule import Molecule
+
+# The distance and similarity measures supported by ``FingerprintStore.top_k``.  Euclidean distances are ranked
+# smallest first, and cosine and Tanimoto similarities largest first.
+METRICS = ('euclidean', 'cosine', 'tanimoto')
+
+# The dtypes fingerprints may be stored as.  "bits" fingerprints are packed into uint8 bytes.
+DTYPES = ('bits', 'int8', 'int16', 'float32')
+
+# The number of set bits in each value of a byte
+_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def _popcount(rows):
+    """
+    Args:
+        rows: A 2D uint8 array of packed bits
+
+    Returns:
+        A float array of the number of set bits in each row
+    """
+    if not hasattr(np, 'bitwise_count'):
+        return _POPCOUNT[rows].sum(axis=1, dtype=np.float64)
+    # Count 64 bits at a time where the rows are a whole number of words
+    if rows.shape[1] % 8 == 0 and rows.flags.c_contiguous:
+        rows = rows.view(np.uint64)
+    return np.bitwise_count(rows).sum(axis=1, dtype=np.float64)
+
+
+def circular_fingerprint(molecule, size=1024, radius=None):
+    """
+    Generates a hashed circular fingerprint of a molecule from its molecular graph, in the manner of extended
+    connectivity fingerprints.  Each atom is first identified by a hash of its element, number of attached hydrogens,
+    hybridisation and number of bonds.  Each iteration up to the radius then identifies it by a hash of its identifier
+    and those of its neighbours, describing its environment one bond further out.  Every identifier sets one bit.
+
+    Args:
+        molecule: A ``Molecule``
+        size: The number of bits in the fingerprint
+        radius: The number of iterations, i.e. the number of bonds out from each atom described.  Defaults to
+            ``_external.CIRCULAR_FINGERPRINT_RADIUS``
+
+    Returns:
+        A numpy bool array of the bits of the fingerprint
+    """
+    radius = _external.CIRCULAR_FINGERPRINT_RADIUS if radius is None else radius
+    atoms = molecule.atoms
+    identifiers = {index: zlib.crc32("{}|{}|{}|{}".format(atom.element, atom.protons, atom.get_hybridisation(),
+                                                          len(set(atom.bonds))).encode())
+                   for index, atom in atoms.items()}
+    features = set(identifiers.values())
+    for iteration in range(radius):
+        identifiers = {index: zlib.crc32(",".join(map(str, [iteration, identifiers[index]] + sorted(
+            identifiers[neighbour] for neighbour in set(atom.bonds)))).encode())
+                       for index, atom in atoms.items()}
+        features.update(identifiers.values())
+
+    fingerprint = np.zeros(size, dtype=bool)
+    fingerprint[[feature % size for feature in features]] = True
+    return fingerprint
+
+
+@lru_cache(maxsize=_external.FINGERPRINT_CACHE_SIZE)
+def circular_fingerprint_cached(inchi, size=1024, radius=None):
+    """
+    Generates the circular fingerprint of a simple InChI, memoized as the same solvents, reagents and catalysts appear
+    in many reactions.  See ``circular_fingerprint``.
+
+    Returns:
+        A read-only numpy bool array of the bits of the fingerprint
+    """
+    fingerprint = circular_fingerprint(Molecule(inchi), size, radius)
+    fingerprint.flags.writeable = False
+    return fingerprint
+
+
+def molecule_fingerprints(molecules, size=1024, radius=None):
+    """
+    Generates the circular fingerprints of many molecules, each distinct InChI only once.
+
+    Args:
+        molecules: An iterable of simple InChIs or ``Molecule`` objects
+        size: The number of bits in each fingerprint
+        radius: The radius of the fingerprints, see ``circular_fingerprint``
+
+    Returns:
+        A numpy bool array with a row of the bits of each molecule's fingerprint
+    """
+    rows = [circular_fingerprint_cached(getattr(molecule, 'inchi', molecule), size, radius) for molecule in molecules]
+    return np.array(rows, dtype=bool).reshape(len(rows), size)
+
+
+class FingerprintStore:
+    """
+    An append-only matrix of fingerprints and the keys identifying its rows, held in a directory of three files:
+    "vectors.bin", the raw rows of the matrix; "keys.txt", the key of each row, one per line; and "meta.json", the
+    width and dtype of the rows, the number committed, and the rowid of the last row added from the source table.
+
+    Rows are committed by rewriting "meta.json", so anything written after the last commit by an interrupted append
+    is ignored, and overwritten by the next.
+    """
+
+    def __init__(self, path, width=None, dtype='int8'):
+        """
+        Args:
+            path: The directory of the store
+            width: The number of features in each fingerprint.  If given, the store is created if it does not exist.
+            dtype: The dtype of a store created, one of ``DTYPES``
+
+        Raises:
+            IOError: The store does not exist, and no width was given to create it
+            ValueError: The dtype is not supported
+        """
+        self.path = path
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.vectors_path = os.path.join(path, 'vectors.bin')
+        self.keys_path = os.path.join(path, 'keys.txt')
+        self._matrix = None
+        self._keys = None
+        self._index = None
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        elif width is None:
+            raise IOError("No fingerprint store found at {}".format(path))
+        elif dtype not in DTYPES:
+            raise ValueError("Unsupported fingerprint dtype {}, must be one of {}".format(dtype, ", ".join(DTYPES)))
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.meta = {'width': width, 'dtype': dtype, 'count': 0, 'keys_size': 0, 'last_rowid': 0}
+            self._commit()
+
+    def __repr__(self):
+        return "<FingerprintStore {} {}x{} {}>".format(self.path, len(self), self.width, self.dtype)
+
+    def __len__(self):
+        return self.meta['count']
+
+    @property
+    def width(self):
+        return self.meta['width']
+
+    @property
+    def dtype(self):
+        return self.meta['dtype']
+
+    @property
+    def last_rowid(self):
+        """
+        The rowid of the last row of the source table added to the store, or 0 if none has been
+        """
+        return self.meta['last_rowid']
+
+    @property
+    def row_size(self):
+        """
+        The number of stored values in each row of the matrix
+        """
+        return (self.width + 7) // 8 if self.dtype == 'bits' else self.width
+
+    def _storage_dtype(self):
+        return np.uint8 if self.dtype == 'bits' else np.dtype(self.dtype)
+
+    def _commit(self):
+        temp_path = self.meta_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def encode(self, vectors):
+        """
+        Converts fingerprints to the dtype they are stored as.
+
+        Args:
+            vectors: A fingerprint, or a sequence or 2D array of fingerprints, each of ``width`` features
+
+        Returns:
+            A 2D array of the encoded fingerprints, one row for each
+
+        Raises:
+            ValueError: The fingerprints are not ``width`` features long
+        """
+        vectors = np.atleast_2d(np.asarray(vectors))
+        if vectors.shape[1] != self.width:
+            raise ValueError("Fingerprints of {} features cannot be stored in a store of width {}".format(
+                vectors.shape[1], self.width))
+        if self.dtype == 'bits':
+            return np.packbits(vectors != 0, axis=1)
+        dtype = self._storage_dtype()
+        if dtype.kind == 'i':
+            limits = np.iinfo(dtype)
+            vectors = np.clip(vectors, limits.min, limits.max)
+        return vectors.astype(dtype)
+
+    def append(self, keys, vectors, last_rowid=None):
+        """
+        Adds fingerprints to the end of the store, and commits them.
+
+        Args:
+            keys: The key of each fingerprint, e.g. its Long-RInChIKey
+            vectors: The fingerprints, see ``encode``
+            last_rowid: The rowid of the last row of the source table added, if any
+        """
+        keys = list(keys)
+        rows = self.encode(vectors) if keys else np.empty((0, self.row_size), self._storage_dtype())
+        if len(rows) != len(keys):
+            raise ValueError("{} keys were given for {} fingerprints".format(len(keys), len(rows)))
+
+        # Overwrite anything left after the last commit by an interrupted append
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(len(self) * self.row_size * rows.itemsize)
+            f.write(np.ascontiguousarray(rows).tobytes())
+        with open(self.keys_path, 'ab') as f:
+            f.truncate(self.meta['keys_size'])
+            f.write(''.join(key + '\n' for key in keys).encode())
+            keys_size = f.tell()
+
+        self.meta['count'] += len(keys)
+        self.meta['keys_size'] = keys_size
+        if last_rowid is not None:
+            self.meta['last_rowid'] = last_rowid
+        self._commit()
+        self._matrix = None
+        if self._keys is not None:
+            self._keys.extend(keys)
+
+        index = self.index()
+        if index is not None:
+            index.update()
+
+    def index(self):
+        """
+        Returns:
+            The ``LSHIndex`` of the store, or None if it has none
+        """
+        if self._index is None and os.path.exists(os.path.join(self.path, LSHIndex.META_FILE)):
+            self._index = LSHIndex(self)
+        return self._index
+
+    def build_index(self, n_tables=None, n_bits=None, seed=0):
+        """
+        Builds an ``LSHIndex`` of the store, replacing any it has.  The index is kept up to date as rows are appended.
+
+        Args:
+            n_tables: The number of hash tables.  Defaults to ``_external.LSH_TABLES``
+            n_bits: The number of bits in the code of each table.  Defaults to ``_external.LSH_BITS``
+            seed: The seed of the random hash functions
+
+        Returns:
+            The ``LSHIndex``
+        """
+        self.drop_index()
+        self._index = LSHIndex(self, n_tables, n_bits, seed)
+        self._index.update()
+        return self._index
+
+    def drop_index(self):
+        """
+        Removes the ``LSHIndex`` of the store.
+
+        Returns:
+            True if there was an index to remove, otherwise False
+        """
+        index = self.index()
+        if index is None:
+            return False
+        index.remove()
+        self._index = None
+        return True
+
+    def matrix(self):
+        """
+        Returns:
+            The committed rows of the store as a read-only array, memory-mapped from disk
+        """
+        if self._matrix is None:
+            if not len(self):
+                self._matrix = np.empty((0, self.row_size), self._storage_dtype())
+            else:
+                self._matrix = np.memmap(self.vectors_path, dtype=self._storage_dtype(), mode='r',
+                                         shape=(len(self), self.row_size))
+        return self._matrix
+
+    def keys(self):
+        """
+        Returns:
+            A list of the keys of the committed rows of the store, in order
+        """
+        if self._keys is None:
+            if not len(self):
+                self._keys = []
+            else:
+                with open(self.keys_path, 'rb') as f:
+                    self._keys = f.read(self.meta['keys_size']).decode().split('\n')[:len(self)]
+        return self._keys
+
+    def scores(self, query, rows=None, metric='euclidean'):
+        """
+        Scores stored fingerprints against a query in one vectorised pass.
+
+        Args:
+            query: The query fingerprint of ``width`` features
+            rows: A 2D array of encoded fingerprints to score.  Defaults to the whole store.
+            metric: One of ``METRICS``
+
+        Returns:
+            A float array of the distance or similarity of each row to the query
+
+        Raises:
+            ValueError: The metric is not supported
+        """
+        if metric not in METRICS:
+            raise ValueError("Unsupported metric {}, must be one of {}".format(metric, ", ".join(METRICS)))
+        rows = self.matrix() if rows is None else rows
+
+        if self.dtype == 'bits':
+            query = self.encode(query)[0]
+            rows = np.ascontiguousarray(rows)
+            common = _popcount(rows & query)
+            squared_norms = _popcount(rows)
+            query_squared_norm = float(_popcount(query[np.newaxis])[0])
+        else:
+            query = self.encode(query)[0].astype(np.float64)
+            rows = np.asarray(rows, dtype=np.float32)
+            common = rows @ query.astype(np.float32)
+            squared_norms = np.einsum('ij,ij->i', rows, rows)
+            query_squared_norm = float(query @ query)
+
+        if metric == 'euclidean':
+            return np.sqrt(np.maximum(squared_norms + query_squared_norm - 2 * common, 0))
+        if metric == 'cosine':
+            denominator = np.sqrt(squared_norms * query_squared_norm)
+        else:
+            denominator = squared_norms + query_squared_norm - common
+        return np.divide(common, denominator, out=np.zeros(len(common)), where=denominator != 0)
+
+    def top_k(self, query, k=None, metric='euclidean', chunk_size=None, approximate=False, radius=None):
+        """
+        Finds the stored fingerprints nearest to a query, scoring the store a chunk of rows at a time.
+
+        Args:
+            query: The query fingerprint of ``width`` features
+            k: The number of fingerprints to return.  Defaults to ``_external.FINGERPRINT_TOP_K``
+            metric: One of ``METRICS``
+            chunk_size: The number of rows scored at a time.  Defaults to ``_external.FINGERPRINT_CHUNK_SIZE``
+            approximate: Whether to score only the candidates found by the store's ``LSHIndex``, if it has one.  Fewer
+                than k fingerprints are returned if fewer candidates are found.
+            radius: The number of bits by which the codes of approximate candidates may differ from the query's.  See
+                ``LSHIndex.candidates``
+
+        Returns:
+            A list of up to k tuples of the key and score of the nearest fingerprints, nearest first
+        """
+        k = k or _external.FINGERPRINT_TOP_K
+        chunk_size = chunk_size or _external.FINGERPRINT_CHUNK_SIZE
+        matrix = self.matrix()
+        index = self.index() if approximate else None
+        if index is not None:
+            rows = index.candidates(query, radius)
+            chunks = ((rows[start:start + chunk_size], matrix[rows[start:start + chunk_size]])
+                      for start in range(0, len(rows), chunk_size))
+        else:
+            chunks = ((np.arange(start, min(start + chunk_size, len(self))), matrix[start:start + chunk_size])
+                      for start in range(0, len(self), chunk_size))
+        return self._top_k_rows(query, chunks, k, metric)
+
+    def _top_k_rows(self, query, chunks, k, metric):
+        """
+        Finds the k best scoring rows among chunks of rows, holding only the best k found so far between chunks.
+
+        Args:
+            query: The query fingerprint
+            chunks: An iterable of tuples of an array of the indexes of rows in the store, and an array of the rows
+            k: The number of rows to return
+            metric: One of ``METRICS``
+
+        Returns:
+            A list of up to k tuples of the key and score of the best rows, best first
+        """
+        sign = 1 if metric == 'euclidean' else -1
+        best_rows = np.empty(0, dtype=np.int64)
+        best_costs = np.empty(0)
+        for indexes, chunk in chunks:
+            costs = np.concatenate((best_costs, sign * self.scores(query, chunk, metric)))
+            indexes = np.concatenate((best_rows, indexes))
+            if len(costs) > k:
+                keep = np.argpartition(costs, k - 1)[:k]
+                costs, indexes = costs[keep], indexes[keep]
+            best_costs, best_rows = costs, indexes
+
+        keys = self.keys()
+        order = np.lexsort((best_rows, best_costs))
+        return [(keys[best_rows[i]], float(sign * best_costs[i])) for i in order]
+
+
+class LSHIndex:
+    """
+    An approximate nearest neighbour index of the rows of a ``FingerprintStore`` by locality sensitive hashing.
+
+    Each of ``n_tables`` hash functions maps a fingerprint to a code of ``n_bits`` bits, the side of each of a set of
+    random hyperplanes through the origin that it lies on.  Fingerprints separated by a small angle share a code in at
+    least one table with high probability, so a query need only score the rows that do.  Sampling bits would be the
+    textbook hash of bit fingerprints, but their set bits are sparse, so nearly every row would share the all zero
+    code, whereas the hyperplanes of the set bits separate them.  More tables, or probing codes within a larger radius
+    of the query's, find more of the true nearest rows at the cost of scoring more rows.  More bits per table make each
+    bucket smaller.
+
+    The index is held in the store's directory: "lsh.json", its parameters and the number of rows hashed; "lsh.bin",
+    the codes of every row, appended as rows are added; and "lsh_codes_<n>.npy" and "lsh_rows_<n>.npy", the codes of
+    the first n rows sorted in each table and the rows they belong to, which are searched by bisection.  Rows hashed
+    since the last sort are scanned, and are merged into the sorted tables once they exceed an eighth of the store.
+    """
+
+    META_FILE = 'lsh.json'
+
+    def __init__(self, store, n_tables=None, n_bits=None, seed=0):
+        """
+        Args:
+            store: The ``FingerprintStore`` indexed
+            n_tables: The number of hash tables of a new index.  Defaults to ``_external.LSH_TABLES``
+            n_bits: The number of bits in the codes of a new index, at most 64.  Defaults to ``_external.LSH_BITS``
+            seed: The seed of the random hash functions of a new index
+
+        Raises:
+            ValueError: The number of bits is not between 1 and 64
+        """
+        self.store = store
+        self.meta_path = os.path.join(store.path, self.META_FILE)
+        self.codes_path = os.path.join(store.path, 'lsh.bin')
+        self._codes = None
+        self._sorted = None
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            n_bits = n_bits or _external.LSH_BITS
+            if not 1 <= n_bits <= 64:
+                raise ValueError("LSH codes must have between 1 and 64 bits, not {}".format(n_bits))
+            self.meta = {'n_tables': n_tables or _external.LSH_TABLES, 'n_bits': n_bits, 'seed': seed, 'count': 0,
+                         'sorted': 0}
+            self._commit()
+
+        # The hash functions are drawn again from the seed rather than stored
+        rng = np.random.default_rng(self.meta['seed'])
+        self._planes = rng.standard_normal((store.width, self.n_tables * self.n_bits)).astype(np.float32)
+
+    def __repr__(self):
+        return "<LSHIndex {} rows, {} tables of {} bits>".format(self.meta['count'], self.n_tables, self.n_bits)
+
+    def __len__(self):
+        return self.meta['count']
+
+    @property
+    def n_tables(self):
+        return self.meta['n_tables']
+
+    @property
+    def n_bits(self):
+        return self.meta['n_bits']
+
+    def _commit(self):
+        temp_path = self.meta_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def _sorted_paths(self, count):
+        return (os.path.join(self.store.path, 'lsh_codes_{}.npy'.format(count)),
+                os.path.join(self.store.path, 'lsh_rows_{}.npy'.format(count)))
+
+    def hash(self, rows):
+        """
+        Args:
+            rows: A 2D array of fingerprints encoded as the store holds them
+
+        Returns:
+            A uint64 array of the code of each row in each table, of shape (rows, n_tables)
+        """
+        if self.store.dtype == 'bits':
+            rows = np.unpackbits(rows, axis=1, count=self.store.width)
+        bits = np.asarray(rows, dtype=np.float32) @ self._planes > 0
+        bits = bits.reshape(len(rows), self.n_tables, self.n_bits).astype(np.uint64)
+        return (bits << np.arange(self.n_bits, dtype=np.uint64)).sum(axis=2, dtype=np.uint64)
+
+    def codes(self):
+        """
+        Returns:
+            The codes of the rows hashed, memory-mapped from disk.  See ``hash``.
+        """
+        if self._codes is None:
+            if not len(self):
+                self._codes = np.empty((0, self.n_tables), dtype=np.uint64)
+            else:
+                self._codes = np.memmap(self.codes_path, dtype=np.uint64, mode='r', shape=(len(self), self.n_tables))
+        return self._codes
+
+    def update(self):
+        """
+        Hashes the rows appended to the store since the index was last updated, and commits them.
+        """
+        count = len(self)
+        matrix = self.store.matrix()
+        chunk_size = _external.FINGERPRINT_CHUNK_SIZE
+        with open(self.codes_path, 'ab') as f:
+            f.truncate(count * self.n_tables * 8)
+            for start in range(count, len(self.store), chunk_size):
+                f.write(np.ascontiguousarray(self.hash(matrix[start:start + chunk_size])).tobytes())
+        self.meta['count'] = len(self.store)
+        self._codes = None
+        if 8 * (len(self) - self.meta['sorted']) > len(self):
+            self._sort()
+        self._commit()
+
+    def _sort(self):
+        """
+        Sorts the codes of every row hashed in each table, replacing the sorted tables.
+        """
+        codes = self.codes()
+        rows = np.empty((self.n_tables, len(self)), dtype=np.int64)
+        sorted_codes = np.empty((self.n_tables, len(self)), dtype=np.uint64)
+        for table in range(self.n_tables):
+            rows[table] = np.argsort(codes[:, table], kind='stable')
+            sorted_codes[table] = codes[rows[table], table]
+
+        codes_path, rows_path = self._sorted_paths(len(self))
+        np.save(codes_path, sorted_codes)
+        np.save(rows_path, rows)
+        self.meta['sorted'] = len(self)
+        self._commit()
+        self._sorted = None
+        for path in glob.glob(os.path.join(self.store.path, 'lsh_*_*.npy')):
+            if path not in (codes_path, rows_path):
+                os.remove(path)
+
+    def candidates(self, query, radius=None):
+        """
+        Finds the rows that share a code with a query in any table, or whose code differs from it by up to ``radius``
+        bits.
+
+        Args:
+            query: The query fingerprint of the store's width
+            radius: The number of bits by which codes may differ.  Each table is probed for every code within the
+                radius, so the number of probes grows steeply with it.  Defaults to ``_external.LSH_RADIUS``
+
+        Returns:
+            A sorted array of the indexes of the rows found
+        """
+        radius = _external.LSH_RADIUS if radius is None else radius
+        code = self.hash(self.store.encode(query))[0]
+        flips = np.array([sum(1 << bit for bit in bits) for distance in range(radius + 1)
+                          for bits in itertools.combinations(range(self.n_bits), distance)], dtype=np.uint64)
+
+        if self._sorted is None and self.meta['sorted']:
+            self._sorted = tuple(np.load(path, mmap_mode='r') for path in self._sorted_paths(self.meta['sorted']))
+        codes = self.codes()
+        found = [np.empty(0, dtype=np.int64)]
+        for table in range(self.n_tables):
+            probes = np.sort(code[table] ^ flips)
+            if self._sorted is not None:
+                sorted_codes, rows = self._sorted[0][table], self._sorted[1][table]
+                starts = np.searchsorted(sorted_codes, probes, 'left')
+                ends = np.searchsorted(sorted_codes, probes, 'right')
+                found.extend(rows[start:end] for start, end in zip(starts, ends) if end > start)
+            unsorted = codes[self.meta['sorted']:, table]
+            found.append(self.meta['sorted'] + np.flatnonzero(np.isin(unsorted, probes)))
+        return np.unique(np.concatenate(found))
+
+    def remove(self):
+        """
+        Deletes the files of the index.
+        """
+        for path in [self.meta_path, self.codes_path] + glob.glob(os.path.join(self.store.path, 'lsh_*_*.npy')):
+            if os.path.exists(path):
+                os.remove(path)
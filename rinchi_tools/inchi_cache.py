@@ -0,0 +1,259 @@
+"""
+InChI Result Cache Module
+-------------------------
+
+This module provides a content-addressed cache for the results of the InChI software.  The same solvents, catalysts
+and reagents appear in thousands of reactions, so molfile to InChI and InChI to AuxInfo conversions are looked up
+here before the inchi-1 program is run.
+
+The cache has two tiers: a size-bounded in-memory LRU, and optionally a size-bounded SQLite database on disk that
+persists between runs and can be shared between processes.  Entries are keyed by a hash of the normalised molfile or
+InChI.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from . import _external
+
+
+def normalise_molfile(molf):
+    """
+    Normalises a molfile so that molfiles differing only in their header are treated as identical.
+
+    The name and comment lines of the header are discarded, as is everything on the program line except the
+    dimensional code, which affects stereo perception.  Trailing whitespace and the "M  END" line are also removed.
+
+    Args:
+        molf: The contents of a molfile as a string
+
+    Returns:
+        The normalised molfile
+    """
+    lines = [line.rstrip() for line in molf.split('\n')]
+    while lines and not lines[-1]:
+        lines.pop()
+    if lines and lines[-1] == 'M  END':
+        lines.pop()
+    if len(lines) > 3:
+        lines = [lines[1][20:22]] + lines[3:]
+    return '\n'.join(lines)
+
+
+def cache_key(kind, text):
+    """
+    Creates the cache key of an input.
+
+    Args:
+        kind: The type of conversion, e.g. "molf" or "auxinfo"
+        text: The normalised input
+
+    Returns:
+        The key as a hex digest string
+    """
+    return kind + ':' + hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class InChICache:
+    """
+    A two tier cache of InChI software results, with hit and miss counters.
+    """
+
+    def __init__(self, max_size=_external.INCHI_CACHE_SIZE, db_path=_external.INCHI_CACHE_PATH,
+                 max_db_size=_external.INCHI_CACHE_DB_SIZE):
+        """
+        Args:
+            max_size: The maximum number of entries held in memory
+            db_path: The path of the SQLite database used as the on-disk tier.  No on-disk tier is used if None.
+            max_db_size: The maximum number of entries held on disk
+        """
+        self.max_size = max_size
+        self.max_db_size = max_db_size
+        self.db_path = db_path
+        self.pid = os.getpid()
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        self._db_inserts = 0
+        if db_path is not None:
+            self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS inchi_cache (key TEXT PRIMARY KEY, value TEXT, '
+                            'last_used INTEGER)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS inchi_cache_last_used ON inchi_cache(last_used)')
+            self.db.commit()
+
+    def __repr__(self):
+        return "<InChICache {}>".format(self.stats())
+
+    def __len__(self):
+        return len(self.memory)
+
+    def stats(self):
+        """
+        Returns:
+            A dict of the hit and miss counters and the number of entries held in memory
+        """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'size': len(self.memory)}
+
+    def get_many(self, keys):
+        """
+        Looks up many keys, first in memory and then on disk.
+
+        Args:
+            keys: An iterable of cache keys
+
+        Returns:
+            A dict of the keys found and their values
+        """
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                if key in found:
+                    continue
+                try:
+                    found[key] = self.memory[key]
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                except KeyError:
+                    missing.append(key)
+
+            # Keys repeated within the batch are looked up and counted once
+            missing = list(dict.fromkeys(missing))
+            if missing and self.db is not None:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    query = 'SELECT key, value FROM inchi_cache WHERE key IN ({})'.format(', '.join('?' * len(chunk)))
+                    rows = self.db.execute(query, chunk).fetchall()
+                    if rows:
+                        self.db.executemany('UPDATE inchi_cache SET last_used = ? WHERE key = ?',
+                                            ((int(time.time()), key) for key, _ in rows))
+                    for key, value in rows:
+                        found[key] = value
+                        self._remember(key, value)
+                        self.disk_hits += 1
+                self.db.commit()
+            self.misses += sum(1 for key in missing if key not in found)
+        return found
+
+    def put_many(self, items):
+        """
+        Stores many results in both tiers.
+
+        Args:
+            items: An iterable of (key, value) pairs, where the value is a string
+        """
+        items = list(items)
+        with self.lock:
+            for key, value in items:
+                self._remember(key, value)
+            if self.db is not None and items:
+                now = int(time.time())
+                self.db.executemany('INSERT OR REPLACE INTO inchi_cache VALUES (?, ?, ?)',
+                                    ((key, value, now) for key, value in items))
+                self._db_inserts += len(items)
+
+                # Only count the table occasionally, evicting the least recently used entries
+                if self._db_inserts >= max(1, self.max_db_size // 100):
+                    self._db_inserts = 0
+                    excess = self.db.execute('SELECT COUNT(*) FROM inchi_cache').fetchone()[0] - self.max_db_size
+                    if excess > 0:
+                        self.db.execute('DELETE FROM inchi_cache WHERE key IN (SELECT key FROM inchi_cache ORDER BY '
+                                        'last_used LIMIT ?)', (excess,))
+                self.db.commit()
+
+    def _remember(self, key, value):
+        """
+        Adds an entry to the in-memory tier, evicting the least recently used entry if full.
+        """
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def cached(self, kind, inputs, normalise, convert):
+        """
+        Converts many inputs, only passing those not found in the cache to the conversion function.
+
+        Args:
+            kind: The type of conversion, used to separate the keys of different conversions
+            inputs: A list of input strings
+            normalise: Function normalising an input before it is hashed
+            convert: Function converting a list of inputs to a list of string results.  Empty results are not
+                cached.
+
+        Returns:
+            A list of results in the order of the input
+        """
+        keys = [cache_key(kind, normalise(item)) for item in inputs]
+        found = self.get_many(keys)
+
+        to_convert = OrderedDict()
+        for key, item in zip(keys, inputs):
+            if key not in found:
+                to_convert.setdefault(key, item)
+        if to_convert:
+            results = convert(list(to_convert.values()))
+            new = dict(zip(to_convert.keys(), results))
+            self.put_many((key, value) for key, value in new.items() if value)
+            found.update(new)
+        return [found[key] for key in keys]
+
+    def close(self):
+        """
+        Closes the on-disk tier
+        """
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Gets the cache shared by the InChI conversion functions of the module, creating it on first use.  A process
+    forked from one that already had a cache gets its own copy with the same settings, sharing only the disk tier.
+
+    Returns:
+        The default InChICache
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = InChICache()
+        elif _default_cache.pid != os.getpid():
+            _default_cache = InChICache(_default_cache.max_size, _default_cache.db_path, _default_cache.max_db_size)
+        return _default_cache
+
+
+def configure(max_size=_external.INCHI_CACHE_SIZE, db_path=_external.INCHI_CACHE_PATH,
+              max_db_size=_external.INCHI_CACHE_DB_SIZE):
+    """
+    Replaces the default cache, e.g. to add an on-disk tier.
+
+    Args:
+        max_size: The maximum number of entries held in memory
+        db_path: The path of the SQLite database used as the on-disk tier.  No on-disk tier is used if None.
+        max_db_size: The maximum number of entries held on disk
+
+    Returns:
+        The new default InChICache
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is not None:
+            _default_cache.close()
+        _default_cache = InChICache(max_size, db_path, max_db_size)
+        return _default_cache
@@ -0,0 +1,208 @@
+"""
+InChI Batch Engine Module
+-------------------------
+
+This module runs the IUPAC inchi-1 program over many structures at once.  Molfiles are collected into a single SD
+file, and InChIs into a single multi-line InChI file, so that inchi-1 is started once per batch rather than once per
+structure.  The output of each run is demultiplexed back to the input records using the "Structure: n" labels that
+inchi-1 writes before each result.
+
+The functions ``_rxn_rdf_patch.molf_2_inchi``, ``tools.inchi_2_auxinfo`` and ``tools.remove_stereo`` go through the
+default engine returned by ``get_engine()``, whose batch size and worker count can be changed with ``configure()``.
+"""
+
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import _external, utils
+
+# Matches the label written by inchi-1 before the output of each structure
+_STRUCTURE_LABEL = re.compile(r'Structure:\s*(\d+)')
+
+
+class InChIEngine:
+    """
+    Runs inchi-1 over batches of molfiles or InChIs.  Batches are run concurrently by up to ``workers`` inchi-1
+    processes.
+    """
+
+    def __init__(self, batch_size=_external.INCHI_BATCH_SIZE, workers=_external.INCHI_WORKERS,
+                 inchi_path=_external.INCHI_PATH):
+        """
+        Args:
+            batch_size: The maximum number of structures passed to a single inchi-1 process
+            workers: The maximum number of inchi-1 processes to run at once
+            inchi_path: The path of the inchi-1 executable
+        """
+        self.batch_size = max(1, int(batch_size))
+        self.workers = max(1, int(workers))
+        self.inchi_path = inchi_path
+
+    def __repr__(self):
+        return "<InChIEngine batch_size:{} workers:{}>".format(self.batch_size, self.workers)
+
+    def molfs_to_inchis(self, molfs):
+        """
+        Generates the InChIs and AuxInfos of many molfiles.
+
+        Args:
+            molfs: An iterable of molfiles as strings
+
+        Returns:
+            A list of (InChI, AuxInfo) tuples in the order of the input.  Empty strings are returned for any
+            structure that inchi-1 failed to convert.
+        """
+        records = []
+        for molf in molfs:
+            # The SD file record separator is only recognised after the end of the molfile
+            if not molf.rstrip().endswith('M  END'):
+                molf = molf.rstrip('\n') + '\nM  END'
+            records.append(molf.rstrip('\n') + '\n$$$$\n')
+        results = self._run(records, ['-STDIO'])
+        return [(result.get('InChI', ''), result.get('AuxInfo', '')) for result in results]
+
+    def inchis_to_auxinfos(self, inchis):
+        """
+        Generates AuxInfo for many InChIs.  The AuxInfos will not include 2D coordinates.
+
+        Args:
+            inchis: An iterable of InChIs
+
+        Returns:
+            A list of AuxInfos in the order of the input.  Empty strings are returned for any InChI that inchi-1
+            failed to convert.
+        """
+        records = [inchi.strip() + '\n' for inchi in inchis]
+        results = self._run(records, ['-stdio', '-InChI2Struct'])
+        return [result.get('AuxInfo', '') for result in results]
+
+    def remove_stereo(self, inchis):
+        """
+        Removes the stereochemistry from many InChIs.
+
+        Args:
+            inchis: An iterable of InChIs
+
+        Returns:
+            A list of InChIs without stereochemical layers, in the order of the input.  The input InChI is returned
+            unchanged for any InChI that inchi-1 failed to convert.
+        """
+        inchis = [inchi.strip() for inchi in inchis]
+        results = self._run([inchi + '\n' for inchi in inchis], ['-stdio', '-InChI2InChI', '-SNon'])
+        return [result.get('InChI', inchi) for result, inchi in zip(results, inchis)]
+
+    def _run(self, records, args):
+        """
+        Splits records into batches and runs inchi-1 over each batch.
+
+        Args:
+            records: A list of records as input file text
+            args: The inchi-1 options to use
+
+        Returns:
+            A list of dicts, one per record in input order, mapping the output type ("InChI" or "AuxInfo") to the
+            output line.
+        """
+        batches = [records[i:i + self.batch_size] for i in range(0, len(records), self.batch_size)]
+        if len(batches) > 1 and self.workers > 1:
+            with ThreadPoolExecutor(min(self.workers, len(batches))) as executor:
+                outputs = list(executor.map(lambda batch: self._run_batch(batch, args), batches))
+        else:
+            outputs = [self._run_batch(batch, args) for batch in batches]
+        return [result for output in outputs for result in output]
+
+    def _run_batch(self, records, args):
+        """
+        Runs inchi-1 once over a batch of records and demultiplexes its output.
+
+        Args:
+            records: A list of records as input file text
+            args: The inchi-1 options to use
+
+        Returns:
+            A list of dicts, one per record in input order, mapping the output type to the output line.
+        """
+        # Saves the records to a temporary file.
+        input_tempfile = tempfile.NamedTemporaryFile(delete=False)
+        input_tempfile.write(bytes(''.join(records), 'utf-8'))
+        input_tempfile.close()
+        try:
+            out, err = utils.call_command([self.inchi_path, input_tempfile.name] + args)
+        finally:
+            os.unlink(input_tempfile.name)
+        return self._demultiplex(out, len(records))
+
+    @staticmethod
+    def _demultiplex(output, count):
+        """
+        Assigns the lines of inchi-1 output to the records that produced them.
+
+        Args:
+            output: The text written by inchi-1 to stdout
+            count: The number of records in the batch
+
+        Returns:
+            A list of ``count`` dicts mapping the output type ("InChI" or "AuxInfo") to the output line.
+        """
+        results = [{} for _ in range(count)]
+        current = None
+        unlabelled = []
+        for line in output.splitlines():
+            label = _STRUCTURE_LABEL.match(line)
+            if label:
+                current = int(label.group(1)) - 1
+            elif line.startswith(('InChI=', 'AuxInfo=')):
+                kind = line.split('=', 1)[0]
+                if current is None:
+                    unlabelled.append((kind, line))
+                elif 0 <= current < count:
+                    results[current].setdefault(kind, line)
+
+        # Without labels, results can only be assigned by position when every record produced output
+        if unlabelled:
+            kinds = [kind for kind, _ in unlabelled]
+            per_record = len(set(kinds))
+            if len(unlabelled) == per_record * count:
+                for index, (kind, line) in enumerate(unlabelled):
+                    results[index // per_record][kind] = line
+        return results
+
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Gets the engine shared by the InChI conversion functions of the module, creating it on first use.
+
+    Returns:
+        The default InChIEngine
+    """
+    global _default_engine
+    with _default_engine_lock:
+        if _default_engine is None:
+            _default_engine = InChIEngine()
+        return _default_engine
+
+
+def configure(batch_size=None, workers=None):
+    """
+    Changes the batch size and worker count of the default engine.
+
+    Args:
+        batch_size: The maximum number of structures passed to a single inchi-1 process.  Unchanged if None.
+        workers: The maximum number of inchi-1 processes to run at once.  Unchanged if None.
+
+    Returns:
+        The default InChIEngine
+    """
+    engine = get_engine()
+    if batch_size is not None:
+        engine.batch_size = max(1, int(batch_size))
+    if workers is not None:
+        engine.workers = max(1, int(workers))
+    return engine
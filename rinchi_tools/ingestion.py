@@ -0,0 +1,318 @@
+"""
+RD File Ingestion Module
+------------------------
+
+This module converts whole directory trees of RD files into a single CSV file or SQLite table.
+
+Files are distributed across worker processes, each converting one RD file at a time, while all output passes through
+a single writer in the calling process.  A manifest records the path, size, modification time and status of every
+file, and the Long-RInChIKeys written so far.  An interrupted ingestion can therefore be resumed: files already
+completed are skipped if unchanged, and a CSV file is truncated back to the end of the last completed file.
+"""
+
+import csv
+import functools
+import os
+import sqlite3
+import time
+
+from . import conversion, database, rdf_reader, utils
+
+# The statuses of files recorded in the manifest
+DONE = 'done'
+FAILED = 'failed'
+
+
+class IngestionManifest:
+    """
+    Records the progress of a directory ingestion in SQLite tables.
+    """
+
+    def __init__(self, db):
+        """
+        Args:
+            db: An SQLite connection to the database holding the manifest tables.  For SQLite output this is the output
+                database, so that the manifest is committed in the same transaction as the rows written.
+        """
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS ingest_files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                        'status TEXT, reactions INTEGER, written INTEGER, seconds REAL, output_offset INTEGER, '
+                        'error TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ingest_keys (longkey TEXT PRIMARY KEY)')
+        self.db.commit()
+
+    def __repr__(self):
+        return "<IngestionManifest {}>".format(self.counts())
+
+    def counts(self):
+        """
+        Returns:
+            A dict of the number of files recorded with each status
+        """
+        return dict(self.db.execute('SELECT status, COUNT(*) FROM ingest_files GROUP BY status'))
+
+    def completed(self):
+        """
+        Returns:
+            A dict of the paths of the completed files and their (size, mtime) when they were ingested
+        """
+        rows = self.db.execute('SELECT path, size, mtime FROM ingest_files WHERE status = ?', (DONE,))
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def keys(self):
+        """
+        Returns:
+            A set of the Long-RInChIKeys written so far
+        """
+        return set(row[0] for row in self.db.execute('SELECT longkey FROM ingest_keys'))
+
+    def output_offset(self):
+        """
+        Returns:
+            The size of the CSV output file after the last completed file was written, or None if no file has been
+            completed
+        """
+        return self.db.execute('SELECT MAX(output_offset) FROM ingest_files WHERE status = ?', (DONE,)).fetchone()[0]
+
+    def record(self, path, size, mtime, status, reactions=0, written=(), seconds=0.0, output_offset=None, error=None):
+        """
+        Records the outcome of a file and the keys of the reactions written from it, without committing.
+
+        Args:
+            path: The path of the RD file
+            size: The size of the file when it was ingested
+            mtime: The modification time of the file when it was ingested, in nanoseconds
+            status: ``DONE`` or ``FAILED``
+            reactions: The number of unique reactions converted from the file
+            written: The Long-RInChIKeys of the reactions written, excluding those already present
+            seconds: The time taken to convert the file
+            output_offset: The size of the CSV output file after the file's rows were written
+            error: The error message of a failed file
+        """
+        written = list(written)
+        self.db.execute('INSERT OR REPLACE INTO ingest_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (path, size, mtime, status, reactions, len(written), seconds, output_offset, error))
+        self.db.executemany('INSERT OR IGNORE INTO ingest_keys VALUES (?)', ((key,) for key in written))
+
+
+def _ingest_file(task, columns, force_equilibrium=False):
+    """
+    Converts a single RD file.  Used as the task run by worker processes.
+
+    Args:
+        task: A tuple of the path, size and modification time of the RD file
+        columns: The columns of reaction data to generate
+        force_equilibrium: Whether to set the direction flags explicitly to equilibrium
+
+    Returns:
+        A tuple of the path, a list of (Long-RInChIKey, data dict) tuples of the unique reactions in the file, the time
+        taken in seconds, and an error message if the file could not be converted, otherwise None.
+    """
+    path = task[0]
+    tstart = time.time()
+    try:
+        with rdf_reader.RDFReader(path) as reader:
+            rows = [(data['longkey'], data) for data in
+                    conversion.iter_rdf_rinchis(reader, force_equilibrium=force_equilibrium, columns=columns,
+                                                return_longkeys=True)]
+    except Exception as e:
+        # librinchi raises a bare Exception for invalid reactions.  The file is recorded as failed rather than
+        # aborting the ingestion, so that resuming does not fail on it again.
+        return path, [], time.time() - tstart, "{}: {}".format(type(e).__name__, e)
+    return path, rows, time.time() - tstart, None
+
+
+def _find_rdfiles(root_dir):
+    """
+    Finds the RD files in a directory tree, in a stable order.
+
+    Args:
+        root_dir: The directory to search
+
+    Returns:
+        A list of absolute paths of files with an .rdf extension
+    """
+    paths = []
+    for root, folders, filenames in os.walk(os.path.abspath(root_dir)):
+        folders.sort()
+        paths.extend(os.path.join(root, filename) for filename in sorted(filenames)
+                     if os.path.splitext(filename)[1] == ".rdf")
+    return paths
+
+
+def ingest_directory(root_dir, output, table_name=None, return_rauxinfo=False, return_longkey=False,
+                     return_shortkey=False, return_webkey=False, force_equilibrium=False, jobs=1, resume=True):
+    """
+    Iterate recursively over all rdf files in the given folder, converting them in parallel and combining them into a
+    single CSV file or SQLite table.  Reactions are written once, in the order of the files, however many files they
+    appear in.  The throughput of each file is printed as it completes.
+
+    The progress is recorded in a manifest: for CSV output a SQLite file alongside the CSV file named
+    "<output>.manifest", and for SQLite output tables within the output database.
+
+    Args:
+        root_dir: The directory to search
+        output: The path of the CSV file, or of the SQLite database if ``table_name`` is given.  Unlike
+            ``conversion.create_csv_from_directory``, the path is used as given so that it can be resumed.
+        table_name: The name of the table to create or append.  If None, a CSV file is written instead.
+        return_rauxinfo: Include RAuxInfo in the result
+        return_longkey: Include Long key in the result
+        return_shortkey: Include the Short key in the result
+        return_webkey: Include the Web key in the result
+        force_equilibrium: Whether to set the direction flags explicitly to equilibrium
+        jobs: The number of worker processes converting files
+        resume: Whether to continue an earlier ingestion into the same output.  Otherwise, any existing manifest is
+            discarded, and a CSV file must not already exist.  Rows are always added to an existing SQLite table.
+
+    Returns:
+        A dict of the number of files recorded with each status
+
+    Raises:
+        IOError: The output exists and cannot be resumed, or a CSV file being resumed is missing or truncated
+    """
+    header = ["rinchi"]
+    for column, wanted in (("rauxinfo", return_rauxinfo), ("longkey", return_longkey),
+                           ("shortkey", return_shortkey), ("webkey", return_webkey)):
+        if wanted:
+            header.append(column)
+
+    if table_name is None:
+        if not os.path.splitext(output)[1]:
+            output += '.csv'
+        writer = _CSVWriter(output, header, resume)
+    else:
+        writer = _SQLWriter(output, table_name, header, resume)
+    manifest = writer.manifest
+
+    # Resume from the last checkpoint, skipping completed files that are unchanged since
+    completed = manifest.completed()
+    seen = manifest.keys()
+    tasks = []
+    for path in _find_rdfiles(root_dir):
+        stat = os.stat(path)
+        if completed.get(path) != (stat.st_size, stat.st_mtime_ns):
+            tasks.append((path, stat.st_size, stat.st_mtime_ns))
+    if completed:
+        print('Resuming: {} files already ingested, {} to go'.format(len(completed), len(tasks)))
+
+    # Workers convert whole files, while the rows are deduplicated and written here as each file completes
+    tstart = time.time()
+    total = 0
+    succeeded = False
+    try:
+        convert = functools.partial(_ingest_file, columns=writer.columns, force_equilibrium=force_equilibrium)
+        results = utils.ordered_parallel_map(convert, tasks, jobs)
+        for number, ((path, size, mtime), (_, rows, seconds, error)) in enumerate(zip(tasks, results)):
+            if error is not None:
+                manifest.record(path, size, mtime, FAILED, seconds=seconds, error=error)
+                writer.checkpoint()
+                print('[{}/{}] {}: failed, {}'.format(number + 1, len(tasks), path, error))
+                continue
+
+            new = []
+            for longkey, data in rows:
+                if longkey not in seen:
+                    seen.add(longkey)
+                    new.append((longkey, data))
+            writer.write(data for _, data in new)
+            manifest.record(path, size, mtime, DONE, len(rows), (longkey for longkey, _ in new), seconds,
+                            writer.offset())
+            writer.checkpoint()
+
+            total += len(rows)
+            print('[{}/{}] {}: {} reactions, {} new, in {:.2f} s ({:.1f} reactions/s)'.format(
+                number + 1, len(tasks), path, len(rows), len(new), seconds, len(rows) / seconds if seconds else 0))
+        succeeded = True
+    finally:
+        counts = manifest.counts()
+        writer.close(succeeded)
+
+    elapsed = time.time() - tstart
+    print('Ingested {} reactions from {} files in {:.1f} s ({:.1f} reactions/s)'.format(
+        total, len(tasks), elapsed, total / elapsed if elapsed else 0))
+    return counts
+
+
+class _CSVWriter:
+    """
+    Appends rows to a CSV file, with the manifest held in a separate SQLite file.
+    """
+
+    def __init__(self, path, header, resume):
+        self.path = os.path.abspath(path)
+        manifest_path = self.path + '.manifest'
+        if os.path.exists(self.path) and not (resume and os.path.exists(manifest_path)):
+            raise IOError("{} already exists and has no ingestion manifest to resume from".format(self.path))
+        if not resume and os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        self.manifest = IngestionManifest(sqlite3.connect(manifest_path))
+
+        # Discard any rows written after the last checkpoint, keeping the columns of the file being resumed
+        offset = self.manifest.output_offset()
+        if offset is not None:
+            if not os.path.exists(self.path) or os.path.getsize(self.path) < offset:
+                self.manifest.db.close()
+                raise IOError("{} is missing or shorter than when its ingestion manifest was written, so cannot be "
+                              "resumed".format(self.path))
+            with open(self.path, newline='') as f:
+                header = next(csv.reader(f, delimiter='$'), header)
+        self.file = open(self.path, 'a+', newline='')
+        self.file.truncate(offset or 0)
+        self.file.seek(0, os.SEEK_END)
+        self.columns = header
+        self.writer = csv.DictWriter(self.file, header, delimiter='$', extrasaction='ignore')
+        if not self.file.tell():
+            self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def offset(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def checkpoint(self):
+        self.manifest.db.commit()
+
+    def close(self, succeeded=True):
+        self.file.close()
+        self.manifest.db.close()
+
+
+class _SQLWriter:
+    """
+    Inserts rows into an SQLite table, with the manifest held in the same database and committed with the rows.
+    """
+
+    def __init__(self, path, table_name, header, resume):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA recursive_triggers = ON')
+        self.cursor = self.db.cursor()
+        self.table_name = table_name
+        if not resume:
+            self.cursor.execute('DROP TABLE IF EXISTS ingest_files')
+            self.cursor.execute('DROP TABLE IF EXISTS ingest_keys')
+        if not database._check_table_exists(table_name, self.cursor):
+            database._create_sql_table(self.cursor, table_name, header, 'longkey')
+        self.columns = database._get_sql_columns(self.cursor, table_name)
+        self.manifest = IngestionManifest(self.db)
+
+    def write(self, rows):
+        rows = (tuple(data.get(column) for column in self.columns) for data in rows)
+        database._sql_insert(self.cursor, self.table_name, rows, self.columns, True)
+
+    def offset(self):
+        return None
+
+    def checkpoint(self):
+        database._update_reaction_indexes(self.cursor, self.table_name)
+        self.db.commit()
+
+    def close(self, succeeded=True):
+        # Index the key columns once the bulk load is over, rather than updating the indexes row by row.  An
+        # interrupted load is left unindexed until it is resumed and completed.
+        self.db.close()
+        if succeeded:
+            database.create_indexes(self.path, self.table_name)
@@ -10,10 +10,50 @@ Modifications:
 """
 
 import collections
-from itertools import product
+import collections.abc
+from itertools import product, zip_longest
 
 from .molecule import Molecule
 
+# The screening stages of ``screen`` in the order they are checked
+SCREEN_STAGES = ('atoms', 'elements', 'degrees', 'rings')
+
+# The number of candidate pairs rejected by each screening stage, and passed on to matching, in this process
+SCREEN_STATS = collections.Counter()
+
+
+def screen(sub, master):
+    """
+    Checks cheap necessary conditions for a molecule to contain a substructure, so that most candidates that cannot
+    match are rejected without running the VF2 matcher.  Every atom of the substructure maps onto a distinct atom of
+    the same element, bonded to at least as many others, and its bonds onto bonds of the molecule, so the molecule
+    must have at least as many atoms of each element, of at least each degree, and at least as many independent rings.
+
+    The number of candidates rejected by each stage is counted in ``SCREEN_STATS``.
+
+    Args:
+        sub: The substructure ``Molecule``
+        master: The ``Molecule`` to search
+
+    Returns:
+        False if the molecule cannot contain the substructure, otherwise True
+    """
+    sub_atoms, sub_elements, sub_degrees, sub_rings = sub.get_screen_features()
+    master_atoms, master_elements, master_degrees, master_rings = master.get_screen_features()
+    if sub_atoms > master_atoms:
+        stage = 'atoms'
+    elif any(count > master_elements[element] for element, count in sub_elements.items()):
+        stage = 'elements'
+    elif any(s > m for s, m in zip_longest(sub_degrees, master_degrees, fillvalue=0)):
+        stage = 'degrees'
+    elif sub_rings > master_rings:
+        stage = 'rings'
+    else:
+        SCREEN_STATS['passed'] += 1
+        return True
+    SCREEN_STATS[stage] += 1
+    return False
+
 
 class Matcher(object):
     """
@@ -105,7 +145,7 @@ class Matcher(object):
         mappings = self.get_terminal_mappings()
         if mappings is None:
             mappings = self.get_backup_mappings()
-        assert isinstance(mappings, collections.Iterable)
+        assert isinstance(mappings, collections.abc.Iterable)
         return mappings
 
     def match(self):
@@ -53,8 +53,9 @@ class Molecule:
         self.has_searched_rings = False
         self.number_of_rings = None
 
-        # Matching flag
+        # Matching flag, and the invariants screened before matching
         self.matched_in_layer = False
+        self.screen_features = None
 
         # Perform initialisation
         self.init_level = None
@@ -928,6 +929,40 @@ class Molecule:
         self.chemical_formula_to_dict()
         return Counter(self.formula_dict)
 
+    def get_screen_features(self):
+        """
+        Get the graph invariants that a molecule must dominate to contain this one as a substructure, as used by
+        ``matcher.screen``.  They are calculated once and stored.
+
+        Returns:
+            A tuple of the number of atoms in the graph, a Counter of their elements (the formula without implicit
+            hydrogens), a list whose k-th entry is the number of atoms bonded to more than k others, and the number of
+            independent rings (the cycle rank of the graph)
+        """
+        if self.screen_features is None:
+            elements = Counter(atom.element for atom in self.atoms.values())
+            degrees = Counter(len(set(atom.bonds)) for atom in self.atoms.values())
+            at_least = []
+            remaining = len(self.atoms)
+            for degree in range(max(degrees, default=0)):
+                remaining -= degrees[degree]
+                at_least.append(remaining)
+
+            # Count the connected components to find the cycle rank, edges - atoms + components
+            unvisited = set(self.atoms)
+            components = 0
+            while unvisited:
+                components += 1
+                stack = [unvisited.pop()]
+                while stack:
+                    for neighbour in self.atoms[stack.pop()].bonds:
+                        if neighbour in unvisited:
+                            unvisited.remove(neighbour)
+                            stack.append(neighbour)
+            edges = sum(len(set(atom.bonds)) for atom in self.atoms.values()) // 2
+            self.screen_features = (len(self.atoms), elements, at_least, edges - len(self.atoms) + components)
+        return self.screen_features
+
     def count_sp3(self, wd=False, enantio=False):
         """
         Count the number of sp3 stereocentres in a molecule.
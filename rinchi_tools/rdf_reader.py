@@ -0,0 +1,207 @@
+"""
+RD File Reader Module
+---------------------
+
+This module provides a streaming reader for RD files.  The file is memory-mapped and its "$RFMT" reaction records are
+yielded one at a time, so peak memory is one record however large the file is.
+
+The byte offsets of the records can be saved to a sidecar index file next to the RD file.  With an index, counting
+the records, skipping to a start record and reading record N are single seeks.  The index records the size and
+modification time of the RD file, and is rebuilt automatically if the file changes.
+"""
+
+import mmap
+import os
+import struct
+from array import array
+from itertools import islice
+
+# The tag which begins each reaction record
+RECORD_TAG = b'$RFMT'
+
+# Sidecar index format: magic, then the RD file size and mtime, then the record offsets as unsigned 64 bit integers
+INDEX_EXTENSION = '.rfmtidx'
+_INDEX_MAGIC = b'RFMTIDX1'
+_INDEX_HEADER = struct.Struct('<8sQQ')
+
+
+class RDFReader:
+    """
+    Reads the reaction records of an RD file.  Each record is the text following a "$RFMT" tag, up to the next tag,
+    exactly as produced by ``rdfile.split('$RFMT')[1:]``.
+    """
+
+    def __init__(self, path, index=False):
+        """
+        Args:
+            path: The path of the RD file
+            index: Whether to load the sidecar offset index, building and saving it if missing or stale.  Otherwise
+                an index is only built in memory when random access requires one.
+        """
+        self.path = path
+        self.index_path = path + INDEX_EXTENSION
+        self.offsets = None
+
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        if self.size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b''
+
+        if index:
+            if not self.load_index():
+                self.build_index()
+                self.save_index()
+
+    def __repr__(self):
+        return "<RDFReader {}>".format(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def __len__(self):
+        if self.offsets is None:
+            self.build_index()
+        return len(self.offsets)
+
+    def __getitem__(self, n):
+        if self.offsets is None:
+            self.build_index()
+        if n < 0:
+            n += len(self.offsets)
+        if not 0 <= n < len(self.offsets):
+            raise IndexError("RD file record index out of range")
+        return self._record_at(self.offsets[n])
+
+    def close(self):
+        """
+        Closes the memory map and the underlying file
+        """
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def _find_tags(self, position=0):
+        """
+        Scans for record tags without decoding the file.
+
+        Args:
+            position: The byte offset to start scanning from
+
+        Returns:
+            A generator yielding the byte offset of each record tag
+        """
+        position = self._map.find(RECORD_TAG, position)
+        while position != -1:
+            yield position
+            position = self._map.find(RECORD_TAG, position + len(RECORD_TAG))
+
+    def _record_at(self, offset):
+        """
+        Reads the record beginning at the tag at the given offset.
+
+        Args:
+            offset: The byte offset of the record's tag
+
+        Returns:
+            The record text, without its tag
+        """
+        start = offset + len(RECORD_TAG)
+        end = self._map.find(RECORD_TAG, start)
+        if end == -1:
+            end = self.size
+        return self._map[start:end].decode('utf-8', errors='replace').replace('\r\n', '\n')
+
+    def records(self, start=0, stop=0):
+        """
+        Yields the records of the file one at a time.
+
+        Args:
+            start: The index of the first record to yield
+            stop: The index of the record at which to stop.  If 0, records are yielded until the end of the file.
+
+        Returns:
+            A generator yielding the record texts
+        """
+        if self.offsets is not None:
+            offsets = self.offsets[start:stop or len(self.offsets)]
+        else:
+            # Without an index, skipped records are only scanned for their tags, not decoded
+            offsets = islice(self._find_tags(), start, stop or None)
+        for offset in offsets:
+            yield self._record_at(offset)
+
+    def build_index(self):
+        """
+        Scans the file for the byte offsets of its records.
+
+        Returns:
+            An array of the offsets
+        """
+        self.offsets = array('Q', self._find_tags())
+        return self.offsets
+
+    def save_index(self):
+        """
+        Saves the record offsets to the sidecar index file, building them first if needed.
+        """
+        if self.offsets is None:
+            self.build_index()
+        with open(self.index_path, 'wb') as f:
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, self.size, self.mtime))
+            self.offsets.tofile(f)
+
+    def load_index(self):
+        """
+        Loads the record offsets from the sidecar index file.
+
+        Returns:
+            True if a valid index for the current file contents was loaded, otherwise False.
+        """
+        try:
+            with open(self.index_path, 'rb') as f:
+                magic, size, mtime = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+                if magic != _INDEX_MAGIC or size != self.size or mtime != self.mtime:
+                    return False
+                offsets = array('Q')
+                offsets.frombytes(f.read())
+        except (OSError, struct.error, ValueError):
+            return False
+        self.offsets = offsets
+        return True
+
+
+def iter_records(rdfile, start=0, stop=0):
+    """
+    Yields the records of an RD file given as text or as an ``RDFReader``, without splitting the whole text at once.
+
+    Args:
+        rdfile: The RD file text block, or an RDFReader
+        start: The index of the first record to yield
+        stop: The index of the record at which to stop.  If 0, records are yielded until the end of the file.
+
+    Returns:
+        A generator yielding the record texts
+    """
+    if isinstance(rdfile, RDFReader):
+        yield from rdfile.records(start, stop)
+        return
+
+    tag = RECORD_TAG.decode()
+    position = rdfile.find(tag)
+    index = 0
+    while position != -1 and (not stop or index < stop):
+        end = rdfile.find(tag, position + len(tag))
+        if index >= start:
+            yield rdfile[position + len(tag):end if end != -1 else len(rdfile)]
+        position = end
+        index += 1
@@ -17,16 +17,107 @@ import itertools
 import os
 import tempfile
 from collections import Counter
+from functools import lru_cache
 
-from numpy import all, array
-from scipy.sparse import csr_matrix
+from numpy import all, asarray, zeros
+from scipy.sparse import coo_matrix, csr_matrix
 
-from . import tools, utils
-from .matcher import Matcher
+from . import _external, fingerprints, inchi_engine, tools, utils
+from .matcher import Matcher, screen
 from .molecule import Molecule
 from .rinchi_lib import RInChI
 
 
+def obabel_fingerprint(inchi):
+    """
+    Generates the fingerprint of a molecule with obabel.
+
+    Args:
+        inchi: The InChI of the molecule
+
+    Returns:
+        A tuple of the bits of the fingerprint, which is empty if obabel could not fingerprint the molecule
+    """
+    i_out, i_err = utils.call_command(["obabel", "-iinchi", "-:" + inchi, "-ofpt"])
+    i_out = "".join(i_out.replace(" ", "").split("\n")[1:])
+
+    bitarray = []
+    i_out = bytearray.fromhex(i_out)
+    for byte in i_out:
+        bitarray.extend(map(int, list(format(byte, '08b'))))
+    return tuple(bitarray)
+
+
+# The same solvents, reagents and catalysts appear in many reactions, so their fingerprints are only generated once
+obabel_fingerprint_cached = lru_cache(maxsize=_external.FINGERPRINT_CACHE_SIZE)(obabel_fingerprint)
+
+
+def calculate_reaction_fingerprints(reactions, fingerprint_size=1024, backend=None, weights=None, dtype=None,
+                                    sparse=False):
+    """
+    Calculates the reaction fingerprints of many reactions at once, by the method of Daniel M. Lowe (2015): the
+    weighted difference omega_na * (products - reactants) + omega_a * agents of the sums of the fingerprints of each
+    class of molecule.
+
+    The fingerprint of each distinct molecule is generated once, by InChI, and stacked into a matrix.  The reaction
+    fingerprints are then the product of a sparse matrix of the weight of each molecule in each reaction with that
+    matrix.
+
+    Args:
+        reactions: A list of Reaction objects.  The fingerprint of each of their molecules is set as its
+            ``fingerprint`` attribute.
+        fingerprint_size: The length of the fingerprints.  obabel fingerprints are always 1024 bits.
+        backend: "obabel" for Open Babel's fingerprints, or "native" for ``fingerprints.circular_fingerprint``.
+            Defaults to ``_external.FINGERPRINT_BACKEND``
+        weights: A tuple of omega_na, the weight of reactants and products, and omega_a, the weight of agents.
+            Defaults to ``_external.REACTION_FINGERPRINT_WEIGHTS``
+        dtype: The numpy dtype of the fingerprints, which must be able to hold the weights.  Defaults to
+            ``_external.REACTION_FINGERPRINT_DTYPE``
+        sparse: Whether to return a scipy sparse CSR matrix rather than a numpy array
+
+    Returns:
+        A matrix with a row of the fingerprint of each reaction
+
+    Raises:
+        ValueError: The backend is not recognised
+    """
+    backend = backend or _external.FINGERPRINT_BACKEND
+    if backend == "obabel":
+        generate_fingerprint = obabel_fingerprint_cached
+    elif backend == "native":
+        def generate_fingerprint(inchi):
+            return fingerprints.circular_fingerprint_cached(inchi, fingerprint_size)
+    else:
+        raise ValueError("Unknown fingerprint backend {}".format(backend))
+    omega_na, omega_a = weights or _external.REACTION_FINGERPRINT_WEIGHTS
+    dtype = dtype or _external.REACTION_FINGERPRINT_DTYPE
+
+    # Number each distinct molecule, and record its weight in each reaction.  Repeated entries are summed.
+    columns = {}
+    molecule_fingerprints = []
+    rows, cols, values = [], [], []
+    for row, r in enumerate(reactions):
+        for molecules, weight in ((r.reactants, -omega_na), (r.products, omega_na), (r.reaction_agents, omega_a)):
+            for molecule in molecules:
+                column = columns.setdefault(molecule.inchi, len(columns))
+                if column == len(molecule_fingerprints):
+                    molecule_fingerprints.append(generate_fingerprint(molecule.inchi))
+                molecule.fingerprint = molecule_fingerprints[column]
+                rows.append(row)
+                cols.append(column)
+                values.append(weight)
+
+    # Molecules which could not be fingerprinted are left as zeros
+    stacked = zeros((len(molecule_fingerprints), fingerprint_size), dtype=dtype)
+    for column, fingerprint in enumerate(molecule_fingerprints):
+        if len(fingerprint):
+            stacked[column] = fingerprint
+    coefficients = coo_matrix((values, (rows, cols)), shape=(len(reactions), len(molecule_fingerprints)), dtype=dtype)
+
+    result = asarray(coefficients.tocsr() @ stacked, dtype=dtype)
+    return csr_matrix(result) if sparse else result
+
+
 class Reaction:
     """
     This class defines a reaction, as defined by a RInChI.  Molecule objects are created from all component InChIs,
@@ -34,10 +125,11 @@ class Reaction:
     reaction
     """
 
-    def __init__(self, rinchi):
+    def __init__(self, rinchi, validate=True):
         """
         Args:
             rinchi: A RInChI which represents the reaction
+            validate: Whether to split the RInChI with the RInChI C library, validating it.  See ``tools.split_rinchi``.
         """
 
         # Split the RInChI into it's InChIs:
@@ -46,7 +138,7 @@ class Reaction:
         self.skey = None
         self.wkey = None
         (self.reactant_inchis, self.product_inchis, self.agent_inchis, self.direction,
-         self.no_struct) = tools.split_rinchi(rinchi)
+         self.no_struct) = tools.split_rinchi(rinchi, validate)
 
         # Create Molecule objects for each inchi, breaking down InChIs representing composite species into individual
         # molecule objects
@@ -101,60 +193,25 @@ class Reaction:
             self.wkey = RInChI().rinchikey_from_rinchi(self.rinchi, "W")
         return self.wkey
 
-    def calculate_reaction_fingerprint(self, fingerprint_size=1024):
+    def calculate_reaction_fingerprint(self, fingerprint_size=1024, backend=None, weights=None, dtype=None):
         """
         Calculates a reaction fingerprint for a given reaction.  Uses a 1024 bit fingerprint by default
 
-        Method of Daniel M. Lowe (2015)
-
-        This function generates fingerprints for individual molecules using obabel. Could be simply modified to use
-        other software packages ie.  RDKIT if desired
+        Method of Daniel M. Lowe (2015).  See ``calculate_reaction_fingerprints``, which calculates the fingerprints of
+        many reactions at once.
 
         Args:
-            fingerprint_size: The length of the fingerprint to be generated.
+            fingerprint_size: The length of the fingerprint to be generated.  obabel fingerprints are always 1024 bits.
+            backend: "obabel" or "native", see ``calculate_reaction_fingerprints``
+            weights: A tuple of the weights omega_na and omega_a, see ``calculate_reaction_fingerprints``
+            dtype: The numpy dtype of the fingerprint
 
+        Raises:
+            ValueError: The backend is not recognised
         """
-
-        def generate_fingerprint(inchi):
-            i_out, i_err = utils.call_command(["obabel", "-iinchi", "-:" + inchi, "-ofpt"])
-            i_out = "".join(i_out.replace(" ", "").split("\n")[1:])
-
-            bitarray = []
-            i_out = bytearray.fromhex(i_out)
-            for byte in i_out:
-                bitarray.extend(map(int, list(format(byte, '08b'))))
-            return bitarray
-
-        for i in self.reactants:
-            i.fingerprint = generate_fingerprint(i.inchi)
-        for i in self.products:
-            i.fingerprint = generate_fingerprint(i.inchi)
-        for i in self.reaction_agents:
-            i.fingerprint = generate_fingerprint(i.inchi)
-
-        # Combining the fingerprints for each class of molecule
-        reactant_f = [sum(i) for i in zip(*[j.fingerprint for j in self.reactants if j.fingerprint])]
-        product_f = [sum(i) for i in zip(*[j.fingerprint for j in self.products if j.fingerprint])]
-        reaction_agent_f = [sum(i) for i in zip(*[j.fingerprint for j in self.reaction_agents if j.fingerprint])]
-
-        # If a reaction is missing any category, replace the entry with zero values
-        if not reaction_agent_f:
-            reaction_agent_f = [0] * fingerprint_size
-        if not product_f:
-            product_f = [0] * fingerprint_size
-        if not reactant_f:
-            reactant_f = [0] * fingerprint_size
-
-        # Combining the molecular fingerprints into a reaction fingerprint using the method of Daniel M.  Lowe omega
-        # and omega_na are empirically derived values as suggested in his 2015 paper
-        omega_na = 10
-        omega_a = 1
-        res = []
-        for i in range(0, len(reactant_f)):
-            res.append(omega_na * (product_f[i] - reactant_f[i]) + omega_a * reaction_agent_f[i])
-
         # Reaction fingerprint is stored as a numpy sparse array
-        self.reaction_fingerprint = csr_matrix(array(res))
+        self.reaction_fingerprint = calculate_reaction_fingerprints([self], fingerprint_size, backend, weights, dtype,
+                                                                    sparse=True)
 
     ##########################################
     # Conversions
@@ -172,9 +229,8 @@ class Reaction:
         for group in (self.reactant_inchis, self.product_inchis, self.agent_inchis):
             inchi_tempfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
 
-            for inchi in group:
-                # Fixes a documented obabel bug. Updating Obabel to 2.4.1 would render this fix unnecessary
-                inchi = tools.remove_stereo(inchi)
+            # Fixes a documented obabel bug. Updating Obabel to 2.4.1 would render this fix unnecessary
+            for inchi in inchi_engine.get_engine().remove_stereo(group):
                 inchi_tempfile.write(bytes(inchi + '\n', encoding='utf-8'))
 
             inchi_tempfile.close()
@@ -320,6 +376,24 @@ class Reaction:
             assert isinstance(m, Molecule)
             return m.has_isotopic_layer()
 
+    def change_descriptors(self):
+        """
+        Calculates every change across the reaction which ``detect_reaction`` can filter on, so that they can be stored
+        and searched without recalculating them.
+
+        Returns:
+            A dict of the names of the filters, as used by ``database.search_rinchis``, and a Counter of the non-zero
+            changes for each.  "isotopic" maps to a Counter of {"": 1} if the reaction has an isotopic InChI, otherwise
+            an empty Counter.
+        """
+        return {
+            'hyb': self.change_across_reaction(Molecule.get_hybrid_count),
+            'val': self.change_across_reaction(Molecule.get_valence_count),
+            'rings': self.change_across_reaction(Molecule.get_ring_count),
+            'formula': self.change_across_reaction(Molecule.get_formula),
+            'ringelements': self.change_across_reaction(Molecule.get_ring_count_inc_elements),
+            'isotopic': Counter({'': 1}) if self.has_isotopic_inchi() else Counter()}
+
     def detect_reaction(self, hyb_i=None, val_i=None, rings_i=None, formula_i=None, isotopic=False, ring_elements=None):
         """
         Detect if a reaction satisfies certain conditions.  Allows searching for reactions based on ring changes,
@@ -350,7 +424,7 @@ class Reaction:
             ring_elements = {}
         if formula_i:
             formula = self.change_across_reaction(Molecule.get_formula)
-            if not all(entry in formula.items() for entry in formula_i.items()):
+            if not all([entry in formula.items() for entry in formula_i.items()]):
                 return False
         if val_i:
             val = self.change_across_reaction(Molecule.get_valence_count)
@@ -409,9 +483,9 @@ class Reaction:
         Detects if the reaction is a substructure
 
         Args:
-            reactant_subs: Lists of reactant inchis
-            product_subs: List of product inchis
-            agent_subs: List of agent inchis
+            reactant_subs: Lists of reactant inchis, or ``Molecule`` objects compiled from them to reuse across reactions
+            product_subs: List of product inchis or ``Molecule`` objects
+            agent_subs: List of agent inchis or ``Molecule`` objects
             exclusive: Match one functionality per molecule of reactant
             rct_disappears: Only match if substructures not in products
             pdt_appears: Only match if substructures not in reactants
@@ -430,9 +504,9 @@ class Reaction:
         products = self.products
         agents = self.reaction_agents
 
-        reactant_s = [Molecule(r) for r in reactant_subs]
-        product_s = [Molecule(r) for r in product_subs]
-        agent_s = [Molecule(r) for r in agent_subs]
+        reactant_s = [r if isinstance(r, Molecule) else Molecule(r) for r in reactant_subs]
+        product_s = [r if isinstance(r, Molecule) else Molecule(r) for r in product_subs]
+        agent_s = [r if isinstance(r, Molecule) else Molecule(r) for r in agent_subs]
 
         def matcher_worker(sub, master):
             """
@@ -440,7 +514,7 @@ class Reaction:
             """
             if not master.matched_in_layer or not exclusive:
                 #  print(sub.inchi, master.inchi)
-                ret = Matcher(sub, master).is_sub()
+                ret = screen(sub, master) and Matcher(sub, master).is_sub()
                 if ret:
                     master.matched_in_layer = True
                 return ret
@@ -485,7 +559,8 @@ class Reaction:
     def has_substructures_by_populations(self, reactant_subs=None, product_subs=None, agent_subs=None, changing_subs=None, exclusive=False,
                                          unique=True):
         """
-        Detects if the reaction is a substructure
+        Detects if the reaction is a substructure.  The inchis may instead be ``Molecule`` objects compiled from them to
+        reuse across reactions, with the same object used wherever an inchi appears.
 
         Args:
             reactant_subs: Dictionary of reactant inchis and their populations in the layer
@@ -516,9 +591,12 @@ class Reaction:
             Has been written so that these functions could be implimented with multiprocessing in future
             """
             if not master.matched_in_layer or not exclusive:
-                sub = Molecule(sub)
+                if not isinstance(sub, Molecule):
+                    sub = Molecule(sub)
                 # print(sub, master)
-                if unique:
+                if not screen(sub, master):
+                    ret = 0
+                elif unique:
                     ret = Matcher(sub, master).sub_count_unique()
                 else:
                     ret = Matcher(sub, master).sub_count()
@@ -15,10 +15,15 @@ Modifications:
 """
 
 import ctypes as ct
+import threading
 
 from . import _external
 
 
+# Pre-encoded key type arguments for the key generation functions
+_KEY_TYPES = {"L": b"L", "S": b"S", "W": b"W"}
+
+
 class StringHandler(object):
     """
     Enables seamless use with Python 3 by converting to ascii within the argument objects
@@ -35,40 +40,68 @@ class StringHandler(object):
             return value.encode('ascii')
 
 
+# Library handles loaded so far, by path.  Loading the library and declaring its prototypes is only done once per
+# process; every RInChI instance thereafter reuses the same binding.
+_LIBRARIES = {}
+_LIBRARIES_LOCK = threading.Lock()
+
+
+def _load_library(lib_path):
+    """
+    Loads the librinchi library on first use and declares the ctypes prototypes of its functions.
+
+    Args:
+        lib_path: The path of the library to load
+
+    Returns:
+        The configured library handle
+    """
+    with _LIBRARIES_LOCK:
+        if lib_path in _LIBRARIES:
+            return _LIBRARIES[lib_path]
+
+        lib_handle = ct.cdll.LoadLibrary(lib_path)
+
+        lib_handle.rinchilib_latest_err_msg.restype = ct.c_char_p
+
+        lib_handle.rinchilib_rinchi_from_file_text.argtypes = [StringHandler, StringHandler, ct.c_bool,
+                                                               ct.POINTER(ct.c_char_p), ct.POINTER(ct.c_char_p)]
+        lib_handle.rinchilib_rinchi_from_file_text.restype = ct.c_long
+
+        lib_handle.rinchilib_rinchikey_from_file_text.argtypes = [StringHandler, StringHandler, StringHandler,
+                                                                  ct.c_bool, ct.POINTER(ct.c_char_p)]
+        lib_handle.rinchilib_rinchikey_from_file_text.restype = ct.c_long
+
+        lib_handle.rinchilib_file_text_from_rinchi.argtypes = [StringHandler, StringHandler, StringHandler,
+                                                               ct.POINTER(ct.c_char_p)]
+        lib_handle.rinchilib_file_text_from_rinchi.restype = ct.c_long
+
+        lib_handle.rinchilib_inchis_from_rinchi.argtypes = [StringHandler, StringHandler, ct.POINTER(ct.c_char_p)]
+        lib_handle.rinchilib_inchis_from_rinchi.restype = ct.c_long
+
+        lib_handle.rinchilib_rinchikey_from_rinchi.argtypes = [StringHandler, StringHandler, ct.POINTER(ct.c_char_p)]
+        lib_handle.rinchilib_rinchikey_from_rinchi.restype = ct.c_long
+
+        _LIBRARIES[lib_path] = lib_handle
+        return lib_handle
+
+
 class RInChI:
     """
-    The RInChI class interfaces the C class in the librinchi library
+    The RInChI class interfaces the C class in the librinchi library.  The library itself is loaded once per process
+    and shared by all instances, so creating an instance is cheap.
     """
 
     def __init__(self, lib_path=_external.LIB_RINCHI_PATH):
 
-        self.lib_handle = ct.cdll.LoadLibrary(lib_path)
+        self.lib_handle = _load_library(lib_path)
 
         self.lib_latest_error_message = self.lib_handle.rinchilib_latest_err_msg
-        self.lib_latest_error_message.restype = ct.c_char_p
-
         self.lib_rinchi_from_file_text = self.lib_handle.rinchilib_rinchi_from_file_text
-        self.lib_rinchi_from_file_text.argtypes = [StringHandler, StringHandler, ct.c_bool, ct.POINTER(ct.c_char_p),
-                                                   ct.POINTER(ct.c_char_p)]
-        self.lib_rinchi_from_file_text.restype = ct.c_long
-
         self.lib_rinchikey_from_file_text = self.lib_handle.rinchilib_rinchikey_from_file_text
-        self.lib_rinchikey_from_file_text.argtypes = [StringHandler, StringHandler, StringHandler,
-                                                      ct.c_bool, ct.POINTER(ct.c_char_p)]
-        self.lib_rinchikey_from_file_text.restype = ct.c_long
-
         self.lib_file_text_from_rinchi = self.lib_handle.rinchilib_file_text_from_rinchi
-        self.lib_file_text_from_rinchi.argtypes = [StringHandler, StringHandler, StringHandler,
-                                                   ct.POINTER(ct.c_char_p)]
-        self.lib_file_text_from_rinchi.restype = ct.c_long
-
         self.lib_inchis_from_rinchi = self.lib_handle.rinchilib_inchis_from_rinchi
-        self.lib_inchis_from_rinchi.argtypes = [StringHandler, StringHandler, ct.POINTER(ct.c_char_p)]
-        self.lib_inchis_from_rinchi.restype = ct.c_long
-
         self.lib_rinchikey_from_rinchi = self.lib_handle.rinchilib_rinchikey_from_rinchi
-        self.lib_rinchikey_from_rinchi.argtypes = [StringHandler, StringHandler, ct.POINTER(ct.c_char_p)]
-        self.lib_rinchikey_from_rinchi.restype = ct.c_long
 
     def rinchi_errorcheck(self, return_code):
         """
@@ -76,11 +109,14 @@ class RInChI:
 
         Args:
             return_code : the return code from the C library
+
+        Raises:
+            RInChIError: The library failed, e.g. on an invalid RInChI or InChI
         """
         if return_code != 0:
             err_message = str(self.lib_latest_error_message(), 'utf-8')
             print(err_message)
-            raise Exception(err_message)
+            raise _external.RInChIError(err_message)
 
     def rinchi_from_file_text(self, input_format, rxnfile_data, force_equilibrium=False):
         """
@@ -238,3 +274,38 @@ class RInChI:
         self.rinchi_errorcheck(self.lib_rinchikey_from_rinchi(rinchi_string, key_type, ct.byref(result)))
         result_uc = str(result.value, 'utf-8')
         return result_uc
+
+    def rinchikeys_from_rinchi(self, rinchi_string, key_types="LSW"):
+        """
+        Generates several RInChI keys of a RInChI at once.  The RInChI is only encoded once for all the keys.
+
+        Args:
+            rinchi_string: A RInChI string
+            key_types: A string of the key types to generate, any of "L", "S" and "W", in the order desired.
+
+        Returns:
+            A tuple of the RInChIKeys in the order given by key_types
+        """
+        if not isinstance(rinchi_string, bytes):
+            rinchi_string = rinchi_string.encode('ascii')
+        result = ct.c_char_p()
+        keys = []
+        for key_type in key_types:
+            self.rinchi_errorcheck(self.lib_rinchikey_from_rinchi(rinchi_string, _KEY_TYPES[key_type],
+                                                                  ct.byref(result)))
+            keys.append(str(result.value, 'utf-8'))
+        return tuple(keys)
+
+    def rinchikeys_from_rinchis(self, rinchis, key_types="LSW"):
+        """
+        Generates the RInChI keys of many RInChIs.  Intended for bulk keying; see ``rinchikeys_from_rinchi``.
+
+        Args:
+            rinchis: An iterable of RInChI strings
+            key_types: A string of the key types to generate, any of "L", "S" and "W", in the order desired.
+
+        Returns:
+            A generator yielding a tuple of the RInChIKeys for each RInChI, in input order
+        """
+        for rinchi_string in rinchis:
+            yield self.rinchikeys_from_rinchi(rinchi_string, key_types)
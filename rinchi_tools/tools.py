@@ -12,11 +12,11 @@ Modifications:
  - D.F. Hampshire 2016
 
 """
-import os
-import tempfile
 from collections import Counter
+from functools import lru_cache
+from itertools import zip_longest
 
-from . import _external, utils
+from . import _external, inchi_cache, inchi_engine, utils
 from .rinchi_lib import RInChI
 
 
@@ -273,13 +273,132 @@ def build_rauxinfo(l2_auxinfo, l3_auxinfo, l4_auxinfo):
     return rauxinfo
 
 
-def split_rinchi_inc_auxinfo(rinchi, rinchi_auxinfo):
+def parse_rinchi(rinchi, rinchi_auxinfo=""):
+    """
+    Splits a RInChI and optional RAuxInfo into their components in pure Python, in a single pass over the layers.
+
+    The result matches that of ``RInChI().inchis_from_rinchi``, including the "InChI=1S//" placeholders added for
+    each unknown structure, but the component InChIs themselves are not validated.  The components are returned as
+    tuples so that the result can safely be memoized; see ``parse_rinchi_cached``.
+
+    Args:
+        rinchi: A RInChI string
+        rinchi_auxinfo: The corresponding RAuxInfo.  May be blank.
+
+    Raises:
+        RInChIError: The RInChI or RAuxInfo is malformed
+
+    Returns:
+        A tuple containing:
+            reactants:
+                Tuple of reactant (InChI, AuxInfo) pairs
+            products:
+                Tuple of product (InChI, AuxInfo) pairs
+            agents:
+                Tuple of agent (InChI, AuxInfo) pairs
+            direction:
+                The direction character
+            no_structs:
+                Tuple of the numbers of unknown reactants, products and agents
+    """
+    rinchi_header = 'RInChI=' + _external.RINCHI_VERSION + '.'
+    header, separator, body = rinchi.rstrip().partition('/')
+    if not (separator and header.startswith(rinchi_header)):
+        raise _external.RInChIError("Invalid or incompatible RInChI header.")
+    inchi_prefix = 'InChI=' + header[len(rinchi_header):] + '/'
+
+    # Strip the direction and unknown structure layers from the end of the body.  InChI layers never begin with
+    # "d" or "u", so these are unambiguous.
+    direction = '+'
+    no_structs = [0, 0, 0]
+    for _ in range(2):
+        body_part, _, tail = body.rpartition('/')
+        if tail.startswith('d') and '<>' not in tail:
+            if tail not in ('d+', 'd-', 'd='):
+                raise _external.RInChIError("Invalid direction layer '/{}'.".format(tail))
+            direction = tail[1]
+        elif tail.startswith('u') and '<>' not in tail:
+            try:
+                counts = [int(count) for count in tail[1:].split('-')]
+            except ValueError:
+                raise _external.RInChIError("Invalid unknown structure layer '/{}'.".format(tail))
+            if len(counts) > 3:
+                raise _external.RInChIError("Invalid unknown structure layer '/{}'.".format(tail))
+            no_structs = counts + [0] * (3 - len(counts))
+        else:
+            break
+        body = body_part
+
+    layers = body.split('<>')
+    if len(layers) > 3:
+        raise _external.RInChIError("RInChI contains too many layers.")
+    layers += [''] * (3 - len(layers))
+
+    # Split the RAuxInfo in the same way, if present
+    aux_layers = [[], [], []]
+    aux_prefix = ''
+    if rinchi_auxinfo:
+        try:
+            aux_header, aux_body = rinchi_auxinfo.rstrip().split('/', 1)
+            aux_prefix = 'AuxInfo=' + aux_header.split('=', 1)[1].split('.', 2)[2] + '/'
+        except (ValueError, IndexError):
+            raise _external.RInChIError("Invalid or incompatible RAuxInfo header.")
+        aux_split = aux_body.split('<>')
+        if len(aux_split) > 3:
+            raise _external.RInChIError("RAuxInfo contains too many layers.")
+        aux_layers[:len(aux_split)] = [aux_layer.split('!') if aux_layer else [] for aux_layer in aux_split]
+
+    groups = []
+    for layer, auxinfos, unknown in zip(layers, aux_layers, no_structs):
+        bodies = layer.split('!') if layer else []
+        if len(auxinfos) > len(bodies):
+            raise _external.RInChIError("RAuxInfo contains too many elements in a layer.")
+        if '' in bodies:
+            raise _external.RInChIError("RInChI contains an empty component.")
+        group = [(inchi_prefix + inchi_body, aux_prefix + aux if aux else '')
+                 for inchi_body, aux in zip_longest(bodies, auxinfos, fillvalue='')]
+        group.extend([(inchi_prefix + '/', aux_prefix + '/' if aux_prefix else '')] * unknown)
+        groups.append(tuple(group))
+
+    # The first layer holds the reactants unless the reaction is reversed
+    if direction == '-':
+        return groups[1], groups[0], groups[2], direction, (no_structs[1], no_structs[0], no_structs[2])
+    return groups[0], groups[1], groups[2], direction, tuple(no_structs)
+
+
+# Memoized variant of parse_rinchi.  The same RInChIs recur often in bulk statistics and searches.
+parse_rinchi_cached = lru_cache(maxsize=_external.SPLIT_CACHE_SIZE)(parse_rinchi)
+
+
+def _split_components(rinchi, rinchi_auxinfo, validate):
+    """
+    Splits a RInChI into lists of (InChI, AuxInfo) pairs, the direction and the unknown structure counts.
+
+    Args:
+        rinchi: A RInChI String
+        rinchi_auxinfo: The corresponding RAuxInfo.  May be blank.
+        validate: Use the RInChI C library, which also validates the component InChIs, instead of the native parser.
+
+    Returns:
+        A tuple of the reactants, products, agents, direction and no-structure counts
+    """
+    if validate:
+        inchi_components = RInChI().inchis_from_rinchi(rinchi, rinchi_auxinfo)
+        return (inchi_components['Reactants'], inchi_components['Products'], inchi_components['Agents'],
+                inchi_components['Direction'], inchi_components['No-Structures'])
+    reactants, products, agents, direction, no_structs = parse_rinchi_cached(rinchi, rinchi_auxinfo)
+    return list(reactants), list(products), list(agents), direction, list(no_structs)
+
+
+def split_rinchi_inc_auxinfo(rinchi, rinchi_auxinfo, validate=True):
     """
     Returns the inchi and auxinfo pairs, each in lists, the direction character, and a list of unknown structures.
 
     Args:
         rinchi: A RInChI String
         rinchi_auxinfo: The corresponding RAuxInfo
+        validate: Split using the RInChI C library, validating the component InChIs.  Defaults to True.  Pass False in
+            bulk operations to use the faster, memoized native parser, see ``parse_rinchi``.
 
     Returns:
         A tuple containing:
@@ -294,21 +413,17 @@ def split_rinchi_inc_auxinfo(rinchi, rinchi_auxinfo):
             no_structs:
                 returns a list of the numbers of unknown structures in each layer
     """
-    inchi_components = RInChI().inchis_from_rinchi(rinchi, rinchi_auxinfo)
-    direction = inchi_components['Direction']
-    reactants = inchi_components['Reactants']
-    products = inchi_components['Products']
-    agents = inchi_components['Agents']
-    no_structs = inchi_components['No-Structures']
-    return reactants, products, agents, direction, no_structs
+    return _split_components(rinchi, rinchi_auxinfo, validate)
 
 
-def split_rinchi(rinchi):
+def split_rinchi(rinchi, validate=True):
     """
     Returns the inchis without RAuxInfo, each in lists, and the direct and no_structs lists
 
     Args:
         rinchi: A RInChI String
+        validate: Split using the RInChI C library, validating the component InChIs.  Defaults to True.  Pass False in
+            bulk operations to use the faster, memoized native parser, see ``parse_rinchi``.
 
     Returns:
         A tuple containing:
@@ -323,25 +438,22 @@ def split_rinchi(rinchi):
             no_structs:
                 returns a list of the numbers of unknown structures in each layer
     """
-    inchi_components = RInChI().inchis_from_rinchi(rinchi, "")
-    direction = inchi_components['Direction']
-    reactants = inchi_components['Reactants']
-    products = inchi_components['Products']
-    agents = inchi_components['Agents']
-    no_structs = inchi_components['No-Structures']
+    reactants, products, agents, direction, no_structs = _split_components(rinchi, "", validate)
     rct_inchis = [el[0] for el in reactants]
     pdt_inchis = [el[0] for el in products]
     agt_inchis = [el[0] for el in agents]
     return rct_inchis, pdt_inchis, agt_inchis, direction, no_structs
 
 
-def split_rinchi_only_auxinfo(rinchi, rinchi_auxinfo):
+def split_rinchi_only_auxinfo(rinchi, rinchi_auxinfo, validate=True):
     """
     Returns the RAuxInfo
 
     Args:
         rinchi: A RInChI String
         rinchi_auxinfo: The corresponding RAuxInfo
+        validate: Split using the RInChI C library, validating the component InChIs.  Defaults to True.  Pass False in
+            bulk operations to use the faster, memoized native parser, see ``parse_rinchi``.
 
     Returns:
         A tuple containing:
@@ -352,10 +464,7 @@ def split_rinchi_only_auxinfo(rinchi, rinchi_auxinfo):
             agt_inchis_auxinfo:
                 List of agent AuxInfos
     """
-    inchi_components = RInChI().inchis_from_rinchi(rinchi, rinchi_auxinfo)
-    reactants = inchi_components['Reactants']
-    products = inchi_components['Products']
-    agents = inchi_components['Agents']
+    reactants, products, agents, _, _ = _split_components(rinchi, rinchi_auxinfo, validate)
     rct_inchis_auxinfo = [el[1] for el in reactants]
     pdt_inchis_auxinfo = [el[1] for el in products]
     agt_inchis_auxinfo = [el[1] for el in agents]
@@ -420,18 +529,11 @@ def generate_rauxinfo(rinchi):
     else:
         l2_inchis, l3_inchis = reactants, products
 
-    # Look up the AuxInfo for the InChIs.
-
-    def auxinfo_convert(inchis):
-        auxinfos = []
-        for inchi in inchis:
-            auxinfo = inchi_2_auxinfo(inchi)
-            auxinfos.append(auxinfo)
-        return auxinfos
-
-    l2_auxinfo = auxinfo_convert(l2_inchis)
-    l3_auxinfo = auxinfo_convert(l3_inchis)
-    l4_auxinfo = auxinfo_convert(agents)
+    # Look up the AuxInfo for the InChIs, all in one batch.
+    auxinfos = inchis_2_auxinfos(l2_inchis + l3_inchis + agents)
+    l2_auxinfo = auxinfos[:len(l2_inchis)]
+    l3_auxinfo = auxinfos[len(l2_inchis):len(l2_inchis) + len(l3_inchis)]
+    l4_auxinfo = auxinfos[len(l2_inchis) + len(l3_inchis):]
     rauxinfo = build_rauxinfo(l2_auxinfo, l3_auxinfo, l4_auxinfo)
     return rauxinfo
 
@@ -553,7 +655,7 @@ def add(rinchis):
     # Iterate over the RInChI steps.
     for rinchi in rinchis:
         # Parse the structures in the RInChI.
-        reactants, products, extras, direction, no_structs = split_rinchi(rinchi)
+        reactants, products, extras, direction, no_structs = split_rinchi(rinchi, validate=False)
         if not all(v == 0 for v in no_structs):
             raise ValueError("No structures present")
 
@@ -658,9 +760,9 @@ def inchi_2_auxinfo(inchi):
     """
     Run the InChI software on an InChI to generate AuxInfo.
 
-    The function saves the InChI to a temporary file, and runs the inchi-1 program on this tempfile as a subprocess.
-    The AuxInfo will not include 2D coordinates, but an AuxInfo of some kind is required for the InChI software to
-    convert an InChI to an SDFile.
+    The InChI is passed to the default ``inchi_engine`` engine, which runs the inchi-1 program as a subprocess.  The
+    AuxInfo will not include 2D coordinates, but an AuxInfo of some kind is required for the InChI software to
+    convert an InChI to an SDFile.  Use ``inchis_2_auxinfos`` to convert many InChIs at once.
 
     Args:
         inchi: An InChI from which to generate AuxInfo.
@@ -668,21 +770,22 @@ def inchi_2_auxinfo(inchi):
     Returns:
         The InChI's AuxInfo (will not contain 2D coordinates).
     """
-    # Save the InChI to a temporary file.
-    inchi_tempfile = tempfile.NamedTemporaryFile(delete=False)
-    inchi_tempfile.write(bytes(inchi, 'UTF-8'))
+    return inchis_2_auxinfos([inchi])[0]
 
-    # A newline is required at the end of the file or the InChI program fails
-    # to generate any output (this may be a bug).
-    inchi_tempfile.write(bytes('\n', 'UTF-8'))
-    inchi_tempfile.close()
 
-    # Run the inchi-1 program, and extract the AuxInfo
-    args = [_external.INCHI_PATH, inchi_tempfile.name, '-stdio', '-InChI2Struct']
-    raw_inchi_out, inchi_err = utils.call_command(args)
-    os.unlink(inchi_tempfile.name)
-    auxinfo = raw_inchi_out.splitlines()[2]
-    return auxinfo
+def inchis_2_auxinfos(inchis):
+    """
+    Run the InChI software on many InChIs at once to generate their AuxInfos.  Results are looked up in, and added
+    to, the default ``inchi_cache`` cache, so only InChIs not seen before are converted.
+
+    Args:
+        inchis: An iterable of InChIs
+
+    Returns:
+        A list of AuxInfos in the order of the input (will not contain 2D coordinates).
+    """
+    return inchi_cache.get_cache().cached('auxinfo', list(inchis), str.strip,
+                                          inchi_engine.get_engine().inchis_to_auxinfos)
 
 
 def process_stats(rinchis, mostcommon=None):
@@ -702,7 +805,7 @@ def process_stats(rinchis, mostcommon=None):
             'unknownstructs': Counter(), 'components': Counter()}
 
     for rinchi in rinchis:
-        rct_inchis, pdt_inchis, agt_inchis, direction, no_structs = split_rinchi(rinchi)
+        rct_inchis, pdt_inchis, agt_inchis, direction, no_structs = split_rinchi(rinchi, validate=False)
         data['reactants'].update(rct_inchis)
         data['products'].update(pdt_inchis)
         data['agents'].update(agt_inchis)
@@ -737,20 +840,4 @@ def remove_stereo(inchi):
     Returns:
         an InChI
     """
-    # Save the InChI to a temporary file.
-    inchi_tempfile = tempfile.NamedTemporaryFile(delete=False)
-    inchi_tempfile.write(bytes(inchi, 'UTF-8'))
-
-    # A newline is required at the end of the file or the InChI program fails
-    # to generate any output (this may be a bug).
-    inchi_tempfile.write(bytes('\n', 'UTF-8'))
-    inchi_tempfile.close()
-
-    # Run the inchi-1 program, and extract the AuxInfo
-    args = [_external.INCHI_PATH, inchi_tempfile.name, '-stdio', '-InChI2InChI', '-NoLabels', '-SNon']
-    raw_inchi_out, inchi_err = utils.call_command(args)
-    os.unlink(inchi_tempfile.name)
-    for line in raw_inchi_out.splitlines():
-        if line.startswith("InChI"):
-            inchi = line
-    return inchi
+    return inchi_engine.get_engine().remove_stereo([inchi])[0]
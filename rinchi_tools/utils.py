@@ -10,11 +10,15 @@ Modifications:
 """
 
 import collections
+import hashlib
+import itertools
+import math
 import os
 import subprocess
 import sys
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 
 def output(text, output_path=False, default_extension=False):
@@ -127,6 +131,120 @@ def consolidate(items):
     return value
 
 
+def chunked(iterable, size):
+    """
+    Groups the items of an iterable into lists, without consuming the iterable ahead of the list being built.
+
+    Args:
+        iterable: The iterable to group
+        size: The maximum number of items in each list
+
+    Returns:
+        A generator yielding lists of up to ``size`` items
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def ordered_parallel_map(function, iterable, jobs=1, max_in_flight=None, initializer=None, initargs=()):
+    """
+    Maps a function over an iterable in a pool of worker processes, yielding the results in input order.
+
+    Only ``max_in_flight`` items are submitted ahead of the result being yielded, so a long iterable is consumed lazily
+    and the memory held by queued inputs and unconsumed results stays bounded.
+
+    Args:
+        function: A picklable function of one argument, e.g. a module level function or a ``functools.partial``
+        iterable: The inputs, which must be picklable
+        jobs: The number of worker processes.  If 1, the function is mapped in the calling process.
+        max_in_flight: The maximum number of inputs submitted but not yet yielded.  Defaults to twice ``jobs``.
+        initializer: A picklable function run once by each worker process before it maps any inputs, e.g. to build
+            state shared by every call.  If ``jobs`` is 1, it is run in the calling process.
+        initargs: The arguments of ``initializer``
+
+    Returns:
+        A generator yielding the results
+    """
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(function, iterable)
+        return
+
+    iterator = iter(iterable)
+    pending = collections.deque()
+    with ProcessPoolExecutor(jobs, initializer=initializer, initargs=initargs) as executor:
+        try:
+            for item in itertools.islice(iterator, max_in_flight or 2 * jobs):
+                pending.append(executor.submit(function, item))
+            while pending:
+                result = pending.popleft().result()
+                for item in itertools.islice(iterator, 1):
+                    pending.append(executor.submit(function, item))
+                yield result
+        finally:
+            # Don't wait for the remaining work if the consumer stops early or a worker fails
+            for future in pending:
+                future.cancel()
+
+
+class BloomFilter:
+    """
+    A fixed size, probabilistic set of strings.  Membership tests never give false negatives, and give false positives
+    at about the error rate chosen once ``capacity`` items have been added.  Supports ``in`` and ``add()`` like a set.
+    """
+
+    def __init__(self, capacity, error_rate=1e-6):
+        """
+        Args:
+            capacity: The number of items the filter is sized for
+            error_rate: The false positive rate once ``capacity`` items have been added
+        """
+        capacity = max(1, int(capacity))
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __repr__(self):
+        return "<BloomFilter {} items, {} bits, {} hashes>".format(self.count, self.size, self.hash_count)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def _positions(self, item):
+        """
+        Derives the bit positions of an item from two halves of a single hash by enhanced double hashing.
+        """
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little')
+        return ((first + i * second + (i ** 3 - i) // 6) % self.size for i in range(self.hash_count))
+
+    def add(self, item):
+        """
+        Adds an item to the filter
+
+        Args:
+            item: The string to add
+        """
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        # Items already present set no new bits, so are not counted again
+        if added:
+            self.count += 1
+
+
 class Spinner:
     """
     A spinner which shows during a long process.
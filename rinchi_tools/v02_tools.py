@@ -42,17 +42,11 @@ def generate_rauxinfo(rinchi):
     # Split the RInChI into constituent InChIs
     gp1_inchis, gp2_inchis, gp3_inchis, direct, u = _split_rinchi(rinchi)
 
-    # Look up the AuxInfo for the InChIs.
-    def auxinfo_convert(inchis):
-        auxinfos = []
-        for inchi in inchis:
-            auxinfo = tools.inchi_2_auxinfo(inchi)
-            auxinfos.append(auxinfo)
-        return auxinfos
-
-    gp1_auxinfo = auxinfo_convert(gp1_inchis)
-    gp2_auxinfo = auxinfo_convert(gp2_inchis)
-    gp3_auxinfo = auxinfo_convert(gp3_inchis)
+    # Look up the AuxInfo for the InChIs, all in one batch.
+    auxinfos = tools.inchis_2_auxinfos(gp1_inchis + gp2_inchis + gp3_inchis)
+    gp1_auxinfo = auxinfos[:len(gp1_inchis)]
+    gp2_auxinfo = auxinfos[len(gp1_inchis):len(gp1_inchis) + len(gp2_inchis)]
+    gp3_auxinfo = auxinfos[len(gp1_inchis) + len(gp2_inchis):]
 
     # Format the AuxInfos for inclusion in the RAuxInfo.
     def rauxinfofy(auxinfos):